@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+'''
+Benchmark suite for pyBackup.
+
+Generates deterministic source trees (see treegen.py) and backs them up
+end to end with rsyncBackup.backup() to a directory standing in for the
+backup disk: a full backup, a backup with nothing changed, and a backup
+after churn (modified, appended, new, and deleted files plus a renamed
+directory). get_MountPoint is stubbed to return the directory and the
+application directory, with the config file and run history, is put in
+a temporary HOME, so nothing outside the work directory is touched and
+no network or disk is needed; only the local rsync binary. Backups with
+the 'cas' backend need no rsync at all.
+
+Microbenchmarks time parsing of rsync output, listing the backups in a
+backup directory, planning and deleting old backups, config writes, and
+the start up of a fresh interpreter importing the package, running the
+preflight check of scheduled backups, and importing the backup modules.
+Files created by the imports are reported; there should be none.
+
+Results are written as JSON, with the version, git commit, Python, and
+rsync version they were measured with; --compare reports the timings
+that got slower than in an earlier result file, e.g.,
+
+  python3 backup_bench.py --output new.json --compare old.json
+'''
+import os, sys, time, json, shutil, socket, platform, tempfile, argparse, logging
+from subprocess import check_output, check_call
+
+HERE = os.path.dirname( os.path.realpath(__file__) )
+ROOT = os.path.dirname( HERE )
+UUID = 'BENCHMARK'
+sys.path.insert( 0, HERE )
+sys.path.insert( 0, ROOT )
+import treegen
+
+def version( cmd ):
+  '''Return first line of output of cmd, or None'''
+  try:
+    return check_output( cmd, cwd = ROOT, stderr = open(os.devnull, 'w') ).decode().splitlines()[0].strip()
+  except Exception:
+    return None
+
+def timeit( func, repeat = 1 ):
+  '''Return best time of repeat calls of func, in seconds, and its last result'''
+  best = None
+  for i in range( repeat ):
+    t0     = time.perf_counter()
+    result = func()
+    dt     = time.perf_counter() - t0
+    best   = dt if best is None else min( best, dt )
+  return best, result
+
+################################################################################
+def endToEnd( work, profile, scale, backend ):
+  '''
+  Purpose:
+    Function to time full, unchanged, and churned backups of a
+    generated tree
+  Inputs:
+    work    : Work directory
+    profile : Tree profile of treegen
+    scale   : Scale of the tree
+    backend : 'rsync' or 'cas'
+  Outputs:
+    Returns dictionary of results for each run
+  '''
+  from pyBackup import utils
+  from pyBackup.rsyncBackup import rsyncBackup
+  from pyBackup.casBackup import casBackup
+
+  src  = os.path.join( work, 'src-{}'.format(profile) )
+  disk = os.path.join( work, 'disk-{}-{}'.format(profile, backend) )
+  if os.path.isdir( src ): shutil.rmtree( src );                               # Churned by the other backend; start from the same tree
+  treegen.generate( src, profile, scale )
+  os.makedirs( disk )
+  utils.get_MountPoint = lambda uuid: disk if uuid == UUID else None
+  utils.CONFIG['destinations'] = [ {'uuid' : UUID, 'backend' : backend} ]
+  utils.CONFIG.saveConfig()
+  cls  = casBackup if backend == 'cas' else rsyncBackup
+
+  results = {}
+  for run in ['full', 'unchanged', 'churn']:
+    if run == 'churn':
+      results['churn_changes'] = treegen.churn( src, fraction = 0.02 )
+    time.sleep( 1.0 )                                                           # New backup name; names have a resolution of seconds
+    inst = cls( src_dir = src, loglevel = logging.WARNING, signals = False )
+    dt, status = timeit( inst.backup )
+    results[run] = {'seconds' : dt, 'status' : status,
+                    'phases'  : dict( inst.metrics.phases ),
+                    'files_transferred' : inst.stats.get('number_of_regular_files_transferred', None),
+                    'bytes_transferred' : inst.stats.get('total_transferred_file_size', None)}
+  shutil.rmtree( disk )
+  return results
+
+################################################################################
+def parsing( work, nfiles ):
+  '''Time parsing of synthetic rsync output for nfiles files'''
+  import parser_bench
+  path = os.path.join( work, 'rsync_output.txt' )
+  parser_bench.record( path, nfiles )
+  dt, lines = timeit( lambda: parser_bench.runParser( path, False ), repeat = 3 )
+  os.remove( path )
+  return {'seconds' : dt, 'lines' : lines, 'lines_per_s' : lines / dt}
+
+################################################################################
+def dirList( work, nbackups, repeat ):
+  '''Time listing a backup directory holding nbackups backups'''
+  from pyBackup.rsyncBackup import rsyncBackup
+  backup_dir = os.path.join( work, 'dirlist' )
+  for i in range( nbackups ):
+    name = time.strftime( '%Y-%m-%dT%H_%M_%S', time.gmtime( treegen.EPOCH + 3600 * i ) )
+    os.makedirs( os.path.join( backup_dir, name + ('.inprogress' if i % 50 == 0 else '') ) )
+  os.makedirs( os.path.join( backup_dir, '.trash' ) )
+  inst = rsyncBackup( signals = False, loglevel = logging.WARNING )
+  dt, _ = timeit( lambda: inst._rsyncBackup__getDirList( backup_dir ), repeat = repeat )
+  shutil.rmtree( backup_dir )
+  return {'seconds' : dt, 'backups' : nbackups}
+
+################################################################################
+class fakeUsage( object ):
+  '''Stand-in for diskUsage with a fixed size for each backup'''
+  def __init__(self, sizes):
+    self.sizes = sizes
+  def accounted(self, name):
+    return name in self.sizes
+  def reclaimable(self, names):
+    return sum( self.sizes[n] for n in names )
+  def shares(self, names):
+    return {n : [(n, 1)] for n in names}, {n : (self.sizes[n], 1) for n in names}
+
+def pruning( work, nbackups, scale ):
+  '''Time planning which of nbackups hourly backups to expire, and deleting a backup'''
+  from pyBackup.retention import retentionPlanner
+  from pyBackup.trashReaper import trashReaper
+  now     = time.time()
+  names   = [ time.strftime( '%Y-%m-%dT%H_%M_%S', time.gmtime( now - 3600 * i ) ) for i in range( nbackups ) ]
+  usage   = fakeUsage( {n : 1024**2 * (i % 7 + 1) for i, n in enumerate( names )} )
+  planner = retentionPlanner( usage = usage, date_FMT = '%Y-%m-%dT%H_%M_%S' )
+  plan_dt, plan = timeit( lambda: planner.plan( names, 50 * 1024**2, now = now ), repeat = 3 )
+
+  backup_dir = os.path.join( work, 'prune' )
+  tree       = os.path.join( backup_dir, 'backup' )
+  info       = treegen.generate( tree, 'small', scale )
+  reaper     = trashReaper( backup_dir, workers = 4 )
+  def delete():
+    reaper.trash( tree )
+    reaper.start()
+    reaper.join()
+  delete_dt, _ = timeit( delete )
+  shutil.rmtree( backup_dir )
+  return {'plan'   : {'seconds' : plan_dt, 'backups' : nbackups, 'deleted' : len(plan['delete'])},
+          'delete' : {'seconds' : delete_dt, 'files' : info['files'], 'files_per_s' : info['files'] / delete_dt}}
+
+################################################################################
+def configWrites( work, writes ):
+  '''Time saving single changes, a transaction of many changes, and delayed saves'''
+  from pyBackup import utils
+  path   = os.path.join( work, 'config.json' )
+  shutil.copy( os.path.join( ROOT, 'pyBackup', 'config.json' ), path )
+  config = utils.Config( path )
+  def single():
+    for i in range( writes ):
+      config['bench'] = i
+      config.saveConfig()
+  def transaction():
+    with config.transaction():
+      for i in range( writes ):
+        config['bench'] = -i
+  def delayed():
+    for i in range( writes ):
+      config['bench'] = i + writes
+      config.saveConfig( delay = utils.SAVE_DELAY )
+    config.flush()
+  out = {}
+  for name, func in [('single', single), ('transaction', transaction), ('delayed', delayed)]:
+    dt, _ = timeit( func )
+    out[name] = {'seconds' : dt, 'writes' : writes, 'writes_per_s' : writes / dt}
+  return out
+
+################################################################################
+STARTUP = {'python'    : 'pass',
+           'package'   : 'import pyBackup',
+           'utils'     : 'import pyBackup.utils',
+           'preflight' : 'from pyBackup.preflight import preflight; preflight("/")',
+           'backup'    : 'import pyBackup.rsyncBackup',
+           'cli'       : 'import pyBackup.cli'}
+
+def startup( work, repeat ):
+  '''Time fresh interpreters importing the package and running the preflight check'''
+  home = os.path.join( work, 'startup-home' )
+  os.makedirs( home )
+  env  = dict( os.environ, HOME = home, PYTHONPATH = ROOT )
+  out  = {}
+  for name, code in STARTUP.items():
+    if name == 'preflight': continue
+    dt, _ = timeit( lambda: check_call( [sys.executable, '-c', code], env = env ), repeat = repeat )
+    out[name] = {'seconds' : dt}
+  created = sorted( os.path.relpath( os.path.join(root, f), home )
+                      for root, dirs, files in os.walk( home ) for f in dirs + files )
+  out['import_side_effects'] = created
+  env['HOME'] = os.environ['HOME'];                                             # Set up by the main benchmark; no disk is mounted
+  dt, _ = timeit( lambda: check_call( [sys.executable, '-c', STARTUP['preflight']], env = env ), repeat = repeat )
+  out['preflight'] = {'seconds' : dt}
+  shutil.rmtree( home )
+  return out
+
+################################################################################
+def flatten( data, prefix = '' ):
+  '''Yield (dotted key, value) of all 'seconds' values in nested results'''
+  for key, value in data.items():
+    name = prefix + '.' + key if prefix else key
+    if isinstance(value, dict):
+      yield from flatten( value, name )
+    elif key == 'seconds':
+      yield name, value
+
+def compare( new, old, threshold ):
+  '''Print timings that changed by more than threshold; returns number slower'''
+  old    = dict( flatten( old['results'] ) )
+  slower = 0
+  for key, value in flatten( new['results'] ):
+    if key not in old or not old[key]: continue
+    change = (value - old[key]) / old[key]
+    if abs(change) > threshold:
+      print( '{:45} {:9.4f}s -> {:9.4f}s  {:+.0f}%{}'.format(
+        key, old[key], value, change * 100, '  SLOWER' if change > 0 else '' ) )
+      slower += change > 0
+  return slower
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark pyBackup end to end and its hot paths")
+  parser.add_argument("--profiles",  type = str, nargs = '+', default = ['small', 'huge', 'deep', 'links'],
+                        choices = sorted(treegen.PROFILES), help = "Trees to back up end to end")
+  parser.add_argument("--backends",  type = str, nargs = '+', default = ['rsync', 'cas'],
+                        choices = ['rsync', 'cas'], help = "Backends to back up with")
+  parser.add_argument("--scale",     type = float, default = 0.1, help = "Factor for the size of the trees")
+  parser.add_argument("--backups",   type = int, default = 2000, help = "Number of backups for listing and pruning")
+  parser.add_argument("--lines",     type = int, default = 200000, help = "Number of files in the rsync output to parse")
+  parser.add_argument("--writes",    type = int, default = 200, help = "Number of config writes")
+  parser.add_argument("--skip",      type = str, nargs = '*', default = [],
+                        choices = ['backup', 'parse', 'dirlist', 'prune', 'config', 'startup'], help = "Benchmarks to skip")
+  parser.add_argument("--workdir",   type = str, help = "Directory for the trees and backups; default is a temporary one")
+  parser.add_argument("--output",    type = str, help = "JSON file to write the results to")
+  parser.add_argument("--compare",   type = str, help = "Earlier JSON result to compare with")
+  parser.add_argument("--threshold", type = float, default = 0.1, help = "Relative change reported by --compare")
+  args = parser.parse_args()
+
+  work = tempfile.mkdtemp( prefix = 'pyBackup-bench-', dir = args.workdir )
+  os.environ['HOME'] = os.path.join( work, 'home' );                            # Application directory, config, and history go here
+  from pyBackup import utils
+  from pyBackup.version import __version__
+  with utils.CONFIG.transaction():
+    utils.CONFIG['exclude']      = [];                                          # The trees are in a temporary directory
+    utils.CONFIG['user_exclude'] = []
+    utils.CONFIG['journal']      = False
+
+  rsync   = version( ['rsync', '--version'] )
+  results = {}
+  try:
+    if 'backup' not in args.skip:
+      for backend in args.backends:
+        if backend == 'rsync' and rsync is None:
+          print( 'rsync not found; skipping rsync backups', file = sys.stderr )
+          continue
+        for profile in args.profiles:
+          print( 'Backing up {} tree with {}'.format(profile, backend), file = sys.stderr )
+          results.setdefault( 'backup', {} ).setdefault( backend, {} )[profile] = endToEnd( work, profile, args.scale, backend )
+    if 'parse'   not in args.skip: results['parse']   = parsing( work, args.lines )
+    if 'dirlist' not in args.skip: results['dirlist'] = dirList( work, args.backups, repeat = 5 )
+    if 'prune'   not in args.skip: results['prune']   = pruning( work, args.backups, args.scale )
+    if 'config'  not in args.skip: results['config']  = configWrites( work, args.writes )
+    if 'startup' not in args.skip: results['startup'] = startup( work, repeat = 5 )
+  finally:
+    shutil.rmtree( work, ignore_errors = True )
+
+  output = {'version'  : __version__,
+            'commit'   : version( ['git', 'rev-parse', '--short', 'HEAD'] ),
+            'time'     : time.strftime( '%Y-%m-%dT%H:%M:%S' ),
+            'host'     : socket.gethostname(),
+            'python'   : platform.python_version(),
+            'platform' : platform.platform(),
+            'rsync'    : rsync,
+            'args'     : vars(args),
+            'results'  : results}
+  text = json.dumps( output, indent = 2 )
+  if args.output:
+    with open( args.output, 'w' ) as fid: fid.write( text + '\n' )
+  else:
+    print( text )
+  if args.compare:
+    with open( args.compare ) as fid:
+      slower = compare( output, json.load( fid ), args.threshold )
+    sys.exit( 1 if slower else 0 )
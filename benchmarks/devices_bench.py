@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+'''
+Benchmark of backup disk discovery.
+
+Times looking up the mount point of a UUID the way it was done before,
+by running 'lsblk --fs --json' and parsing its output on every lookup,
+against the cached device resolution, which reads the mount table and
+/dev/disk/by-uuid once and only re-reads them when the kernel reports
+a mount change. A rebuild of the cache is timed too. The UUID of the
+file system holding --path is looked up; where /dev/disk/by-uuid does
+not exist, the cache falls back to lsblk and the difference shows only
+the cost of parsing the nested device tree.
+'''
+import os, sys, time, json, argparse
+from subprocess import check_output
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.realpath(__file__) ) ) )
+from pyBackup.devices import deviceCache, LSBLK
+
+def legacyMountPoint( UUID ):
+  '''Lookup used before the device cache; kept as the baseline'''
+  data = json.loads( check_output( LSBLK ) )
+  for device in data['blockdevices']:
+    if ('children' in device) and device['children']:
+      for child in device['children']:
+        if ('uuid' in child) and (child['uuid'] == UUID):
+          return child['mountpoint']
+  return None
+
+def measure( func, arg, repeat ):
+  t0 = time.perf_counter()
+  for i in range(repeat): result = func( arg )
+  dt = time.perf_counter() - t0
+  return {'result' : result, 'seconds' : dt, 'lookups_per_s' : repeat / dt,
+          'us_per_lookup' : dt / repeat * 1e6}
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark backup disk discovery")
+  parser.add_argument("--path",    type = str, default = '/', help = "Look up the file system holding this path")
+  parser.add_argument("--repeat",  type = int, default = 200, help = "Number of lookups")
+  args = parser.parse_args()
+
+  cache = deviceCache()
+  uuid  = cache.uuid( args.path )
+  if uuid is None:
+    print( 'No UUID found for {}'.format(args.path) )
+    sys.exit(1)
+
+  def rebuild( uuid ):
+    cache.invalidate()
+    return cache.mountPoint( uuid )
+
+  results = {'uuid'    : uuid,
+             'direct'  : cache.direct,
+             'legacy'  : measure( legacyMountPoint, uuid, args.repeat ),
+             'cached'  : measure( cache.mountPoint, uuid, args.repeat * 100 ),
+             'rebuild' : measure( rebuild, uuid, args.repeat )}
+  results['speedup'] = results['legacy']['us_per_lookup'] / results['cached']['us_per_lookup']
+  print( json.dumps( results, indent = 2 ) )
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+'''
+Benchmark of the rsync output parser.
+
+Replays rsync output through the streaming parser (and, for comparison,
+the line reader that was used before it) and reports lines per second
+and peak memory. By default a synthetic recording in the format of
+'rsync -a --progress --stats' is generated for --files files; use
+--replay to use output recorded from a real run, e.g.,
+
+  rsync -a --progress --stats src dst > rsync_output.txt
+'''
+import os, sys, time, json, tempfile, tracemalloc, argparse
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.realpath(__file__) ) ) )
+from pyBackup.rsyncParser import rsyncParser
+
+LINESEP = str.encode( os.linesep )
+CARRET  = str.encode( '\r' )
+BUFFER  = 1024 * 4
+
+def readLines( pipe, previous = None ):
+  '''Line reader used before rsyncParser; kept as the baseline'''
+  data = pipe.read(BUFFER).replace(CARRET, LINESEP)
+  if previous: data = previous + data
+  try:
+    index = data.index( LINESEP )
+  except:
+    return None, data
+  else:
+    return data[:index+1], data[index+1:]
+
+def record( path, nfiles ):
+  '''Write synthetic rsync --progress output for nfiles files to path'''
+  with open(path, 'wb') as fid:
+    for i in range(nfiles):
+      size = (i * 7919) % 10000000
+      fid.write( 'home/user/dir{:04d}/file{:07d}.dat\n'.format(i // 1000, i).encode() )
+      fid.write( '{:>15,}   0%    0.00kB/s    0:00:00\r'.format(0).encode() )
+      fid.write( '{:>15,} 100%   95.37MB/s    0:00:00 (xfr#{}, to-chk={}/{})\n'.format(
+        size, i+1, nfiles-i-1, nfiles).encode() )
+    fid.write( b'\nNumber of files: ' + '{:,}'.format(nfiles).encode() + b'\n' )
+    fid.write( b'Total file size: 123,456,789 bytes\n' )
+    fid.write( b'Total transferred file size: 123,456,789 bytes\n' )
+
+def runParser( path, paths ):
+  events = 0
+  with open(path, 'rb', buffering = 0) as fid:
+    parser = rsyncParser( fid, paths = paths )
+    for event in parser: events += 1
+  return parser.lines
+
+def runLegacy( path ):
+  lines = 0
+  with open(path, 'rb') as fid:
+    line, remain = readLines( fid )
+    while line or remain:
+      if line and line.endswith(LINESEP):
+        line   = line.decode()
+        lines += 1
+      line, remain = readLines( fid, previous = remain )
+  return lines
+
+def measure( func, *args ):
+  t0    = time.perf_counter()
+  lines = func( *args )
+  dt    = time.perf_counter() - t0
+  tracemalloc.start()
+  func( *args )
+  peak  = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return {'lines' : lines, 'seconds' : dt, 'lines_per_s' : lines / dt, 'peak_bytes' : peak}
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark rsync output parsing")
+  parser.add_argument("--files",  type = int, default = 1000000, help = "Number of files in synthetic recording")
+  parser.add_argument("--replay", type = str, help = "Recorded rsync output to replay instead")
+  parser.add_argument("--legacy", action = 'store_true', help = "Also benchmark the old line reader")
+  args = parser.parse_args()
+
+  path = args.replay
+  if path is None:
+    fd, path = tempfile.mkstemp( suffix = '.rsync' )
+    os.close( fd )
+    record( path, args.files )
+  try:
+    results = {'input_bytes' : os.path.getsize(path),
+               'parser'      : measure( runParser, path, False ),
+               'parser_paths': measure( runParser, path, True )}
+    if args.legacy:
+      results['legacy'] = measure( runLegacy, path )
+  finally:
+    if args.replay is None: os.remove( path )
+  print( json.dumps( results, indent = 2 ) )
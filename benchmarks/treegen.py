@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+'''
+Deterministic generator of synthetic source trees for benchmarks.
+
+The same profile, scale, and seed always give the same tree: the same
+paths, contents, hard links, and modification times. churn() changes a
+tree the same way every time too, so the backup that follows measures
+the same work on every machine and every version. Profiles:
+
+  small : many small files in a wide, shallow tree
+  huge  : a few large files
+  deep  : small files in deeply nested directories
+  links : small files, many of them hard linked to each other
+  mixed : some of each
+
+Run directly to create a tree, e.g.,
+
+  python3 treegen.py /tmp/src --profile mixed --scale 2
+'''
+import os, sys, json, random, argparse
+
+EPOCH   = 1577836800                                                            # Modification times are set from 2020-01-01
+PROFILES = {
+  'small' : {'files' : 20000, 'dirs' : 200, 'depth' : 2,  'size' : (0, 16384),           'links' : 0.0},
+  'huge'  : {'files' : 4,     'dirs' : 1,   'depth' : 1,  'size' : (64*1024**2, 256*1024**2), 'links' : 0.0},
+  'deep'  : {'files' : 5000,  'dirs' : 500, 'depth' : 24, 'size' : (0, 4096),            'links' : 0.0},
+  'links' : {'files' : 10000, 'dirs' : 100, 'depth' : 2,  'size' : (0, 8192),            'links' : 0.3},
+}
+PROFILES['mixed'] = [ dict(PROFILES[p], files = max(PROFILES[p]['files'] // 4, 1), name = p)
+                        for p in ['small', 'huge', 'deep', 'links'] ]
+
+def content( rng, size ):
+  '''Return size bytes of reproducible data; large files repeat a random block'''
+  if size <= 1024**2: return rng.randbytes( size )
+  block = rng.randbytes( 1024**2 )
+  return (block * (size // len(block) + 1))[:size]
+
+def makeDirs( root, rng, ndirs, depth ):
+  '''Return list of ndirs directory paths below root, nested up to depth levels'''
+  dirs = [root]
+  for i in range( ndirs ):
+    parent = rng.choice( dirs )
+    if parent.count( os.sep ) - root.count( os.sep ) >= depth: parent = root
+    path = os.path.join( parent, 'd{:05d}'.format(i) )
+    os.makedirs( path, exist_ok = True )
+    dirs.append( path )
+  return dirs
+
+def generate( root, profile = 'mixed', scale = 1.0, seed = 0 ):
+  '''
+  Purpose:
+    Function to create a synthetic tree
+  Inputs:
+    root    : Directory to create the tree in; must not exist
+  Keywords:
+    profile : Name of profile in PROFILES
+    scale   : Factor applied to the number of files and directories
+    seed    : Seed of the random generator
+  Outputs:
+    Returns dictionary with 'files', 'bytes', and 'links' counts
+  '''
+  rng   = random.Random( seed )
+  specs = PROFILES[profile]
+  if isinstance(specs, dict): specs = [dict( specs, name = profile )]
+  os.makedirs( root )
+  info  = {'files' : 0, 'bytes' : 0, 'links' : 0}
+  for spec in specs:
+    top   = os.path.join( root, spec['name'] )
+    dirs  = makeDirs( top, rng, max( int(spec['dirs'] * scale), 1 ), spec['depth'] )
+    files = []
+    for i in range( max( int(spec['files'] * scale), 1 ) ):
+      path = os.path.join( rng.choice( dirs ), 'f{:07d}.dat'.format(i) )
+      if files and rng.random() < spec['links']:
+        os.link( rng.choice( files ), path )
+        info['links'] += 1
+        continue
+      size = rng.randint( *spec['size'] )
+      with open( path, 'wb' ) as fid:
+        fid.write( content( rng, size ) )
+      mtime = EPOCH + rng.randint( 0, 86400 * 365 )
+      os.utime( path, (mtime, mtime) )
+      files.append( path )
+      info['files'] += 1
+      info['bytes'] += size
+  return info
+
+def churn( root, fraction = 0.01, seed = 1 ):
+  '''
+  Purpose:
+    Function to change a tree the way a day of use might: some files
+    are modified, appended to, deleted, or created, and one directory
+    is renamed
+  Inputs:
+    root     : Directory of the tree
+  Keywords:
+    fraction : Fraction of files to change
+    seed     : Seed of the random generator
+  Outputs:
+    Returns dictionary with the counts of each kind of change
+  '''
+  rng   = random.Random( seed )
+  files = sorted( os.path.join( r, f ) for r, d, fs in os.walk( root ) for f in fs )
+  dirs  = sorted( os.path.join( r, d ) for r, ds, f in os.walk( root ) for d in ds )
+  count = {'modified' : 0, 'appended' : 0, 'deleted' : 0, 'created' : 0, 'renamed' : 0}
+  for path in rng.sample( files, max( int(len(files) * fraction), 1 ) ):
+    kind = rng.choice( ['modified', 'appended', 'deleted', 'created'] )
+    if kind == 'modified':
+      size = os.path.getsize( path )
+      with open( path, 'r+b' ) as fid:
+        fid.seek( rng.randint( 0, max(size - 1, 0) ) )
+        fid.write( rng.randbytes( 64 ) )
+    elif kind == 'appended':
+      with open( path, 'ab' ) as fid:
+        fid.write( rng.randbytes( 4096 ) )
+    elif kind == 'deleted':
+      os.remove( path )
+    else:
+      path = path + '.new'
+      with open( path, 'wb' ) as fid:
+        fid.write( rng.randbytes( rng.randint( 0, 65536 ) ) )
+    if kind != 'deleted':
+      mtime = EPOCH + 86400 * 366 + rng.randint( 0, 86400 )
+      os.utime( path, (mtime, mtime) )
+    count[kind] += 1
+  deepest = [d for d in dirs if os.path.isdir( d )]
+  if deepest:                                                                   # A reorganisation; the files themselves do not change
+    src = rng.choice( deepest )
+    os.rename( src, src + '.moved' )
+    count['renamed'] += 1
+  return count
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Generate a synthetic source tree")
+  parser.add_argument("root",      type = str, help = "Directory to create")
+  parser.add_argument("--profile", type = str, default = 'mixed', choices = sorted(PROFILES), help = "Shape of the tree")
+  parser.add_argument("--scale",   type = float, default = 1.0, help = "Factor for the number of files")
+  parser.add_argument("--seed",    type = int, default = 0, help = "Seed of the random generator")
+  parser.add_argument("--churn",   type = float, help = "Change this fraction of an existing tree instead")
+  args = parser.parse_args()
+  if args.churn:
+    print( json.dumps( churn( args.root, args.churn, seed = args.seed ) ) )
+  else:
+    print( json.dumps( generate( args.root, args.profile, args.scale, args.seed ) ) )
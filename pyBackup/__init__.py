@@ -1,5 +1,5 @@
 import logging
-import os, shutil
+import os
 log = logging.getLogger(__name__);
 log.setLevel( logging.DEBUG );
 
@@ -12,9 +12,14 @@ APPDIR = os.path.join(
 )
 LOGDIR     = os.path.join( APPDIR, 'logs' )
 CONFIGFILE = os.path.join( APPDIR, 'config.json' )
-os.makedirs( LOGDIR, exist_ok=True )
-
-if not os.path.isfile( CONFIGFILE ):
-  shutil.copy( os.path.join(DIR, 'config.json'), CONFIGFILE )
-
 
+def setup():
+  '''
+  Create the application directory, and the config file from the
+  defaults, if they do not exist. Called when they are first needed,
+  so importing the package writes nothing.
+  '''
+  os.makedirs( LOGDIR, exist_ok=True )
+  if not os.path.isfile( CONFIGFILE ):
+    import shutil
+    shutil.copy( os.path.join(DIR, 'config.json'), CONFIGFILE )
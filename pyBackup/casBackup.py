@@ -0,0 +1,464 @@
+import logging;
+
+import os, stat, time, signal, multiprocessing;
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED;
+from datetime import datetime;
+
+from . import LOGDIR, utils
+from .lock import processLock, LOCKNAME
+from .destinations import destinations, getState, setState
+from .retention import retentionPlanner
+from .journal import changeJournal
+from .excludes import excludeFilter, saveTagged
+from .casStore import casStore, storeFiles, CHUNK_SIZE
+from .metrics import runMetrics
+from .governor import settings as governorSettings, lowerPriority
+from .logs import addFileHandler
+
+BATCH_FILES = 64;                                                               # Small files are handed to the hashing processes in batches
+BATCH_BYTES = 16 * 1024**2
+
+def fileNode( info ):
+  '''Return manifest node with the metadata of an lstat result'''
+  mode = info.st_mode
+  if stat.S_ISDIR( mode ):
+    kind = 'd'
+  elif stat.S_ISREG( mode ):
+    kind = 'f'
+  elif stat.S_ISLNK( mode ):
+    kind = 'l'
+  else:
+    kind = 'o'
+  return {'t' : kind, 'm' : mode, 'u' : info.st_uid, 'g' : info.st_gid, 'mt' : info.st_mtime_ns}
+
+class casBackup( object ):
+  def __init__(self, src_dir = '/', loglevel = logging.DEBUG, signals = True,
+                destination = None, plan = None):
+    '''
+    Purpose:
+      Class to back up to a content-addressed store (see casStore)
+      instead of hard-linked snapshot directories. The source tree is
+      walked once; files whose size, modification time, and inode are
+      those recorded in the previous backup keep their chunk lists,
+      and the rest are read, hashed, and stored by a pool of processes.
+      With the change journal, unchanged directory trees are taken
+      from the previous manifest without being walked at all, so a
+      backup costs about as much as what changed. Provides the same
+      interface as rsyncBackup.
+    Inputs:
+      None.
+    Keywords:
+      src_dir     : Directory to back up
+      loglevel    : Logging level
+      signals     : If set, SIGTERM and friends cancel the backup
+      destination : Destination dictionary; default is the first
+                     configured
+      plan        : Ignored; the source is not shared with backups to
+                     other destinations
+    '''
+    super().__init__();
+    self.log         = logging.getLogger(__name__);
+    self.loglevel    = loglevel;
+    self.log_file    = os.path.join(LOGDIR, 'pyBackup_cas.log');                # Handler added when the backup runs
+
+    self.src_dir     = src_dir;
+    self.destination = destination;                                             # Destination dictionary; default is the first configured
+    self.uuid        = None;                                                    # UUID of the destination disk
+    self.mountPoint  = None;
+    self.backup_dir  = None;
+    self.backup_size = 0;                                                       # Bytes expected to be stored
+    self.store       = None;                                                    # casStore instance
+    self.stats       = {};
+    self.metrics     = runMetrics( 'cas', log = self.log );
+    self.rsyncStatus = -1;
+    self.statusTXT   = '';
+    self.__lock      = None;
+    self.__journal   = None;
+    self.__pool      = None;                                                    # ProcessPoolExecutor hashing files
+    self.__futures   = {};                                                      # Dictionary of future: batch of files
+    self.__batch     = [];
+    self.__batchSize = 0;
+    self.__counts    = {};
+    self.__queued    = 0;                                                       # Bytes handed to the hashing processes
+    self.__t0        = None;
+    self.__cancel    = False;
+    if signals:
+      for sig in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT]:
+        signal.signal(sig, self.cancel);
+
+  ##############################################################################
+  @property
+  def statusTXT(self):
+    return self.__statusTXT;
+  @statusTXT.setter
+  def statusTXT(self, value):
+    if value != '': self.log.info( value );
+    self.__statusTXT = value;
+  #########
+  @property
+  def progress(self):
+    '''Percent of the bytes to hash that are done'''
+    expected = max( self.__queued, self.backup_size )
+    if not expected: return 0.0
+    return min( 100.0 * self.__counts.get('hashed', 0) / expected, 100.0 )
+  #########
+  @property
+  def eta(self):
+    '''Estimated time remaining for hashing, in seconds'''
+    done = self.__counts.get('hashed', 0)
+    if not self.__t0 or not done: return None
+    rate = done / (time.monotonic() - self.__t0)
+    return max( max( self.__queued, self.backup_size ) - done, 0 ) / rate
+  #########
+  @property
+  def bytes_done(self):
+    '''Bytes hashed so far'''
+    return self.__counts.get('hashed', 0)
+  #########
+  @property
+  def files_done(self):
+    '''Files scanned so far'''
+    return self.__counts.get('files', 0)
+
+  ##############################################################################
+  def cancel(self, *args):
+    self.log.error( args )
+    self.statusTXT = 'Canceling backup'
+    self.__cancel  = True;
+
+  ##############################################################################
+  def backup(self, mountPoint = None):
+    addFileHandler( self.log, self.log_file, self.loglevel )
+    if self.destination is None:
+      dests = destinations()
+      self.destination = dests[0] if dests else None
+    if not self.destination:
+      self.log.error( 'Backup disk NOT set!' )
+      return 1
+    self.uuid = self.destination['uuid']
+
+    self.mountPoint = mountPoint or utils.get_MountPoint( self.uuid );
+    if not self.mountPoint:
+      self.log.info( 'Backup disk NOT mounted!' )
+      return 1
+    self.backup_dir = os.path.join( self.mountPoint, self.destination['backup_dir'] );
+    os.makedirs( self.backup_dir, exist_ok = True )
+
+    self.__lock = processLock( os.path.join( self.backup_dir, LOCKNAME ), log = self.log )
+    if not self.__lock.acquire():
+      self.log.debug('Backup directory locked, is there a backup running?')
+      return
+
+    self.metrics = runMetrics( 'cas', log = self.log )
+    self.metrics.begin( self.uuid )
+    status       = 1
+    try:
+      status = self.__backup()
+    finally:
+      if self.__pool: self.__pool.shutdown( wait = True, cancel_futures = True )
+      self.__lock.release()
+      self.metrics.save( status, stats = self.stats )
+    return status
+
+  ##############################################################################
+  def __backup(self):
+    '''Private method to run the backup once the backup directory is locked'''
+    self.store = casStore( self.backup_dir, log = self.log )
+    self.store.create()
+    chunk_size = utils.CONFIG.get('cas_chunk_size', CHUNK_SIZE)
+    date_str   = datetime.utcnow().strftime( utils.CONFIG['date_FMT'] )
+    with self.metrics.phase( 'list' ):
+      names     = self.store.snapshots()
+      prev_name = names[-1] if names else None
+      prev      = self.store.load( prev_name ) if prev_name else None
+    if prev and (prev['src_dir'] != self.src_dir or prev['chunk_size'] != chunk_size):
+      self.log.info( 'Previous backup is of another directory or chunk size; hashing everything' )
+      prev = None
+
+    changes = self.__journalChanges( prev_name if prev else None )
+    if changes is not None and len(changes) == 0:
+      self.log.info('No changes recorded since the last backup, skipping backup');
+      self.__journal.commit();
+      return self.__finished()
+
+    last_stats       = getState( self.uuid, 'last_stats', None ) or {}
+    self.backup_size = last_stats.get('total_stored_bytes',
+                         last_stats.get('total_transferred_file_size', 0) )
+    with self.metrics.phase( 'prune' ):
+      freed = self.__removeSnapshots( prev_name )
+    self.metrics.count( 'bytes_freed', freed )
+
+    self.statusTXT = 'Backing up'
+    self.__t0      = time.monotonic()
+    try:
+      with self.metrics.phase( 'transfer' ):
+        root = self.__scan( prev, changes, chunk_size )
+    except OSError as err:
+      self.log.critical( 'Backup failed! {}'.format(err) )
+      root = None
+    if root is None or self.__cancel:
+      if self.__journal: self.__journal.abort();
+      self.rsyncStatus = 1
+      return 1                                                                  # Chunks stored so far are reused by the next run
+    if self.__journal: self.__journal.commit();
+
+    self.stats = {'number_of_files'                     : self.__counts['files'],
+                  'number_of_regular_files_transferred' : self.__counts['transferred'],
+                  'number_of_deleted_files'             : self.__counts['deleted'],
+                  'total_file_size'                     : self.__counts['size'],
+                  'total_transferred_file_size'         : self.__counts['transferred_size'],
+                  'total_stored_bytes'                  : self.__counts['stored']}
+    if changes is not None:                                                     # Only changes were scanned; totals are those of the previous run
+      for key in ['number_of_files', 'total_file_size']:
+        self.stats[key] = last_stats.get( key, self.stats[key] )
+    if prev is not None and root == prev['root']:
+      self.log.info('No files have changed, skipping backup');
+      return self.__finished()
+
+    self.statusTXT = 'Saving backup'
+    with self.metrics.phase( 'save' ):
+      os.sync();                                                                # Chunks must be on disk before the manifest refers to them
+      self.store.save( date_str, {'version' : 1, 'src_dir' : self.src_dir, 'chunk_size' : chunk_size,
+                                  'stats' : self.stats, 'root' : root} )
+    size = getState( self.uuid, 'backup_size', 0 ) or 0
+    with utils.CONFIG.transaction():
+      setState( self.uuid, last_backup = date_str, last_stats = self.stats,
+        backup_size = max( size + self.stats['total_stored_bytes'] - freed, 0 ) )
+      utils.CONFIG['last_backup']  = date_str;
+      utils.CONFIG['days_since_last_backup'] = 0;
+    return self.__finished()
+
+  ##############################################################################
+  def __finished(self):
+    self.statusTXT   = 'Finished'
+    self.rsyncStatus = 0
+    return 0
+
+  ##############################################################################
+  def __journalChanges(self, prev_name):
+    '''
+    Purpose:
+      Private method to take the changes recorded by the watcher since
+      the last backup. They are only used when the newest backup in
+      the store is the last backup to this destination, so nothing
+      recorded before it was made by another backend is missed.
+    Inputs:
+      prev_name : Name of the previous backup, or None
+    Outputs:
+      Returns journalChanges instance, or None if a full scan is
+      needed
+    '''
+    self.__journal = None
+    if not utils.CONFIG.get('journal', False): return None
+    if len( destinations() ) > 1:
+      self.log.info( 'Change journal is only used with one destination; full scan' )
+      return None
+    self.__journal = changeJournal( self.src_dir, log = self.log )
+    changes        = self.__journal.begin()
+    if changes is None: return None
+    if prev_name is None or getState( self.uuid, 'last_backup', None ) != prev_name:
+      self.log.info( 'Newest backup in the store is not the last backup; full scan' )
+      return None
+    if len(changes) > utils.CONFIG.get('journal_max', 100000):
+      self.log.info( '{} changes recorded; full scan'.format(len(changes)) )
+      return None
+    return changes
+
+  ##############################################################################
+  def __scan(self, prev, changes, chunk_size):
+    '''
+    Purpose:
+      Private method to build the manifest of the source tree while
+      the files that changed are hashed and stored by the process
+      pool. Without journal changes every directory is listed; with
+      them, only the directories on the way to a change are, and the
+      rest are taken from the previous manifest as they are.
+    Inputs:
+      prev       : Manifest of the previous backup, or None
+      changes    : journalChanges instance, or None for a full scan
+      chunk_size : Size of the chunks in bytes
+    Outputs:
+      Returns root node of the manifest, or None if cancelled
+    '''
+    top      = os.fsencode( self.src_dir.rstrip(os.sep) or os.sep )
+    excluded = excludeFilter( self.src_dir, log = self.log )
+    excluded.discover()
+    mounts   = set()
+    for dest in destinations():                                                 # Never back up backup disks
+      point = self.mountPoint if dest['uuid'] == self.uuid else utils.get_MountPoint( dest['uuid'] )
+      if point: mounts.add( os.fsencode( point.rstrip(os.sep) ) )
+    dirty, forced = None, set()
+    if changes is not None:
+      dirty  = set()
+      forced = set( changes.files )
+      for path in changes.dirs + changes.trees + changes.files:
+        while path not in dirty:                                                # Every directory on the way to a change
+          dirty.add( path )
+          parent = os.path.dirname( path )
+          if path == top or parent == path: break
+          path = parent
+
+    self.__counts = dict.fromkeys( ['files', 'size', 'transferred', 'transferred_size',
+                                    'stored', 'deleted', 'hashed'], 0 )
+    workers     = utils.CONFIG.get('hash_workers', 0) or os.cpu_count() or 1
+    method      = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    governor    = governorSettings()
+    self.__pool = ProcessPoolExecutor( max_workers = workers,
+                    mp_context  = multiprocessing.get_context( method ),        # Not forked from a process with threads
+                    initializer = lowerPriority if governor['enabled'] else None,
+                    initargs    = (governor['nice'], governor['ionice']) )
+    self.__futures = {}
+    root  = fileNode( os.stat( top ) )
+    root['e'] = {}
+    stack = [(top, root, prev['root'] if prev else None)]
+    while stack and not self.__cancel:
+      path, node, old = stack.pop()
+      olds = old['e'] if old and old['t'] == 'd' else {}
+      try:
+        with os.scandir( path ) as it:
+          entries = list( it )
+      except OSError as err:
+        self.log.warning( 'Failed to list {}: {}'.format(os.fsdecode(path), err) )
+        continue
+      if path != top and excluded.tag( path, [entry.name for entry in entries] ):
+        continue;                                                               # Cache tag or marker file; kept as an empty directory
+      for entry in entries:
+        full = entry.path
+        if full in mounts or excluded( full ): continue
+        try:
+          info = entry.stat( follow_symlinks = False )
+        except OSError:
+          continue;                                                             # Vanished
+        name  = os.fsdecode( entry.name )
+        prior = olds.get( name, None )
+        child = fileNode( info )
+        node['e'][name] = child
+        self.__counts['files'] += 1
+        if child['t'] == 'd':
+          if dirty is not None and full not in dirty and prior and prior['t'] == 'd':
+            child['e'] = prior['e'];                                            # Unchanged tree; shared with the previous manifest
+          else:
+            child['e'] = {}
+            stack.append( (full, child, prior) )
+        elif child['t'] == 'f':
+          child['s'] = info.st_size
+          child['i'] = info.st_ino
+          if info.st_nlink > 1: child['n'] = info.st_nlink
+          self.__counts['size'] += info.st_size
+          if (prior and prior['t'] == 'f' and full not in forced and
+              (prior['s'], prior['mt'], prior['i']) == (child['s'], child['mt'], child['i'])):
+            child['h'] = prior['h']
+          else:
+            self.__queue( full, node['e'], name, prior, chunk_size, workers )
+        elif child['t'] == 'l':
+          try:
+            child['l'] = os.fsdecode( os.readlink( full ) )
+          except OSError:
+            del node['e'][name]
+        else:
+          child['r'] = info.st_rdev
+      self.__counts['deleted'] += len( set(olds) - set(node['e']) )
+    saveTagged( self.src_dir, sorted( excluded.tagged ) );                      # For backups that do not walk the source
+    self.__submit( chunk_size )
+    while self.__futures and not self.__cancel:
+      self.__drain( FIRST_COMPLETED )
+    if self.__cancel: return None
+    return root
+
+  ##############################################################################
+  def __queue(self, path, parent, name, prior, chunk_size, workers):
+    '''Private method to add a file to the next batch to hash; full batches are submitted'''
+    size = parent[name]['s']
+    self.__batch.append( (path, parent, name, prior) )
+    self.__batchSize += size
+    self.__queued    += size
+    if len(self.__batch) >= BATCH_FILES or self.__batchSize >= BATCH_BYTES:
+      self.__submit( chunk_size )
+      while len(self.__futures) >= workers * 4 and not self.__cancel:          # Keep the walk just ahead of the hashing
+        self.__drain( FIRST_COMPLETED )
+
+  ##############################################################################
+  def __submit(self, chunk_size):
+    '''Private method to hand the current batch to the process pool'''
+    if not self.__batch: return
+    future = self.__pool.submit( storeFiles, [item[0] for item in self.__batch],
+                                 self.store.objects, chunk_size )
+    self.__futures[future] = self.__batch
+    self.__batch     = []
+    self.__batchSize = 0
+
+  ##############################################################################
+  def __drain(self, when):
+    '''
+    Purpose:
+      Private method to wait for hashed batches and put their chunk
+      lists in the manifest. Files that could not be read are left out
+      of the backup; errors writing the store are raised.
+    Inputs:
+      when : Passed to concurrent.futures.wait
+    Outputs:
+      None.
+    '''
+    done, _ = wait( list(self.__futures), return_when = when )
+    for future in done:
+      batch = self.__futures.pop( future )
+      for (path, parent, name, prior), (digests, size, stored, err) in zip( batch, future.result() ):
+        node = parent[name]
+        if err is not None:
+          self.log.warning( 'Failed to back up {}: {}'.format(os.fsdecode(path), err) )
+          self.__counts['files'] -= 1
+          self.__counts['size']  -= node['s']
+          del parent[name]
+          continue
+        self.__counts['size']  += size - node['s'];                             # File changed size while it was read
+        node['s'], node['h']    = size, digests
+        self.__counts['hashed'] += size
+        self.__counts['stored'] += stored
+        if prior is None or prior.get('h', None) != digests:
+          self.__counts['transferred']      += 1
+          self.__counts['transferred_size'] += size
+
+  ##############################################################################
+  def __removeSnapshots(self, protect):
+    '''
+    Purpose:
+      Private method to expire old backups until the chunks of the
+      current backup are expected to fit on the disk. The retention
+      planner picks the backups, using the store to compute the bytes
+      only they refer to; their manifests are deleted and the chunks
+      no backup refers to any more are collected.
+    Inputs:
+      protect : Name of backup never to delete; the previous one
+    Outputs:
+      Returns the number of bytes freed
+    '''
+    freed = 0
+    order = None
+    while not self.__cancel:
+      short = self.backup_size - self.__available()
+      if short <= 0: break
+      self.statusTXT = 'Deleting old backups'
+      if order is None:
+        names   = self.store.snapshots()
+        planner = retentionPlanner( tiers = self.destination['retention'], usage = self.store, log = self.log )
+        plan    = planner.plan( names, short, protect = [protect] if protect else [] )
+        order   = plan['delete'] + [n for n in plan['order'] if n not in plan['delete']]
+      if not order:
+        self.log.warning( 'No more old backups to delete' )
+        break
+      batch = [ order.pop(0) ]
+      while order and self.store.reclaimable( batch ) < short:
+        batch.append( order.pop(0) )
+      for name in batch:
+        self.log.info( 'Expiring backup {}'.format(name) )
+        self.store.remove( name )
+      freed += self.store.collect()[1]
+    return freed
+
+  ##############################################################################
+  def __available(self):
+    '''Return space available for backups right now, keeping a fraction of the disk free'''
+    info    = os.statvfs( self.backup_dir )
+    free    = info.f_bavail * info.f_frsize
+    total   = info.f_blocks * info.f_frsize
+    return free - self.destination['disk_reserve'] * total
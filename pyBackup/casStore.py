@@ -0,0 +1,479 @@
+import logging;
+
+import os, stat, time, json, gzip, hashlib, tempfile;
+from threading import Lock, BoundedSemaphore;
+from collections import Counter;
+from concurrent.futures import ThreadPoolExecutor;
+
+CASDIR     = '.cas';                                                            # Store inside the top-level backup directory; hidden from snapshot listings
+OBJECTS    = 'objects'
+SNAPSHOTS  = 'snapshots'
+MANIFEST   = '.json.gz'
+CHUNK_SIZE = 1024**2
+DIGEST     = 32;                                                                # Bytes of the blake2b digest
+
+def digest( data ):
+  '''Return hex digest of a chunk'''
+  return hashlib.blake2b( data, digest_size = DIGEST ).hexdigest()
+
+def objectPath( objects, key ):
+  '''Return path of a chunk in the objects directory; fanned out by the first byte'''
+  return os.path.join( objects, key[:2], key[2:] )
+
+def chunkSizes( node, chunk_size ):
+  '''Yield (digest, size) of each chunk of a file node'''
+  size = node['s']
+  for i, key in enumerate( node['h'] ):
+    yield key, min( chunk_size, size - i * chunk_size )
+
+def storeFile( path, objects, chunk_size ):
+  '''
+  Purpose:
+    Function to read a file once, hashing it in fixed-size chunks and
+    storing the chunks not yet in the store. Chunks are written to a
+    temporary file and renamed into place, so a chunk is either
+    complete or absent, and two processes storing the same chunk do
+    not interfere.
+  Inputs:
+    path       : Path of file to store
+    objects    : Objects directory of the store
+    chunk_size : Size of the chunks in bytes
+  Outputs:
+    Returns tuple of (list of digests, bytes read, bytes stored)
+  '''
+  digests = []
+  size    = 0
+  stored  = 0
+  with open( path, 'rb' ) as fid:
+    for data in iter( lambda: fid.read( chunk_size ), b'' ):
+      key   = digest( data )
+      size += len(data)
+      dst   = objectPath( objects, key )
+      if not os.path.exists( dst ):
+        fd, tmp = tempfile.mkstemp( dir = os.path.dirname( dst ), prefix = '.tmp' )
+        with os.fdopen( fd, 'wb' ) as out:
+          out.write( data )
+        os.replace( tmp, dst )
+        stored += len(data)
+      digests.append( key )
+  return digests, size, stored
+
+def storeFiles( paths, objects, chunk_size ):
+  '''
+  Purpose:
+    Function run in the worker processes to store a batch of files;
+    small files are batched so the cost of handing out work is spread
+    over many of them
+  Inputs:
+    paths      : List of paths of files to store
+    objects    : Objects directory of the store
+    chunk_size : Size of the chunks in bytes
+  Outputs:
+    Returns list with, for each path, the tuple returned by storeFile
+    followed by None, or (None, 0, 0, error message) if the file could
+    not be read
+  '''
+  out = []
+  for path in paths:
+    try:
+      out.append( storeFile( path, objects, chunk_size ) + (None,) )
+    except OSError as err:
+      out.append( (None, 0, 0, str(err)) )
+  return out
+
+def walk( node, path = '' ):
+  '''Yield (relative path, node) for a manifest node and everything below it'''
+  stack = [(path, node)]
+  while stack:
+    path, node = stack.pop()
+    yield path, node
+    if node['t'] == 'd':
+      for name, child in node['e'].items():
+        stack.append( (os.path.join( path, name ) if path else name, child) )
+
+class casStore( object ):
+  def __init__(self, backup_dir, log = None):
+    '''
+    Purpose:
+      Class for a content-addressed store of backups. File contents
+      are split into chunks named by their blake2b digest, so each
+      distinct chunk is stored once however many files, paths, or
+      backups hold it; a file that changes in place only adds the
+      chunks that changed. Each backup is a gzipped JSON manifest of
+      the directory tree with the metadata and chunk list of every
+      file. Chunks no manifest refers to are deleted by collect().
+    Inputs:
+      backup_dir : Top-level backup directory; the store is kept in
+                    its '.cas' directory
+    Keywords:
+      log        : Logger to use
+    '''
+    super().__init__();
+    self.log       = log or logging.getLogger(__name__);
+    self.root      = os.path.join( backup_dir, CASDIR );
+    self.objects   = os.path.join( self.root, OBJECTS );
+    self.snapdir   = os.path.join( self.root, SNAPSHOTS );
+    self.__refs    = None;                                                      # Counter of digest: number of manifests referring to it
+    self.__chunks  = {};                                                        # Dictionary of name: {digest: size} of loaded manifests
+
+  ##############################################################################
+  def exists(self):
+    '''Return True if the store has been created'''
+    return os.path.isdir( self.snapdir )
+
+  ##############################################################################
+  def create(self):
+    '''Create the store directories; the objects are fanned out over 256 directories'''
+    os.makedirs( self.snapdir, exist_ok = True )
+    for i in range( 256 ):
+      os.makedirs( os.path.join( self.objects, '{:02x}'.format(i) ), exist_ok = True )
+
+  ##############################################################################
+  def snapshots(self):
+    '''Return sorted list of names of backups in the store'''
+    if not self.exists(): return []
+    return sorted( name[:-len(MANIFEST)] for name in os.listdir( self.snapdir )
+                     if name.endswith( MANIFEST ) and not name.startswith('.') )
+
+  ##############################################################################
+  def load(self, name):
+    '''Return the manifest of a backup'''
+    with gzip.open( os.path.join( self.snapdir, name + MANIFEST ), 'rt', encoding = 'utf8' ) as fid:
+      return json.load( fid )
+
+  ##############################################################################
+  def save(self, name, manifest):
+    '''
+    Purpose:
+      Method to write the manifest of a backup. It is written to a
+      temporary file that is synced and renamed into place, so a
+      backup either exists completely or not at all; the chunks it
+      refers to must be on disk already.
+    Inputs:
+      name     : Name of the backup
+      manifest : Manifest dictionary
+    Outputs:
+      None.
+    '''
+    fd, tmp = tempfile.mkstemp( dir = self.snapdir, prefix = '.tmp' )
+    try:
+      with os.fdopen( fd, 'wb' ) as raw:
+        with gzip.GzipFile( fileobj = raw, mode = 'wb', compresslevel = 6 ) as fid:
+          fid.write( json.dumps( manifest, separators = (',', ':') ).encode( 'utf8' ) )
+        raw.flush()
+        os.fsync( raw.fileno() )
+      os.replace( tmp, os.path.join( self.snapdir, name + MANIFEST ) )
+    except:
+      if os.path.exists( tmp ): os.remove( tmp )
+      raise
+    dfd = os.open( self.snapdir, os.O_RDONLY )
+    try:
+      os.fsync( dfd )
+    finally:
+      os.close( dfd )
+    self.__refs = None
+
+  ##############################################################################
+  def remove(self, name):
+    '''Delete the manifest of a backup; its chunks are deleted by collect()'''
+    os.remove( os.path.join( self.snapdir, name + MANIFEST ) )
+    chunks = self.__chunks.pop( name, None )
+    if self.__refs is not None and chunks is not None:
+      self.__refs.subtract( chunks.keys() )
+
+  ##############################################################################
+  def chunks(self, name):
+    '''Return dictionary of digest: size of every chunk a backup refers to'''
+    if name not in self.__chunks:
+      manifest = self.load( name )
+      size     = manifest['chunk_size']
+      chunks   = {}
+      for path, node in walk( manifest['root'] ):
+        if node['t'] == 'f': chunks.update( chunkSizes( node, size ) )
+      self.__chunks[name] = chunks
+    return self.__chunks[name]
+
+  ##############################################################################
+  def accounted(self, name):
+    '''Return True if the space a backup frees is known; always, for the store'''
+    return os.path.isfile( os.path.join( self.snapdir, name + MANIFEST ) )
+
+  ##############################################################################
+  def reclaimable(self, names):
+    '''
+    Purpose:
+      Method to compute the bytes that deleting a set of backups
+      together would free; i.e., the size of the chunks no other
+      backup refers to. Lets the store stand in for diskUsage in the
+      retention planner.
+    Inputs:
+      names : List of backup names
+    Outputs:
+      Returns number of bytes
+    '''
+    if self.__refs is None:
+      self.__refs = Counter()
+      for name in self.snapshots():
+        self.__refs.update( self.chunks( name ).keys() )
+    inside = Counter()
+    sizes  = {}
+    for name in names:
+      chunks = self.chunks( name )
+      inside.update( chunks.keys() )
+      sizes.update( chunks )
+    return sum( sizes[key] for key, n in inside.items() if self.__refs[key] == n )
+
+  ##############################################################################
+  def shares(self, names):
+    '''
+    Purpose:
+      Method to get the chunks only the given backups refer to, with
+      the backups that refer to each; see diskUsage.shares(), which
+      the store stands in for in the retention planner
+    Inputs:
+      names : List of backup names
+    Outputs:
+      Returns tuple of (links, chunks); links is a dictionary of name:
+      list of (digest, 1) and chunks a dictionary of digest: (size,
+      number of backups referring to it)
+    '''
+    self.reclaimable( [] );                                                     # Count references of all backups once
+    inside = Counter()
+    for name in names:
+      inside.update( self.chunks( name ).keys() )
+    links  = {}
+    chunks = {}
+    for name in names:
+      links[name] = []
+      for key, size in self.chunks( name ).items():
+        if self.__refs[key] == inside[key]:
+          links[name].append( (key, 1) )
+          chunks[key] = (size, inside[key])
+    return links, chunks
+
+  ##############################################################################
+  def collect(self):
+    '''
+    Purpose:
+      Method to delete the chunks that no backup refers to, along with
+      temporary files left by interrupted writes. Every manifest is
+      read to mark the chunks in use, then the objects are swept.
+    Inputs:
+      None.
+    Outputs:
+      Returns tuple of (number of chunks deleted, bytes freed)
+    '''
+    used = set()
+    for name in self.snapshots():
+      used.update( self.chunks( name ).keys() )
+    files = freed = 0
+    for sub in os.scandir( self.objects ):
+      if not sub.is_dir(): continue
+      for entry in os.scandir( sub.path ):
+        if entry.name.startswith('.tmp') or sub.name + entry.name not in used:
+          try:
+            size = entry.stat().st_size
+            os.remove( entry.path )
+          except OSError:
+            continue
+          files += 1
+          freed += size
+    for entry in os.scandir( self.snapdir ):                                    # Manifests of interrupted saves
+      if entry.name.startswith('.tmp'): os.remove( entry.path )
+    self.log.info( 'Collected {} unused chunks'.format(files) )
+    return files, freed
+
+  ##############################################################################
+  def read(self, node):
+    '''
+    Purpose:
+      Method to stream the contents of a file node, one chunk at a
+      time; each chunk is checked against its digest
+    Inputs:
+      node : File node of a manifest
+    Outputs:
+      Generator of bytes; raises IOError for a missing or corrupt chunk
+    '''
+    for key in node['h']:
+      with open( objectPath( self.objects, key ), 'rb' ) as fid:
+        data = fid.read()
+      if digest( data ) != key:
+        raise IOError( 'Corrupt chunk {}'.format(key) )
+      yield data
+
+  ##############################################################################
+  def find(self, manifest, path):
+    '''
+    Purpose:
+      Method to find a path of the source disk in a manifest. The
+      path must be the backed up directory or inside it.
+    Inputs:
+      manifest : Manifest dictionary
+      path     : Absolute or relative path on the source disk
+    Outputs:
+      Returns tuple of (relative path, node), or (None, None)
+    '''
+    path  = os.path.abspath( path )
+    top   = manifest['src_dir'].rstrip(os.sep) or os.sep
+    if path != top and not path.startswith( top.rstrip(os.sep) + os.sep ): return None, None
+    rel   = os.path.relpath( path, top )
+    node  = manifest['root']
+    for name in ([] if rel == '.' else rel.split( os.sep )):
+      node = node['e'].get( name, None ) if node['t'] == 'd' else None
+      if node is None: return None, None
+    return rel, node
+
+  ##############################################################################
+  def versions(self, path):
+    '''
+    Purpose:
+      Method to list every version of a path across all backups;
+      backups holding the same contents and modification time are
+      collapsed into one entry
+    Inputs:
+      path : Path on the source disk
+    Outputs:
+      Returns list of dictionaries with 'snapshots', 'size', 'mtime',
+      and 'path' keys, oldest first, as restore.listVersions
+    '''
+    versions = []
+    for name in self.snapshots():
+      rel, node = self.find( self.load( name ), path )
+      if node is None: continue
+      key = (node['t'], node.get('mt', None), node.get('h', None) and tuple(node['h']), node.get('l', None))
+      if versions and versions[-1]['key'] == key:
+        versions[-1]['snapshots'].append( name )
+        continue
+      mtime = time.strftime( '%Y/%m/%d-%H:%M:%S', time.localtime( node.get('mt', 0) / 1e9 ) )
+      versions.append( {'snapshots' : [name], 'size' : node.get('s', 0), 'mtime' : mtime,
+                        'path' : rel, 'key' : key} )
+    for version in versions: version.pop('key')
+    return versions
+
+class casRestore( object ):
+  def __init__(self, store, workers = 4, callback = None, log = None):
+    '''
+    Purpose:
+      Class to restore a file or directory tree from a backup in the
+      content-addressed store. The manifest is walked in one thread
+      while files are streamed from their chunks by a pool of
+      threads, checking every chunk; hard links are recreated once all
+      files are written and directory metadata is set last, as for
+      restore.snapshotRestore.
+    Inputs:
+      store    : casStore instance
+    Keywords:
+      workers  : Number of files to write at once
+      callback : Function called with (files, bytes, seconds) about
+                  once a second
+      log      : Logger to use
+    '''
+    super().__init__();
+    self.log      = log or logging.getLogger(__name__);
+    self.store    = store;
+    self.workers  = max( int(workers or 1), 1 );
+    self.callback = callback;
+    self.files    = 0;
+    self.bytes    = 0;
+    self.errors   = [];
+    self.is_root  = hasattr(os, 'geteuid') and os.geteuid() == 0;
+    self.__lock   = Lock();
+    self.__t0     = None;
+    self.__report = 0.0;
+
+  ##############################################################################
+  def restore(self, node, dst):
+    '''
+    Purpose:
+      Method to restore a manifest node
+    Inputs:
+      node : Node of a manifest, as returned by casStore.find
+      dst  : Path to restore to; must not exist
+    Outputs:
+      Returns True if everything was restored
+    '''
+    self.__t0 = time.monotonic()
+    links     = {};                                                             # Destination of first copy of each multiply linked inode
+    deferred  = [];                                                             # Hard links to create once copies are done
+    dirs      = [];                                                             # Directories to set metadata on at the end
+    slots     = BoundedSemaphore( self.workers * 4 );                           # Limit number of queued files
+    with ThreadPoolExecutor( max_workers = self.workers ) as pool:
+      for rel, child in walk( node ):
+        d = os.path.join( dst, rel ) if rel else dst
+        if child['t'] == 'd':
+          try:
+            os.makedirs( d, exist_ok = True )
+          except OSError as err:
+            self.errors.append( (d, err) )
+          dirs.append( (d, child) )
+          continue
+        if child.get('n', 1) > 1:
+          if child['i'] in links:
+            deferred.append( (links[child['i']], d) )
+            continue
+          links[child['i']] = d
+        slots.acquire()
+        future = pool.submit( self.__write, child, d )
+        future.add_done_callback( lambda f: slots.release() )
+
+    for first, d in deferred:                                                   # All files are written; create the hard links
+      try:
+        os.link( first, d )
+        self.__count( 1, 0 )
+      except OSError as err:
+        self.errors.append( (d, err) )
+    for d, child in sorted( dirs, key = lambda x: -len(x[0]) ):                 # Deepest directories first
+      self.__setMeta( d, child )
+    self.__progress( force = True )
+    for path, err in self.errors:
+      self.log.error( 'Failed to restore {}: {}'.format(path, err) )
+    return len(self.errors) == 0
+
+  ##############################################################################
+  def __write(self, node, dst):
+    '''Write one non-directory node with its metadata'''
+    try:
+      if node['t'] == 'l':
+        os.symlink( node['l'], dst )
+      elif node['t'] == 'f':
+        with open( dst, 'wb' ) as fid:
+          for data in self.store.read( node ):
+            fid.write( data )
+      elif self.is_root:
+        os.mknod( dst, node['m'], node.get('r', 0) )
+      else:
+        self.log.warning( 'Skipping special file: {}'.format(dst) )
+        return
+      self.__setMeta( dst, node )
+      self.__count( 1, node.get('s', 0) if node['t'] == 'f' else 0 )
+    except OSError as err:
+      with self.__lock:
+        self.errors.append( (dst, err) )
+
+  ##############################################################################
+  def __setMeta(self, dst, node):
+    '''Set ownership, permissions, and times; ownership only as root'''
+    try:
+      if self.is_root:
+        os.chown( dst, node['u'], node['g'], follow_symlinks = False )
+      if node['t'] != 'l':
+        os.chmod( dst, stat.S_IMODE( node['m'] ) )
+      if node['t'] != 'l' or os.utime in os.supports_follow_symlinks:
+        os.utime( dst, ns = (node['mt'], node['mt']), follow_symlinks = False )
+    except (OSError, NotImplementedError) as err:
+      with self.__lock:
+        self.errors.append( (dst, err) )
+
+  ##############################################################################
+  def __count(self, files, nbytes):
+    with self.__lock:
+      self.files += files
+      self.bytes += nbytes
+    self.__progress()
+
+  ##############################################################################
+  def __progress(self, force = False):
+    now = time.monotonic()
+    if self.callback and (force or now - self.__report > 1.0):
+      self.__report = now
+      self.callback( self.files, self.bytes, now - self.__t0 )
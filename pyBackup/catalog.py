@@ -0,0 +1,446 @@
+import logging;
+
+import os, sqlite3;
+from threading import RLock;
+
+from .rsyncParser import Deleted
+
+CATALOG = 'catalog.db'                                                          # Name of catalog file in the backup directory
+BATCH   = 10000                                                                 # Number of entries per transaction
+
+SCHEMA  = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+  id       INTEGER PRIMARY KEY,
+  name     TEXT UNIQUE NOT NULL,
+  complete INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS paths (
+  id       INTEGER PRIMARY KEY,
+  path     BLOB UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+  snapshot INTEGER NOT NULL,
+  path     INTEGER NOT NULL,
+  kind     TEXT,
+  size     INTEGER,
+  mtime    TEXT,
+  inode    INTEGER,
+  change   TEXT,
+  PRIMARY KEY (snapshot, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_path  ON entries (path, snapshot);
+CREATE INDEX IF NOT EXISTS entries_inode ON entries (inode);
+CREATE TABLE IF NOT EXISTS checksums (
+  inode    INTEGER PRIMARY KEY,
+  size     INTEGER,
+  mtime    INTEGER,
+  digest   BLOB,
+  checked  REAL,
+  bad      INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS checksums_checked ON checksums (checked);
+'''
+
+CHANGED = ('new', 'modified', 'attrs', 'created')                               # Change types that mean data or metadata was written
+
+def changeType( flags ):
+  '''
+  Purpose:
+    Function to convert the flags of rsync itemized output to a
+    change type
+  Inputs:
+    flags : Itemized change flags, e.g., b'>f+++++++++'
+  Outputs:
+    Returns one of 'new', 'modified', 'attrs', 'created', 'linked',
+    or 'unchanged'
+  '''
+  first = flags[0:1]
+  if first == b'.':
+    return 'unchanged' if flags[2:].strip(b' .') == b'' else 'attrs'
+  if first == b'h': return 'linked'
+  if first == b'c': return 'created'
+  if flags[2:3] == b'+': return 'new'
+  return 'modified'
+
+class snapshotCatalog( object ):
+  def __init__(self, path, log = None):
+    '''
+    Purpose:
+      Class for an indexed catalog of what every backup contains.
+      While a backup runs, the itemized output of rsync is added in
+      batched transactions; when it finishes, the inode of each
+      entry is filled in, mostly from the entry with the same path
+      in the backup used as link destination, so only new and
+      changed files are stat'ed.
+    Inputs:
+      path : Path to the SQLite catalog file
+    Keywords:
+      log  : Logger to use
+    '''
+    super().__init__();
+    self.log     = log or logging.getLogger(__name__);
+    self.path    = path;
+    self.db      = sqlite3.connect( path, check_same_thread = False )
+    self.db.execute( 'PRAGMA journal_mode = WAL' )
+    self.db.execute( 'PRAGMA synchronous = NORMAL' )
+    self.db.executescript( SCHEMA )
+    self.__lock  = RLock();                                                     # Also held for reads; pool threads write through the same connection
+    self.__rows  = [];
+    self.__snap  = None;                                                        # Id of snapshot being written
+    self.__link  = None;                                                        # Id of link destination snapshot
+
+  ##############################################################################
+  def snapshotId(self, name):
+    '''Return id of snapshot with given name, or None'''
+    with self.__lock:
+      row = self.db.execute( 'SELECT id FROM snapshots WHERE name = ?', (name,) ).fetchone()
+    return row[0] if row else None
+
+  ##############################################################################
+  def snapshots(self):
+    '''Return sorted list of names of complete snapshots'''
+    with self.__lock:
+      rows = self.db.execute( 'SELECT name FROM snapshots WHERE complete = 1 ORDER BY name' ).fetchall()
+    return [row[0] for row in rows]
+
+  ##############################################################################
+  def begin(self, name, link = None, carry = False, resume = None):
+    '''
+    Purpose:
+      Method to start a new snapshot. Any snapshot that was never
+      completed, e.g., after a crash, is dropped first.
+    Inputs:
+      name  : Name of the snapshot; i.e., the backup directory name
+    Keywords:
+      link  : Name of the snapshot used as link destination
+      carry : If True, all entries of the link snapshot are copied
+               as unchanged first; used when the snapshot is a clone
+               of the link snapshot and rsync only itemizes changes
+      resume : Name of an incomplete snapshot that is being resumed;
+               its entries are kept and it is renamed to name
+    Outputs:
+      None.
+    '''
+    with self.__lock, self.db:
+      keep = None
+      for (snap, old) in self.db.execute( 'SELECT id, name FROM snapshots WHERE complete = 0' ).fetchall():
+        if resume is not None and old == resume:
+          keep = snap
+        else:
+          self.__delete( snap )
+      old = self.snapshotId( name )
+      if old is not None and old != keep: self.__delete( old )
+      if keep is not None:                                                      # Continue filling the interrupted snapshot
+        self.db.execute( 'UPDATE snapshots SET name = ? WHERE id = ?', (name, keep) )
+        self.__snap = keep
+      else:
+        cur = self.db.execute( 'INSERT INTO snapshots (name) VALUES (?)', (name,) )
+        self.__snap = cur.lastrowid
+      self.__rows = []
+      self.__link = self.snapshotId( link ) if link else None
+      if carry and keep is None and self.__link is not None:
+        self.db.execute(
+          'INSERT INTO entries (snapshot, path, kind, size, mtime, inode, change) '
+          "SELECT ?, path, kind, size, mtime, inode, 'unchanged' FROM entries WHERE snapshot = ?",
+          (self.__snap, self.__link) )
+
+  ##############################################################################
+  def add(self, item):
+    '''
+    Purpose:
+      Method to add an entry to the current snapshot; thread safe.
+      Entries are written in batches.
+    Inputs:
+      item : Item or Deleted event from rsyncParser
+    Outputs:
+      None.
+    '''
+    with self.__lock:
+      self.__rows.append( item )
+      full = len(self.__rows) >= BATCH
+    if full: self.flush()
+
+  ##############################################################################
+  def flush(self):
+    '''Write buffered entries in one transaction'''
+    with self.__lock:
+      rows, self.__rows = self.__rows, []
+      if not rows or self.__snap is None: return
+      snap = self.__snap
+      gone = [item for item in rows if isinstance(item, Deleted)]
+      if gone: rows = [item for item in rows if not isinstance(item, Deleted)]
+      with self.db:
+        self.db.executemany(
+          'DELETE FROM entries WHERE snapshot = ? AND path = (SELECT id FROM paths WHERE path = ?)',
+          ( (snap, item.path.rstrip(b'/') or b'.') for item in gone ) )
+        self.db.executemany( 'INSERT OR IGNORE INTO paths (path) VALUES (?)',
+          ( (item.path.rstrip(b'/') or b'.',) for item in rows ) )
+        self.db.executemany(
+          'INSERT OR REPLACE INTO entries (snapshot, path, kind, size, mtime, change) '
+          'SELECT ?, id, ?, ?, ?, ? FROM paths WHERE path = ?',
+          ( (snap, item.flags[1:2].decode(), item.size, item.mtime.decode(),
+             changeType( item.flags ), item.path.rstrip(b'/') or b'.') for item in rows ) )
+
+  ##############################################################################
+  def finish(self, snap_dir):
+    '''
+    Purpose:
+      Method to complete the current snapshot. Inodes of unchanged
+      entries are copied from the link destination when its entry has
+      the same size and time; all others, e.g., files rsync linked
+      from another link destination, are stat'ed in snap_dir.
+    Inputs:
+      snap_dir : Directory the snapshot was written to
+    Outputs:
+      None.
+    '''
+    self.flush()
+    with self.__lock:
+      snap = self.__snap
+      with self.db:
+        if self.__link is not None:
+          self.db.execute(
+            'UPDATE entries SET inode = (SELECT l.inode FROM entries AS l '
+            'WHERE l.snapshot = ? AND l.path = entries.path '
+            'AND l.size IS entries.size AND l.mtime IS entries.mtime) '
+            "WHERE snapshot = ? AND change IN ('unchanged', 'linked')", (self.__link, snap) )
+        rows = self.db.execute(
+          'SELECT e.path, p.path FROM entries AS e JOIN paths AS p ON p.id = e.path '
+          'WHERE e.snapshot = ? AND e.inode IS NULL', (snap,) ).fetchall()
+        inodes = []
+        root   = os.fsencode( snap_dir )
+        for pid, path in rows:
+          try:
+            inodes.append( (os.lstat( os.path.join(root, path) ).st_ino, snap, pid) )
+          except OSError:
+            pass
+        self.db.executemany( 'UPDATE entries SET inode = ? WHERE snapshot = ? AND path = ?', inodes )
+        self.db.execute( 'UPDATE snapshots SET complete = 1 WHERE id = ?', (snap,) )
+      self.__snap = None
+    self.log.debug( 'Catalog updated; {} inodes stat\'ed'.format(len(rows)) )
+
+  ##############################################################################
+  def drop(self, name = None, prune = True):
+    '''
+    Purpose:
+      Method to remove a snapshot from the catalog
+    Keywords:
+      name  : Name of snapshot to remove; default is the current one
+      prune : If True, paths no snapshot holds any more are removed
+               too; see prunePaths(). Pass False when dropping several
+               snapshots, and prune once afterwards.
+    Outputs:
+      None.
+    '''
+    with self.__lock:
+      if name is None:
+        snap, self.__snap, self.__rows = self.__snap, None, []
+      else:
+        snap = self.snapshotId( name )
+      if snap is None: return
+      with self.db:
+        self.__delete( snap )
+    if prune: self.prunePaths()
+
+  ##############################################################################
+  def prunePaths(self, batch = BATCH):
+    '''
+    Purpose:
+      Method to remove paths no snapshot holds any more, e.g., of
+      temporary files and build outputs of deleted backups, so the
+      catalog does not grow with churn. Paths are removed in batches,
+      in order of id, each in a transaction of its own, so backup
+      threads adding entries are not held up for long.
+    Keywords:
+      batch : Number of paths per transaction
+    Outputs:
+      Returns number of paths removed
+    '''
+    last  = 0
+    total = 0
+    while True:
+      with self.__lock, self.db:
+        ids = [ row[0] for row in self.db.execute(
+          'SELECT id FROM paths AS p WHERE id > ? AND NOT EXISTS '
+          '(SELECT 1 FROM entries AS e WHERE e.path = p.id) ORDER BY id LIMIT ?', (last, batch) ) ]
+        self.db.executemany( 'DELETE FROM paths WHERE id = ?', ( (i,) for i in ids ) )
+      total += len(ids)
+      if len(ids) < batch: break
+      last = ids[-1]
+    if total: self.log.debug( 'Removed {} paths from the catalog'.format(total) )
+    return total
+
+  ##############################################################################
+  def versions(self, path):
+    '''
+    Purpose:
+      Method to find all snapshots containing a path
+    Inputs:
+      path : Path relative to the snapshot directories
+    Outputs:
+      Returns list of (snapshot, size, mtime, inode, change) tuples
+      sorted by snapshot name
+    '''
+    path = os.fsencode( path ).strip(b'/') or b'.'
+    with self.__lock:
+      return self.db.execute(
+        'SELECT s.name, e.size, e.mtime, e.inode, e.change FROM paths AS p '
+        'JOIN entries AS e ON e.path = p.id JOIN snapshots AS s ON s.id = e.snapshot '
+        'WHERE p.path = ? AND s.complete = 1 ORDER BY s.name', (path,) ).fetchall()
+
+  ##############################################################################
+  def changes(self, name):
+    '''
+    Purpose:
+      Method to list entries that were written in a snapshot
+    Inputs:
+      name : Name of the snapshot
+    Outputs:
+      Returns list of (path, size, mtime, change) tuples
+    '''
+    with self.__lock:
+      rows = self.db.execute(
+        'SELECT p.path, e.size, e.mtime, e.change FROM snapshots AS s '
+        'JOIN entries AS e ON e.snapshot = s.id JOIN paths AS p ON p.id = e.path '
+        'WHERE s.name = ? AND e.change IN ({})'.format( ','.join('?'*len(CHANGED)) ),
+        (name,) + CHANGED ).fetchall()
+    return [ (os.fsdecode(path), size, mtime, change) for path, size, mtime, change in rows ]
+
+  ##############################################################################
+  def named(self, names):
+    '''
+    Purpose:
+      Method to find paths with given file names in any snapshot;
+      e.g., cache tags
+    Inputs:
+      names : List of file names
+    Outputs:
+      Returns list of paths, as bytes
+    '''
+    out = []
+    for name in names:
+      name = os.fsencode( name )
+      with self.__lock:
+        rows = self.db.execute( 'SELECT path FROM paths WHERE path = ? OR CAST(path AS TEXT) GLOB ?',
+          (name, '*/' + os.fsdecode( name ).replace('[', '[[]').replace('*', '[*]').replace('?', '[?]')) ).fetchall()
+      out.extend( row[0] for row in rows )
+    return out
+
+  ##############################################################################
+  def unhashed(self, name = None, changed = True):
+    '''
+    Purpose:
+      Method to list files whose inode has no checksum yet; one path
+      for each inode
+    Keywords:
+      name    : Name of the snapshot; default is all complete snapshots
+      changed : If True, only files written in the snapshot; files
+                 linked from an earlier snapshot share its inode
+    Outputs:
+      Returns list of (snapshot, path, inode, size) tuples
+    '''
+    where = ["e.kind = 'f'", 'e.inode IS NOT NULL', 'c.inode IS NULL']
+    args  = []
+    if name is None:
+      where.append( 's.complete = 1' )
+    else:
+      where.append( 's.name = ?' )
+      args.append( name )
+    if changed:
+      where.append( 'e.change IN ({})'.format( ','.join('?'*len(CHANGED)) ) )
+      args.extend( CHANGED )
+    with self.__lock:
+      return self.db.execute(
+        'SELECT s.name, p.path, e.inode, e.size FROM snapshots AS s '
+        'JOIN entries AS e ON e.snapshot = s.id JOIN paths AS p ON p.id = e.path '
+        'LEFT JOIN checksums AS c ON c.inode = e.inode '
+        'WHERE {} GROUP BY e.inode'.format( ' AND '.join(where) ), args ).fetchall()
+
+  ##############################################################################
+  def setChecksums(self, rows):
+    '''
+    Purpose:
+      Method to record checksums of inodes
+    Inputs:
+      rows : Iterable of (inode, size, mtime, digest, checked, bad)
+              tuples; mtime in nanoseconds, checked a time stamp
+    Outputs:
+      None.
+    '''
+    with self.__lock, self.db:
+      self.db.executemany(
+        'INSERT OR REPLACE INTO checksums (inode, size, mtime, digest, checked, bad) '
+        'VALUES (?, ?, ?, ?, ?, ?)', rows )
+
+  ##############################################################################
+  def sample(self, budget = None, name = None):
+    '''
+    Purpose:
+      Method to pick checksummed files to verify, those verified
+      longest ago first, so repeated runs cover everything in turn
+    Keywords:
+      budget : Bytes to pick at most; default is all
+      name   : Only pick files in this snapshot
+    Outputs:
+      Returns list of (inode, size, mtime, digest, snapshot, path)
+      tuples, where snapshot and path are a complete snapshot
+      holding the inode and its path in it
+    '''
+    with self.__lock:
+      where = '' if name is None else (
+        'WHERE c.inode IN (SELECT e.inode FROM entries AS e JOIN snapshots AS s '
+        'ON s.id = e.snapshot WHERE s.name = ?)' )
+      cur   = self.db.execute(
+        'SELECT c.inode, c.size, c.mtime, c.digest FROM checksums AS c {} '
+        'ORDER BY c.checked'.format( where ), () if name is None else (name,) )
+      out   = []
+      total = 0
+      for inode, size, mtime, digest in cur:
+        if budget is not None and out and total + (size or 0) > budget: break
+        where = 'AND s.name = ?' if name is not None else ''
+        args  = (inode,) if name is None else (inode, name)
+        row   = self.db.execute(
+          'SELECT s.name, p.path FROM entries AS e JOIN snapshots AS s ON s.id = e.snapshot '
+          'JOIN paths AS p ON p.id = e.path WHERE e.inode = ? AND s.complete = 1 '
+          "AND e.kind = 'f' {} ORDER BY s.name DESC LIMIT 1".format( where ), args ).fetchone()
+        if row is None: continue
+        out.append( (inode, size, mtime, digest) + row )
+        total += size or 0
+      cur.close()
+    return out
+
+  ##############################################################################
+  def sharing(self, inode):
+    '''
+    Purpose:
+      Method to find every snapshot holding an inode; a damaged inode
+      is damaged in all of them
+    Inputs:
+      inode : Inode number
+    Outputs:
+      Returns list of (snapshot, path) tuples sorted by snapshot name
+    '''
+    with self.__lock:
+      rows = self.db.execute(
+        'SELECT s.name, p.path FROM entries AS e JOIN snapshots AS s ON s.id = e.snapshot '
+        'JOIN paths AS p ON p.id = e.path WHERE e.inode = ? AND s.complete = 1 '
+        'ORDER BY s.name', (inode,) ).fetchall()
+    return [ (name, os.fsdecode(path)) for name, path in rows ]
+
+  ##############################################################################
+  def pruneChecksums(self):
+    '''Remove checksums of inodes no snapshot holds any more; their numbers may be reused'''
+    with self.__lock, self.db:
+      cur = self.db.execute(
+        'DELETE FROM checksums WHERE inode NOT IN '
+        '(SELECT inode FROM entries WHERE inode IS NOT NULL)' )
+    return cur.rowcount
+
+  ##############################################################################
+  def close(self):
+    self.db.close()
+
+  ##############################################################################
+  def __delete(self, snap):
+    self.db.execute( 'DELETE FROM entries WHERE snapshot = ?', (snap,) )
+    self.db.execute( 'DELETE FROM snapshots WHERE id = ?', (snap,) )
@@ -0,0 +1,97 @@
+import logging;
+
+import os, json, time;
+from threading import Lock;
+
+CHECKPOINT = '.checkpoint'                                                      # Appended to the .inprogress directory name
+
+class backupCheckpoint( object ):
+  def __init__(self, path, src_dir, name, changes = None, log = None):
+    '''
+    Purpose:
+      Class to record which subtrees of a backup have finished, in a
+      small JSON file next to the .inprogress directory, so a backup
+      that was cancelled, or lost power, can be resumed. A resumed run
+      skips subtrees that finished if the change journal shows they
+      have not changed since they were started. Without the journal,
+      nothing below a subtree is known to be unchanged, so every
+      subtree is transferred again; rsync only updates what differs
+      from the partial backup.
+    Inputs:
+      path    : Path of the checkpoint file
+      src_dir : Directory being backed up
+      name    : Name of the backup being written
+    Keywords:
+      changes : journalChanges recorded since the last backup, if any
+      log     : Logger to use
+    '''
+    super().__init__();
+    self.log      = log or logging.getLogger(__name__);
+    self.path     = path;
+    self.src_dir  = src_dir;
+    self.changes  = changes;
+    self.resumed  = None;                                                       # Name of the backup that was interrupted
+    self.finished = {};
+    self.__lock   = Lock();
+    try:
+      with open( path, 'r' ) as fid:
+        data = json.load( fid )
+    except (OSError, ValueError):
+      data = {}
+    if data.get('src_dir') == src_dir:
+      self.resumed  = data.get('name', None)
+      self.finished = data.get('finished', {})
+      self.log.info( 'Resuming backup; {} subtrees finished earlier'.format(len(self.finished)) )
+    self.name     = name;
+    self.__save()
+
+  ##############################################################################
+  def reusable(self, subtree):
+    '''
+    Purpose:
+      Method to check if a subtree finished earlier can be skipped
+    Inputs:
+      subtree : Name of the top-level subtree
+    Outputs:
+      Returns stats recorded for the subtree, or None if it must be
+      transferred again
+    '''
+    info = self.finished.get( subtree, None )
+    if info is None or self.changes is None: return None
+    path = os.path.join( self.src_dir, subtree )
+    if self.changes.changedSince( os.fsencode(path), info['started'] ): return None
+    return info['stats']
+
+  ##############################################################################
+  def start(self, subtree):
+    '''Return start information for a subtree; pass it to done() when it finishes'''
+    return {'started' : time.time()}
+
+  ##############################################################################
+  def done(self, subtree, info, stats):
+    '''
+    Purpose:
+      Method to mark a subtree as finished; thread safe
+    Inputs:
+      subtree : Name of the top-level subtree
+      info    : Dictionary returned by start()
+      stats   : Stats of the transfer of the subtree
+    Outputs:
+      None.
+    '''
+    with self.__lock:
+      self.finished[subtree] = dict( info, stats = stats )
+      self.__save()
+
+  ##############################################################################
+  def remove(self):
+    '''Remove the checkpoint file; the backup is complete'''
+    if os.path.isfile( self.path ): os.remove( self.path )
+
+  ##############################################################################
+  def __save(self):
+    '''Write the checkpoint atomically'''
+    tmp = self.path + '.tmp'
+    with open( tmp, 'w' ) as fid:
+      json.dump( {'src_dir' : self.src_dir, 'name' : self.name, 'finished' : self.finished}, fid )
+    os.replace( tmp, self.path )
@@ -0,0 +1,484 @@
+import logging;
+
+import os, sys, time, argparse;
+
+def size_fmt( num, suffix = 'B' ):
+  '''Format a number of bytes in a human readable format'''
+  for unit in ['','K','M','G','T','P','E','Z']:
+    if abs(num) < 1024.0:
+      return "{:3.1f}{}{}".format(num, unit, suffix)
+    num /= 1024.0
+  return "{:.1f}{}{}".format(num, 'Y', suffix);
+
+def size_parse( text ):
+  '''Parse a size such as 500M or 1.5G to a number of bytes'''
+  text = text.strip().upper().rstrip('B')
+  for i, unit in enumerate( ['K','M','G','T','P'] ):
+    if text.endswith( unit ):
+      return int( float( text[:-1] ) * 1024**(i+1) )
+  return int( float( text ) )
+
+################################################################################
+def restoreCmd( args ):
+  '''
+  Purpose:
+    Function for the restore command; lists versions of a path or
+    restores it from a backup
+  Inputs:
+    args : Parsed command line arguments
+  Outputs:
+    Returns exit code
+  '''
+  from . import restore
+  from .casStore import casStore
+
+  backup_dir = args.backup_dir or restore.getBackupDir()
+  if not backup_dir or not os.path.isdir( backup_dir ):
+    print( 'Backup disk NOT mounted!' )
+    return 1
+
+  snapshots = restore.getSnapshots( backup_dir )
+  store     = casStore( backup_dir )
+  stored    = store.snapshots()
+  if stored and (not snapshots or stored[-1] > snapshots[-1]):                  # Newest backups are in the content-addressed store
+    return casRestoreCmd( args, store, stored )
+
+  src_dir = restore.sourceDir( backup_dir )
+  try:
+    if args.list:
+      return showVersions( args.path, restore.listVersions( backup_dir, args.path, src_dir = src_dir ) )
+
+    snapshot = args.snapshot or (snapshots[-1] if snapshots else None)
+    if snapshot not in snapshots:
+      print( 'Backup not found: {}'.format(snapshot) )
+      return 1
+    rel = restore.relativePath( backup_dir, [snapshot], args.path, src_dir = src_dir )
+  except ValueError as err:
+    print( '{}: {}'.format(err, args.path) )
+    return 1
+  if rel is None:
+    print( 'Path not in backup {}: {}'.format(snapshot, args.path) )
+    return 1
+  dst = args.to or os.path.abspath( args.path )
+  if os.path.lexists( dst ):
+    print( 'Destination exists, use --to to restore elsewhere: {}'.format(dst) )
+    return 1
+
+  inst = restore.snapshotRestore( workers = args.workers, callback = report )
+  ok   = inst.restore( os.path.join( backup_dir, snapshot, rel ), dst )
+  print()
+  return 0 if ok else 1
+
+################################################################################
+def casRestoreCmd( args, store, snapshots ):
+  '''
+  Purpose:
+    Function for the restore command when the backups are in the
+    content-addressed store; a file can be streamed to standard
+    output with '--to -'
+  Inputs:
+    args      : Parsed command line arguments
+    store     : casStore instance
+    snapshots : List of backup names in the store
+  Outputs:
+    Returns exit code
+  '''
+  from .casStore import casRestore
+
+  if args.list:
+    return showVersions( args.path, store.versions( args.path ) )
+
+  snapshot = args.snapshot or snapshots[-1]
+  if snapshot not in snapshots:
+    print( 'Backup not found: {}'.format(snapshot) )
+    return 1
+  rel, node = store.find( store.load( snapshot ), args.path )
+  if node is None:
+    print( 'Path not in backup {}: {}'.format(snapshot, args.path) )
+    return 1
+  if args.to == '-':
+    if node['t'] != 'f':
+      print( 'Only files can be written to standard output: {}'.format(args.path), file = sys.stderr )
+      return 1
+    for data in store.read( node ):
+      sys.stdout.buffer.write( data )
+    sys.stdout.buffer.flush()
+    return 0
+  dst = args.to or os.path.abspath( args.path )
+  if os.path.lexists( dst ):
+    print( 'Destination exists, use --to to restore elsewhere: {}'.format(dst) )
+    return 1
+
+  inst = casRestore( store, workers = args.workers, callback = report )
+  ok   = inst.restore( node, dst )
+  print()
+  return 0 if ok else 1
+
+################################################################################
+def showVersions( path, versions ):
+  '''Print the versions of a path; returns exit code'''
+  if not versions:
+    print( 'No backups found for: {}'.format(path) )
+    return 1
+  for version in versions:
+    snaps = version['snapshots']
+    span  = snaps[0] if len(snaps) == 1 else '{} ... {} ({} backups)'.format(snaps[0], snaps[-1], len(snaps))
+    print( '{:>10}  {}  {}'.format( size_fmt(version['size']), version['mtime'], span ) )
+  return 0
+
+################################################################################
+def report( files, nbytes, seconds ):
+  '''Print restore progress'''
+  rate = nbytes / seconds if seconds > 0 else 0
+  print( '\rRestored {} files, {} ({}/s)'.format(files, size_fmt(nbytes), size_fmt(rate)),
+    end = '', flush = True )
+
+################################################################################
+def pruneCmd( args ):
+  '''
+  Purpose:
+    Function for the prune command; reports which backups the
+    retention tiers keep, how much each frees, and which would be
+    deleted, then deletes them unless this is a dry run. Without
+    --need, all redundant backups are deleted.
+  Inputs:
+    args : Parsed command line arguments
+  Outputs:
+    Returns exit code
+  '''
+  from . import restore
+  from .lock import processLock, LOCKNAME
+  from .destinations import connected
+  from .catalog import snapshotCatalog, CATALOG
+  from .usage import diskUsage
+  from .retention import retentionPlanner
+  from .trashReaper import trashReaper
+  from .casStore import casStore
+
+  backup_dir = args.backup_dir or restore.getBackupDir()
+  if not backup_dir or not os.path.isdir( backup_dir ):
+    print( 'Backup disk NOT mounted!' )
+    return 1
+  tiers = None
+  for dest, path in connected():                                                # Retention of the destination, if it is one
+    if os.path.realpath( path ) == os.path.realpath( backup_dir ): tiers = dest['retention']
+  lock  = processLock( os.path.join( backup_dir, LOCKNAME ) )
+  if not args.dry_run and not lock.acquire():
+    print( 'Backup directory locked, is there a backup running?' )
+    return 1
+
+  try:
+    names   = restore.getSnapshots( backup_dir )
+    store   = casStore( backup_dir )
+    stored  = store.snapshots()
+    if stored and (not names or stored[-1] > names[-1]):                        # Newest backups are in the content-addressed store
+      names, usage, protect = stored, store, []
+    else:
+      store   = None
+      catalog = snapshotCatalog( os.path.join( backup_dir, CATALOG ) )
+      usage   = diskUsage( catalog )
+      usage.update()
+      latest  = os.path.join( backup_dir, 'Latest' )
+      protect = [os.path.basename( os.path.realpath( latest ) )] if os.path.lexists( latest ) else []
+    plan    = retentionPlanner( tiers = tiers, usage = usage ).plan( names, args.need or 0, protect = protect )
+    delete  = plan['delete'] if args.need else plan['thin']
+    sizes   = plan['sizes'] or {}
+    for name in names:
+      state = 'keep' if name in plan['keep'] else 'thin'
+      size  = size_fmt( sizes[name] ) if name in sizes else '-'
+      print( '{}  {:4}  {:>10}  {}'.format( name, state, size, 'DELETE' if name in delete else '' ) )
+    reclaim = usage.reclaimable( delete ) if delete else 0
+    if reclaim is None:
+      print( 'Space freed is unknown; not all backups are in the catalog' )
+    else:
+      print( 'Deleting {} backups frees {}'.format( len(delete), size_fmt(reclaim) ) )
+    if args.need and reclaim is not None and reclaim < args.need:
+      print( 'Not enough space can be freed' )
+      return 1
+    if args.dry_run or not delete: return 0
+
+    if store:
+      for name in delete: store.remove( name )
+      store.collect()
+      return 0
+    reaper = trashReaper( backup_dir )
+    for name in delete:
+      reaper.trash( os.path.join( backup_dir, name ) )
+      usage.remove( name )
+      catalog.drop( name, prune = False )
+    catalog.prunePaths()
+    reaper.join()
+    catalog.close()
+    return 0
+  finally:
+    lock.release()
+
+################################################################################
+def verifyCmd( args ):
+  '''
+  Purpose:
+    Function for the verify command; reads back a budgeted sample of
+    the backed up files, or all of them, compares them with the
+    checksums recorded when they were written, and lists the damaged
+    ones with every backup that holds them
+  Inputs:
+    args : Parsed command line arguments
+  Outputs:
+    Returns exit code; 2 if any file is damaged
+  '''
+  from . import restore, utils
+  from .lock import processLock, LOCKNAME
+  from .catalog import snapshotCatalog, CATALOG
+  from .verify import snapshotVerifier
+
+  backup_dir = args.backup_dir or restore.getBackupDir()
+  if not backup_dir or not os.path.isdir( backup_dir ):
+    print( 'Backup disk NOT mounted!' )
+    return 1
+  if not os.path.isfile( os.path.join( backup_dir, CATALOG ) ):
+    print( 'No catalog in the backup directory; nothing to verify' )
+    return 1
+  lock = processLock( os.path.join( backup_dir, LOCKNAME ) )
+  if not lock.acquire():                                                        # Files of backups being deleted would look missing
+    print( 'Backup directory locked, is there a backup running?' )
+    return 1
+
+  try:
+    catalog  = snapshotCatalog( os.path.join( backup_dir, CATALOG ) )
+    verifier = snapshotVerifier( backup_dir, catalog, workers = args.workers )
+    rate     = utils.CONFIG.get('verify_rate', 0) if args.rate is None else args.rate
+    t0       = time.monotonic()
+    if args.all:
+      added = verifier.record( args.snapshot, changed = False, rate = rate )
+      if added: print( 'Checksummed {} files backed up before checksums were kept'.format(added) )
+    budget = None if args.all else (args.budget or utils.CONFIG.get('verify_budget', 0) or None)
+    bad    = verifier.verify( budget = budget, rate = rate, name = args.snapshot )
+    dt     = time.monotonic() - t0
+    print( 'Verified {} files, {} in {:.1f}s'.format(
+      verifier.stats['files'], size_fmt( verifier.stats['bytes'] ), dt ) )
+    for item in bad:
+      print( '{} (inode {}{}):'.format( item['problem'].upper(), item['inode'],
+        '; ' + item['error'] if item['error'] else '' ) )
+      for name, path in item['snapshots']:
+        print( '  {}/{}'.format( name, path ) )
+    catalog.close()
+    if bad:
+      print( '{} damaged files'.format(len(bad)) )
+      return 2
+    return 0
+  finally:
+    lock.release()
+
+################################################################################
+def excludesCmd( args ):
+  '''
+  Purpose:
+    Function for the excludes command; lists the compiled exclude
+    rules, or suggests directories to exclude from the transfer logs
+    of recent backups
+  Inputs:
+    args : Parsed command line arguments
+  Outputs:
+    Returns exit code
+  '''
+  from . import restore
+  from .excludes import excludeFilter, suggest
+
+  if not args.suggest:
+    filt = excludeFilter( args.src )
+    filt.discover()
+    for rule in filt.rules(): print( rule )
+    return 0
+
+  backup_dir = args.backup_dir or restore.getBackupDir()
+  if not backup_dir or not os.path.isdir( backup_dir ):
+    print( 'Backup disk NOT mounted!' )
+    return 1
+  found = suggest( backup_dir, src_dir = args.src, runs = args.runs, min_size = args.min_size )
+  if not found:
+    print( 'Nothing to suggest' )
+    return 0
+  print( '{:>10}  {:>8}  {:>7}  {:5}  {:15}  {}'.format('Bytes/run', 'Time/run', 'Files', 'Runs', 'Reason', 'Directory') )
+  for s in found:
+    secs = '-' if s['seconds_per_run'] is None else '{:.1f}s'.format(s['seconds_per_run'])
+    print( '{:>10}  {:>8}  {:>7.0f}  {:5}  {:15}  {}'.format( size_fmt( s['bytes_per_run'] ), secs,
+      s['files_per_run'], s['runs'], s['reason'], s['path'] ) )
+  print()
+  print( 'Saves {} per backup if all are excluded; add patterns such as {} to user_exclude'.format(
+    size_fmt( sum( s['bytes_per_run'] for s in found ) ), found[0]['pattern'] ) )
+  return 0
+
+################################################################################
+def watchCmd( args ):
+  '''
+  Purpose:
+    Function for the watch command; runs the watcher that records
+    changed paths for the next backup, until it is signaled
+  Inputs:
+    args : Parsed command line arguments
+  Outputs:
+    Returns exit code
+  '''
+  from .journal import journalWatcher
+
+  watcher = journalWatcher( args.src, flush = args.flush )
+  return watcher.run()
+
+################################################################################
+def ctlCmd( args ):
+  '''
+  Purpose:
+    Function for the ctl command; sends a command to the backup daemon
+    and prints the reply, or streams the status of the daemon
+  Inputs:
+    args : Parsed command line arguments
+  Outputs:
+    Returns exit code
+  '''
+  from . import daemon
+
+  path = args.socket or daemon.SOCKET
+  def show( info ):
+    if info['running']:
+      eta = ', {:.0f}s left'.format(info['eta']) if info.get('eta') else ''
+      return '{} ({:.0f}%{})'.format(info['status'], info['progress'], eta)
+    nxt = time.strftime( '%Y-%m-%d %H:%M', time.localtime(info['next_backup']) ) if info['next_backup'] else 'now'
+    return 'Idle; last backup {}, next {}, disk {}'.format(
+      info['last_backup'] or 'never', nxt, ', '.join( info['mounted'] ) or 'NOT mounted' )
+
+  if args.action == 'watch':
+    info = None
+    for info in daemon.watch( path ):
+      print( '\r' + show( info ).ljust(79), end = '', flush = True )
+    if info is None:
+      print( 'Daemon is not running' )
+      return 1
+    print()
+    return 0
+
+  reply = daemon.request( args.action, path )
+  if reply is None:
+    print( 'Daemon is not running' )
+    return 1
+  if not reply.get('ok', False):
+    print( reply.get('error', 'Failed') )
+    return 1
+  if args.action == 'status':
+    print( show( reply ) )
+  return 0
+
+################################################################################
+def statsCmd( args ):
+  '''
+  Purpose:
+    Function for the stats command; lists recent backup runs from the
+    run history and summarises where the time goes
+  Inputs:
+    args : Parsed command line arguments
+  Outputs:
+    Returns exit code
+  '''
+  import json
+  from .metrics import readHistory, summarize
+
+  records = readHistory( last = args.last, destination = args.destination )
+  summary = summarize( records )
+  if args.json:
+    print( json.dumps( {'runs' : records, 'summary' : summary}, indent = 2 ) )
+    return 0
+  if not records:
+    print( 'No backups recorded yet' )
+    return 1
+
+  def secs( value ):
+    return '-' if value is None else '{:.1f}s'.format(value)
+  print( '{:19}  {:8}  {:>6}  {:>8}  {:>9}  {:>9}  {:>10}  {:>10}'.format(
+    'Started', 'Disk', 'Status', 'Time', 'Scanned', 'Copied', 'Bytes', 'Rate') )
+  for r in records:
+    print( '{:19}  {:8}  {:>6}  {:>8}  {:>9}  {:>9}  {:>10}  {:>10}'.format(
+      time.strftime( '%Y-%m-%d %H:%M:%S', time.localtime( r['start'] ) ),
+      (r.get('destination', None) or '-')[:8], 'ok' if r['status'] == 0 else 'FAILED',
+      secs( r['duration'] ), r.get('files_scanned', 0), r.get('files_transferred', 0),
+      size_fmt( r.get('bytes_transferred', 0) ), size_fmt( r.get('bytes_per_second', 0) ) + '/s' ) )
+  print()
+  print( '{} runs, {} failed; median {}, 90th percentile {}'.format(
+    summary['runs'], summary['failed'], secs( summary['duration']['median'] ), secs( summary['duration']['p90'] ) ) )
+  for phase, times in sorted( summary['phases'].items(), key = lambda x: -(x[1]['median'] or 0) ):
+    print( '  {:10} median {:>8}  p90 {:>8}'.format( phase, secs( times['median'] ), secs( times['p90'] ) ) )
+  if summary['trend'] is not None:
+    print( 'Median run time {} {:.0f}% over these runs'.format(
+      'grew' if summary['trend'] > 0 else 'fell', abs( summary['trend'] ) * 100 ) )
+  return 0
+
+################################################################################
+def main( argv = None ):
+  '''
+  Purpose:
+    Entry point for the pyBackup sub-commands
+  Inputs:
+    argv : List of command line arguments; default is sys.argv[1:]
+  Outputs:
+    Returns exit code
+  '''
+  parser = argparse.ArgumentParser( prog = 'pyBackup', description = 'pyBackup commands' )
+  parser.add_argument('--loglevel', type = int, default = 30, help = 'Set logging level')
+  subs   = parser.add_subparsers( dest = 'command' )
+
+  sub = subs.add_parser('restore', help = 'List versions of, or restore, a file or directory')
+  sub.add_argument('path',         type = str, help = 'Path, on the backed up computer, to list or restore')
+  sub.add_argument('--list',       action = 'store_true', help = 'List all versions of path across backups')
+  sub.add_argument('--snapshot',   type = str, help = 'Name of backup to restore from; default is newest')
+  sub.add_argument('--to',         type = str, help = "Where to restore to; default is the original location. With the 'cas' backend, '-' writes a file to standard output")
+  sub.add_argument('--workers',    type = int, default = 8, help = 'Number of files to copy at once')
+  sub.add_argument('--backup-dir', type = str, help = 'Top-level backup directory; default from config')
+  sub.set_defaults( func = restoreCmd )
+
+  sub = subs.add_parser('prune', help = 'Delete backups according to the retention tiers')
+  sub.add_argument('--need',       type = size_parse, help = 'Free at least this much space, e.g., 50G; default deletes all redundant backups')
+  sub.add_argument('--dry-run',    action = 'store_true', help = 'Only report what would be deleted')
+  sub.add_argument('--backup-dir', type = str, help = 'Top-level backup directory; default from config')
+  sub.set_defaults( func = pruneCmd )
+
+  sub = subs.add_parser('verify', help = 'Check backed up files against their checksums')
+  sub.add_argument('--all',        action = 'store_true', help = 'Verify every file, and checksum files backed up before checksums were kept')
+  sub.add_argument('--budget',     type = size_parse, help = 'Read at most this much, e.g., 10G; default from config')
+  sub.add_argument('--rate',       type = size_parse, help = 'Read at most this much per second, e.g., 50M; 0 for no limit; default from config')
+  sub.add_argument('--snapshot',   type = str, help = 'Only verify files in this backup')
+  sub.add_argument('--workers',    type = int, help = 'Number of processes reading files; default from config')
+  sub.add_argument('--backup-dir', type = str, help = 'Top-level backup directory; default from config')
+  sub.set_defaults( func = verifyCmd )
+
+  sub = subs.add_parser('excludes', help = 'List exclude rules, or suggest directories to exclude')
+  sub.add_argument('--suggest',    action = 'store_true', help = 'Suggest directories that change often and are not worth backing up')
+  sub.add_argument('--src',        type = str, default = '/', help = 'Directory backed up')
+  sub.add_argument('--runs',       type = int, default = 10, help = 'Number of recent backups to look at')
+  sub.add_argument('--min-size',   type = size_parse, default = 100 * 1024**2, help = 'Bytes per backup for a directory to count as high churn, e.g., 100M')
+  sub.add_argument('--backup-dir', type = str, help = 'Top-level backup directory; default from config')
+  sub.set_defaults( func = excludesCmd )
+
+  sub = subs.add_parser('watch', help = 'Record changed paths so backups only scan what changed')
+  sub.add_argument('--src',        type = str, default = '/', help = 'Directory to watch; must match the backed up directory')
+  sub.add_argument('--flush',      type = float, default = 5.0, help = 'Seconds between writes of the journal')
+  sub.set_defaults( func = watchCmd )
+
+  sub = subs.add_parser('ctl', help = 'Trigger, cancel, or watch backups run by the daemon, or stop it')
+  sub.add_argument('action',       choices = ['trigger', 'cancel', 'status', 'watch', 'stop'], help = 'What to do')
+  sub.add_argument('--socket',     type = str, default = None, help = 'Control socket of the daemon; default in the application directory')
+  sub.set_defaults( func = ctlCmd )
+
+  sub = subs.add_parser('stats', help = 'Show timings and throughput of recent backups')
+  sub.add_argument('--last',       type = int, default = 20, help = 'Number of recent runs to show')
+  sub.add_argument('--destination', type = str, help = 'Only show runs to the disk with this UUID')
+  sub.add_argument('--json',       action = 'store_true', help = 'Print the runs and summary as JSON')
+  sub.set_defaults( func = statsCmd )
+
+  args = parser.parse_args( argv )
+  logging.basicConfig( level = args.loglevel, format = '%(asctime)s [%(levelname)s] %(message)s' )
+  logging.getLogger( __package__ ).setLevel( args.loglevel );                  # Package logger defaults to DEBUG
+  if not getattr(args, 'func', None):
+    parser.print_help()
+    return 1
+  return args.func( args )
+
+if __name__ == "__main__":
+  sys.exit( main() )
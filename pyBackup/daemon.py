@@ -0,0 +1,449 @@
+import logging;
+
+import os, sys, json, time, fcntl, select, signal, socket, asyncio, calendar;
+from datetime import datetime;
+from threading import Thread;
+
+from . import APPDIR, setup, utils
+from .journal import JOURNALDIR, CHANGES, MOUNTINFO, readState
+from .destinations import destinations, getState
+
+SOCKET   = os.path.join( APPDIR, 'pyBackupd.sock' )                             # Control socket for the GUI and CLI
+PIDLOCK  = os.path.join( APPDIR, 'pyBackupd.lock' )                             # Held by the running daemon
+COMMAND  = 'pyBackupd'                                                          # Script that starts the daemon
+TICK     = 30                                                                   # Maximum seconds between schedule checks
+SCHEDULE = {'interval'      : 60,                                               # Minutes between backups
+            'min'           : 15,                                               # Shortest interval, after heavy change
+            'max'           : 240,                                              # Longest interval, when idle
+            'busy_files'    : 1000,                                             # Files transferred that count as heavy change
+            'busy_bytes'    : 1024**3,                                          # Bytes transferred that count as heavy change
+            'journal_bytes' : 1024**2}                                          # Journal size that triggers an early backup
+
+def schedule():
+  '''Return the schedule settings of the config merged over the defaults'''
+  return dict( SCHEDULE, **(utils.CONFIG.get('schedule', None) or {}) )
+
+def lastBackupTime( last_backup = None ):
+  '''Return UTC timestamp of the last backup, or of the given date string; None if there is none'''
+  if last_backup is None: last_backup = utils.CONFIG.get('last_backup', '')
+  if not last_backup: return None
+  try:
+    date = datetime.strptime( last_backup, utils.CONFIG['date_FMT'] )
+  except ValueError:
+    return None
+  return calendar.timegm( date.timetuple() )
+
+def command():
+  '''
+  Purpose:
+    Function to find the script that starts the daemon; on the PATH,
+    or installed next to the python interpreter
+  Inputs:
+    None.
+  Outputs:
+    Returns path of the script, or None if it is not installed
+  '''
+  import shutil
+  for cmd in (shutil.which( COMMAND ),
+              os.path.join( os.path.dirname( sys.executable ), COMMAND )):
+    if cmd and os.path.isfile( cmd ) and os.access( cmd, os.X_OK ):
+      return cmd
+  return None
+
+def request( cmd, path = SOCKET, timeout = 5.0 ):
+  '''
+  Purpose:
+    Function to send a command to the daemon and read the reply
+  Inputs:
+    cmd     : Command; one of trigger, cancel, status, or stop
+  Keywords:
+    path    : Path of the control socket
+    timeout : Seconds to wait for the daemon
+  Outputs:
+    Returns reply dictionary, or None if the daemon is not running
+  '''
+  try:
+    with socket.socket( socket.AF_UNIX, socket.SOCK_STREAM ) as sock:
+      sock.settimeout( timeout )
+      sock.connect( path )
+      sock.sendall( json.dumps( {'cmd' : cmd} ).encode() + b'\n' )
+      with sock.makefile( 'rb' ) as fid:
+        line = fid.readline()
+  except OSError:
+    return None
+  try:
+    return json.loads( line )
+  except ValueError:
+    return None
+
+def watch( path = SOCKET ):
+  '''
+  Purpose:
+    Generator of status updates of the daemon, about one a second,
+    until the daemon exits
+  Keywords:
+    path : Path of the control socket
+  Outputs:
+    Yields status dictionaries
+  '''
+  try:
+    with socket.socket( socket.AF_UNIX, socket.SOCK_STREAM ) as sock:
+      sock.connect( path )
+      sock.sendall( b'{"cmd": "watch"}\n' )
+      with sock.makefile( 'rb' ) as fid:
+        for line in fid:
+          try:
+            yield json.loads( line )
+          except ValueError:
+            return
+  except OSError:
+    return
+
+class backupDaemon( object ):
+  def __init__(self, src_dir = '/', socket_path = SOCKET, loglevel = logging.INFO, log = None):
+    '''
+    Purpose:
+      Class for the resident scheduler that replaces the hourly cron
+      job. The daemon keeps the config and the mount points of the
+      backup disks in memory and decides when to back up:
+        - after the interval since the last backup has passed; the
+          interval shrinks after backups that transferred a lot and
+          grows while nothing changes
+        - as soon as a backup disk is mounted
+        - early when the change journal grows large
+        - once, right away, when backups were missed while the
+          computer was off or asleep
+      Backups run in a thread, one at a time, while the event loop
+      serves the control socket used by the GUI and the CLI to trigger,
+      cancel, and watch backups. If the change journal is enabled and
+      no watcher is running, the daemon starts one.
+    Inputs:
+      None.
+    Keywords:
+      src_dir     : Directory to back up
+      socket_path : Path of the control socket
+      loglevel    : Logging level for the backups
+      log         : Logger to use
+    '''
+    super().__init__();
+    self.log          = log or logging.getLogger(__name__);
+    self.src_dir      = src_dir;
+    self.socket_path  = socket_path;
+    self.loglevel     = loglevel;
+    self.interval     = schedule()['interval'] * 60;                            # Seconds; adapted after every backup
+    self.mounts       = {};                                                     # Mount point of each mounted destination, by UUID
+    self.inst         = None;                                                   # multiBackup instance of the running backup
+    self.lastStatus   = None;                                                   # Return code of the last backup
+    self.__loop       = None;
+    self.__wake       = None;                                                   # Set to re-check the schedule right away
+    self.__task       = None;
+    self.__reason     = None;                                                   # Why the next backup was triggered
+    self.__notBefore  = 0;                                                      # No scheduled backup before this time; after failures
+    self.__lastRun    = None;                                                   # Time of the last successful run; also set when nothing changed
+    self.__watcher    = None;                                                   # Journal watcher started by the daemon
+    self.__running    = False;
+
+  ##############################################################################
+  def run(self):
+    '''
+    Purpose:
+      Method to run the daemon until it is signaled
+    Inputs:
+      None.
+    Outputs:
+      Returns exit code
+    '''
+    setup()
+    lock = os.open( PIDLOCK, os.O_RDWR | os.O_CREAT, 0o644 )
+    try:
+      fcntl.flock( lock, fcntl.LOCK_EX | fcntl.LOCK_NB )
+    except OSError:
+      self.log.error( 'Another daemon is already running' )
+      os.close( lock )
+      return 1
+    try:
+      asyncio.run( self.__main() )
+    finally:
+      os.close( lock )
+    return 0
+
+  ##############################################################################
+  def stop(self, *args):
+    '''Stop the daemon; a running backup is cancelled'''
+    self.__running = False
+    if self.inst: self.inst.cancel()
+    if self.__wake: self.__wake.set()
+
+  ##############################################################################
+  def trigger(self, reason = 'requested'):
+    '''
+    Purpose:
+      Method to start a backup as soon as possible
+    Keywords:
+      reason : Reason for the backup, for the log
+    Outputs:
+      Returns False if a backup is already running, True otherwise
+    '''
+    if self.__task: return False
+    self.__reason = reason
+    self.__wake.set()
+    return True
+
+  ##############################################################################
+  def cancel(self):
+    '''Cancel the running backup; returns False if none is running'''
+    if not self.inst: return False
+    self.inst.cancel()
+    return True
+
+  ##############################################################################
+  def status(self):
+    '''Return dictionary with the state of the daemon and the running backup'''
+    last = self.__lastBackup()
+    info = {'running'     : self.inst is not None,
+            'status'      : self.inst.statusTXT if self.inst else '',
+            'progress'    : self.inst.progress  if self.inst else 0.0,
+            'eta'         : self.inst.eta       if self.inst else None,
+            'last_backup' : utils.CONFIG.get('last_backup', ''),
+            'last_status' : self.lastStatus,
+            'next_backup' : max( last + self.interval, self.__notBefore ) if last else None,
+            'interval'    : self.interval,
+            'mounted'     : sorted( self.mounts.values() )}
+    return info
+
+  ##############################################################################
+  def __lastBackup(self):
+    '''Return time of the last backup; runs that found nothing to back up count too'''
+    times = [t for t in (lastBackupTime(), self.__lastRun) if t is not None]
+    return max( times ) if times else None
+
+  ##############################################################################
+  async def __main(self):
+    '''Event loop of the daemon'''
+    self.__loop    = asyncio.get_running_loop()
+    self.__wake    = asyncio.Event()
+    self.__running = True
+    for sig in [signal.SIGTERM, signal.SIGINT, signal.SIGQUIT]:
+      self.__loop.add_signal_handler( sig, self.stop )
+    self.__loop.add_signal_handler( signal.SIGHUP, self.__reloadConfig, True )
+    self.__reloadConfig()
+    self.__mountsChanged()
+    if os.path.exists( MOUNTINFO ):                                             # Woken by the kernel on mount changes
+      Thread( target = self.__watchMounts, daemon = True ).start()
+
+    if os.path.exists( self.socket_path ): os.remove( self.socket_path );      # Stale; the lock is held
+    server = await asyncio.start_unix_server( self.__client, path = self.socket_path )
+    os.chmod( self.socket_path, 0o660 )
+    self.log.info( 'Daemon started; backing up {} every {:.0f} minutes'.format(
+      self.src_dir, self.interval / 60 ) )
+
+    while self.__running:
+      self.__reloadConfig()
+      await self.__superviseWatcher()
+      if not os.path.exists( MOUNTINFO ): self.__mountsChanged();              # No mount notifications; poll
+      reason = self.__due()
+      if reason and not self.__task:
+        self.__task = asyncio.ensure_future( self.__backup( reason ) )
+      self.__wake.clear()
+      try:
+        await asyncio.wait_for( self.__wake.wait(), timeout = TICK )
+      except asyncio.TimeoutError:
+        pass
+
+    self.log.info( 'Daemon stopping' )
+    if self.__task: await self.__task
+    server.close()
+    await server.wait_closed()
+    if os.path.exists( self.socket_path ): os.remove( self.socket_path )
+    if self.__watcher and self.__watcher.returncode is None:
+      self.__watcher.terminate()
+      await self.__watcher.wait()
+
+  ##############################################################################
+  def __due(self):
+    '''
+    Purpose:
+      Private method to decide if a backup should start now
+    Inputs:
+      None.
+    Outputs:
+      Returns reason for the backup, or None if none is due
+    '''
+    if self.__reason:                                                           # Triggered; by a client or the disk being mounted
+      reason, self.__reason = self.__reason, None
+      return reason
+    if not self.mounts: return None
+    now  = time.time()
+    if now < self.__notBefore: return None
+    last = self.__lastBackup()
+    if last is None: return 'first backup'
+    if now >= last + 2 * self.interval:
+      return 'catching up on missed backups'                                    # Missed runs are collapsed into one
+    if now >= last + self.interval: return 'scheduled'
+    if utils.CONFIG.get('journal', False) and now >= last + schedule()['min'] * 60:
+      try:
+        size = os.path.getsize( os.path.join( JOURNALDIR, CHANGES ) )
+      except OSError:
+        size = 0
+      if size > schedule()['journal_bytes']: return 'heavy change recorded by the journal'
+    return None
+
+  ##############################################################################
+  async def __backup(self, reason):
+    '''
+    Purpose:
+      Private method to run a backup in a thread
+    Inputs:
+      reason : Reason for the backup, for the log
+    Outputs:
+      None.
+    '''
+    from .rsyncBackup import multiBackup
+
+    self.log.info( 'Starting backup: {}'.format(reason) )
+    try:
+      self.inst = multiBackup( src_dir = self.src_dir, loglevel = self.loglevel, signals = False )
+      status    = await self.__loop.run_in_executor( None, self.inst.backup, dict(self.mounts) )
+    except Exception as err:
+      self.log.exception( 'Backup failed: {}'.format(err) )
+      status    = 1
+    self.__adapt( status, self.inst.stats if self.inst else {} )
+    self.lastStatus = status
+    self.inst       = None
+    self.__task     = None
+    self.__wake.set()
+
+  ##############################################################################
+  def __adapt(self, status, stats):
+    '''
+    Purpose:
+      Private method to adapt the interval to how much changed. A
+      backup that transferred many files or bytes halves the interval;
+      one that transferred nothing doubles it; otherwise it returns
+      to the configured interval. After a failure, or when another
+      backup held the lock, scheduled backups wait for the shortest
+      interval.
+    Inputs:
+      status : Return code of the backup; None if it did not run
+      stats  : Stats of the transfer
+    Outputs:
+      None.
+    '''
+    sched  = schedule()
+    if status != 0:
+      self.__notBefore = time.time() + sched['min'] * 60
+      return
+    self.__lastRun = time.time()
+    files  = stats.get('number_of_regular_files_transferred', 0) if stats else 0
+    nbytes = stats.get('total_transferred_file_size', 0)        if stats else 0
+    if files >= sched['busy_files'] or nbytes >= sched['busy_bytes']:
+      interval = self.interval / 2
+    elif files == 0:
+      interval = self.interval * 2
+    else:
+      interval = sched['interval'] * 60
+    self.interval = min( max( interval, sched['min'] * 60 ), sched['max'] * 60 )
+    self.log.info( 'Next backup in {:.0f} minutes'.format( self.interval / 60 ) )
+
+  ##############################################################################
+  def __reloadConfig(self, force = False):
+    '''Reload the config file when it was changed by another process'''
+    if self.__task: return                                                      # The backup writes the config itself
+    if utils.CONFIG.reload( force = force ) and self.__wake:
+      self.log.debug( 'Config reloaded' )
+      self.__mountsChanged();                                                   # The backup disk may have been changed
+
+  ##############################################################################
+  def __watchMounts(self):
+    '''Thread that wakes the event loop whenever the mount table changes'''
+    with open( MOUNTINFO, 'rb' ) as fid:
+      fid.read()
+      poller = select.poll()
+      poller.register( fid, select.POLLPRI | select.POLLERR )
+      while self.__running:
+        if poller.poll( 1000 ):
+          fid.seek( 0 )
+          fid.read()
+          self.__loop.call_soon_threadsafe( self.__mountsChanged )
+
+  ##############################################################################
+  def __mountsChanged(self):
+    '''Refresh the mount points of the backup disks; trigger a backup when one appears'''
+    mounts = {}
+    for dest in destinations():
+      try:
+        mountPoint = utils.get_MountPoint( dest['uuid'] )
+      except Exception as err:
+        self.log.warning( 'Failed to find backup disk: {}'.format(err) )
+        mountPoint = None
+      if mountPoint: mounts[ dest['uuid'] ] = mountPoint
+    if mounts == self.mounts: return
+    for uuid in self.mounts:
+      if uuid not in mounts: self.log.info( 'Backup disk unmounted: {}'.format(self.mounts[uuid]) )
+    new, self.mounts = [uuid for uuid in mounts if uuid not in self.mounts], mounts
+    for uuid in new:
+      self.log.info( 'Backup disk mounted at {}'.format(mounts[uuid]) )
+      last = lastBackupTime( getState( uuid, 'last_backup', '' ) )             # Rotated disks may be far behind the others
+      if self.__wake and (last is None or time.time() >= last + schedule()['min'] * 60):
+        self.__notBefore = 0
+        self.trigger( 'backup disk mounted' )
+
+  ##############################################################################
+  async def __superviseWatcher(self):
+    '''Start the journal watcher if the journal is enabled and none is running'''
+    if not utils.CONFIG.get('journal', False): return
+    if self.__watcher and self.__watcher.returncode is None: return
+    if readState() is not None: return                                          # Started by someone else
+    self.log.info( 'Starting journal watcher' )
+    self.__watcher = await asyncio.create_subprocess_exec(
+      sys.executable, '-m', 'pyBackup.cli', 'watch', '--src', self.src_dir )
+
+  ##############################################################################
+  async def __client(self, reader, writer):
+    '''
+    Purpose:
+      Private method to serve a client of the control socket. Clients
+      send one JSON object per line with a 'cmd' key and get one JSON
+      object per line back; 'watch' streams the status every second
+      until the client disconnects.
+    Inputs:
+      reader : asyncio StreamReader
+      writer : asyncio StreamWriter
+    Outputs:
+      None.
+    '''
+    try:
+      async for line in reader:
+        try:
+          cmd = json.loads( line ).get('cmd', None)
+        except (ValueError, AttributeError):
+          cmd = None
+        if cmd == 'trigger':
+          if self.trigger():
+            reply = {'ok' : True}
+          else:
+            reply = {'ok' : False, 'error' : 'Backup already running'}
+        elif cmd == 'cancel':
+          if self.cancel():
+            reply = {'ok' : True}
+          else:
+            reply = {'ok' : False, 'error' : 'No backup running'}
+        elif cmd == 'status':
+          reply = dict( self.status(), ok = True )
+        elif cmd == 'stop':
+          self.stop()
+          reply = {'ok' : True}
+        elif cmd == 'watch':
+          while self.__running:
+            writer.write( json.dumps( dict( self.status(), ok = True ) ).encode() + b'\n' )
+            await writer.drain()
+            await asyncio.sleep( 1.0 )
+          break
+        else:
+          reply = {'ok' : False, 'error' : 'Unknown command: {}'.format(cmd)}
+        writer.write( json.dumps( reply ).encode() + b'\n' )
+        await writer.drain()
+    except (ConnectionError, OSError, asyncio.CancelledError):                   # Client went away, or the daemon is stopping
+      pass
+    finally:
+      writer.close()
@@ -0,0 +1,99 @@
+import os;
+from threading import Lock;
+
+from . import utils
+
+STATE_LOCK = Lock()                                                             # Backups to several destinations update the state at once
+
+def destinations():
+  '''
+  Purpose:
+    Function to get the backup destinations from the config. Each
+    entry of the 'destinations' list has the UUID of a backup disk
+    and, optionally, its own 'backup_dir', 'retention',
+    'disk_reserve', and 'backend'; missing settings are taken from the top level of
+    the config. Without a list, the disk set with 'disk_UUID' is the
+    only destination.
+  Inputs:
+    None.
+  Outputs:
+    Returns list of destination dictionaries with 'uuid',
+    'backup_dir', 'retention', 'disk_reserve', and 'backend' keys
+  '''
+  dests = utils.CONFIG.get('destinations', None) or []
+  if not dests and utils.CONFIG['disk_UUID']:
+    dests = [ {'uuid' : utils.CONFIG['disk_UUID']} ]
+  out   = []
+  for dest in dests:
+    if not dest.get('uuid', None): continue
+    out.append( {'uuid'         : dest['uuid'],
+                 'backup_dir'   : dest.get('backup_dir', None) or utils.CONFIG['backup_dir'],
+                 'retention'    : dest.get('retention',  None) or utils.CONFIG.get('retention', None),
+                 'disk_reserve' : dest.get('disk_reserve', utils.CONFIG.get('disk_reserve', 0.1)),
+                 'backend'      : dest.get('backend', None) or utils.CONFIG.get('backend', 'rsync')} )
+  return out
+
+def connected( mounts = None ):
+  '''
+  Purpose:
+    Function to get the destinations whose disks are mounted
+  Keywords:
+    mounts : Dictionary of UUID: mount point; default looks them up
+  Outputs:
+    Returns list of (destination, top-level backup directory) tuples
+  '''
+  out = []
+  for dest in destinations():
+    if mounts is not None:
+      mountPoint = mounts.get( dest['uuid'], None )
+    else:
+      mountPoint = utils.get_MountPoint( dest['uuid'] )
+    if mountPoint:
+      out.append( (dest, os.path.join( mountPoint, dest['backup_dir'] )) )
+  return out
+
+def getState( uuid, key, default = None ):
+  '''
+  Purpose:
+    Function to get a value recorded for one destination by its last
+    backup; e.g., 'last_stats', 'last_backup', or 'backup_size'
+  Inputs:
+    uuid    : UUID of the destination
+    key     : Name of the value
+  Keywords:
+    default : Returned if nothing is recorded
+  Outputs:
+    Returns the value
+  '''
+  state = (utils.CONFIG.get('destination_state', None) or {}).get( uuid, {} )
+  if key in state: return state[key]
+  if uuid == utils.CONFIG['disk_UUID']:                                         # Kept at the top level before there were several destinations
+    return utils.CONFIG.get( key, default )
+  return default
+
+def setState( uuid, **values ):
+  '''Record values for one destination; saved with the config'''
+  with STATE_LOCK:
+    states       = dict( utils.CONFIG.get('destination_state', None) or {} )
+    states[uuid] = dict( states.get( uuid, {} ), **values )
+    utils.CONFIG['destination_state'] = states
+
+def addDestination( path ):
+  '''
+  Purpose:
+    Function to add a backup disk as another destination
+  Inputs:
+    path : Path to mount point of the disk
+  Outputs:
+    Returns True if added, False otherwise
+  '''
+  uuid = utils.get_UUID( path )
+  if not uuid or not os.path.isdir( path ): return False
+  dests = list( utils.CONFIG.get('destinations', None) or [] )
+  if not dests and utils.CONFIG['disk_UUID']:                                   # Keep the disk set up before
+    dests.append( {'uuid' : utils.CONFIG['disk_UUID']} )
+  if uuid not in [dest.get('uuid', None) for dest in dests]:
+    dests.append( {'uuid' : uuid} )
+  utils.CONFIG['destinations'] = dests
+  utils.CONFIG.saveConfig()
+  return True
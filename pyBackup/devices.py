@@ -0,0 +1,217 @@
+import logging;
+
+import os, sys, json, stat, select;
+from threading import Lock;
+from subprocess import check_output;
+
+MOUNTINFO = '/proc/self/mountinfo'
+BYUUID    = '/dev/disk/by-uuid'
+LSBLK     = ['lsblk', '--fs', '--json']
+DISKUTIL  = ['diskutil', 'info']
+
+def unescape( path ):
+  '''Decode the octal escapes of mountinfo paths; e.g., \\040 for a space'''
+  if b'\\' in path:
+    path = path.decode('unicode_escape').encode('latin-1')
+  return os.fsdecode( path )
+
+def readMountinfo( fid ):
+  '''
+  Purpose:
+    Function to parse the mount table
+  Inputs:
+    fid : Open binary file object of /proc/self/mountinfo
+  Outputs:
+    Returns list of (device number, mount point, source) tuples for
+    mounts of the root of a file system; bind mounts of directories
+    inside a file system are skipped
+  '''
+  fid.seek( 0 )
+  mounts = []
+  for line in fid.read().splitlines():
+    pre, _, post = line.partition( b' - ' )
+    fields = pre.split()
+    if len(fields) < 5 or fields[3] != b'/': continue
+    major, minor = fields[2].split( b':' )
+    source = post.split()[1] if len(post.split()) > 1 else b''
+    mounts.append( (os.makedev( int(major), int(minor) ), unescape( fields[4] ), unescape( source )) )
+  return mounts
+
+def readByUUID( path = BYUUID ):
+  '''
+  Purpose:
+    Function to map file system UUIDs to the block devices holding
+    them. udev links every file system, whether it is on a disk, a
+    partition, an LVM volume, or an open LUKS container, so nested
+    devices need no special handling.
+  Keywords:
+    path : Directory of UUID links
+  Outputs:
+    Returns dictionary of UUID: (device number, device path)
+  '''
+  devices = {}
+  for entry in os.scandir( path ):
+    try:
+      st = os.stat( entry.path )                                                # Follows the link to the device node
+    except OSError:
+      continue
+    if stat.S_ISBLK( st.st_mode ):
+      devices[entry.name] = (st.st_rdev, os.path.realpath( entry.path ))
+  return devices
+
+def lsblkDevices( data ):
+  '''
+  Purpose:
+    Function to flatten the device tree printed by lsblk, to any depth;
+    e.g., a file system on an LVM volume inside a LUKS container on a
+    partition
+  Inputs:
+    data : Parsed JSON output of lsblk --fs --json
+  Outputs:
+    Returns list of device dictionaries
+  '''
+  devices = []
+  stack   = list( data.get('blockdevices', None) or [] )
+  while stack:
+    device = stack.pop()
+    devices.append( device )
+    stack.extend( device.get('children', None) or [] )
+  return devices
+
+def diskutil( val ):
+  '''Return dictionary of the output of diskutil info for a disk, UUID, or mount point'''
+  data = {}
+  if isinstance(val, str) and val != '':
+    try:
+      lines = check_output( DISKUTIL+[val] ).decode().splitlines()
+    except:
+      return data
+    for line in lines:
+      try:
+        key, val = line.split(':')
+      except:
+        pass
+      else:
+        data[ key.strip() ] = val.strip()
+  return data
+
+class deviceCache( object ):
+  def __init__(self, mountinfo = MOUNTINFO, by_uuid = BYUUID, log = None):
+    '''
+    Purpose:
+      Class to resolve file system UUIDs to mount points, and paths to
+      the UUID of the file system holding them, without running lsblk
+      on every lookup. On Linux, the mount table is read from
+      mountinfo and matched to the UUID links created by udev by
+      device number, or by device path for file systems such as btrfs
+      that report an anonymous device number. Both are cached until
+      the kernel reports a change of the mount table, which is checked
+      with a poll of the open mountinfo file and costs one system call.
+      Without UUID links, e.g., in containers, the output of lsblk is
+      cached instead, and without mountinfo lsblk is run for every
+      lookup; diskutil is used on macOS.
+    Inputs:
+      None.
+    Keywords:
+      mountinfo : Path of the mount table
+      by_uuid   : Directory of UUID links
+      log       : Logger to use
+    '''
+    super().__init__();
+    self.log       = log or logging.getLogger(__name__);
+    self.mountinfo = mountinfo;
+    self.by_uuid   = by_uuid;
+    self.__lock    = Lock();
+    self.__fid     = None;                                                      # Open mount table; readable with POLLPRI after changes
+    self.__poller  = None;
+    self.__mounts  = None;                                                      # Dictionary of UUID: mount point
+    self.__uuids   = None;                                                      # Dictionary of device number: UUID
+    self.watch     = 'linux' in sys.platform and os.path.exists( mountinfo );   # Mount changes are reported
+    self.direct    = self.watch and os.path.isdir( by_uuid );                   # No need for lsblk
+
+  ##############################################################################
+  def mountPoint(self, uuid):
+    '''
+    Purpose:
+      Method to find where a file system is mounted
+    Inputs:
+      uuid : UUID of the file system
+    Outputs:
+      Returns mount point, or None if not mounted
+    '''
+    if not uuid: return None
+    if 'darwin' in sys.platform:
+      return diskutil( uuid ).get('Mount Point', None)
+    with self.__lock:
+      self.__update()
+      return self.__mounts.get( uuid, None )
+
+  ##############################################################################
+  def uuid(self, path):
+    '''
+    Purpose:
+      Method to find the UUID of the file system holding a path
+    Inputs:
+      path : Path to a mount point, or anything on the file system
+    Outputs:
+      Returns UUID, or None if not found
+    '''
+    if 'darwin' in sys.platform:
+      return diskutil( path ).get('Disk / Partition UUID', None)
+    path = os.path.realpath( path )
+    with self.__lock:
+      self.__update()
+      if self.direct:
+        try:
+          return self.__uuids.get( os.stat( path ).st_dev, None )
+        except OSError:
+          return None
+      best = None
+      for uuid, mnt in self.__mounts.items():                                   # Deepest mount holding the path
+        if path == mnt or path.startswith( mnt.rstrip(os.sep) + os.sep ):
+          if best is None or len(mnt) > len(self.__mounts[best]): best = uuid
+      return best
+
+  ##############################################################################
+  def changed(self):
+    '''Return True if the mount table changed since it was last read'''
+    if self.__fid is None: return True
+    return len( self.__poller.poll( 0 ) ) > 0
+
+  ##############################################################################
+  def invalidate(self):
+    '''Drop the cache; it is rebuilt on the next lookup'''
+    with self.__lock:
+      self.__mounts = None
+
+  ##############################################################################
+  def __update(self):
+    '''Private method to rebuild the cache if the mount table changed'''
+    if self.__mounts is not None and not self.changed(): return
+    if self.__fid is None and self.watch:
+      self.__fid    = open( self.mountinfo, 'rb' )
+      self.__poller = select.poll()
+      self.__poller.register( self.__fid, select.POLLPRI | select.POLLERR )
+    mounts = readMountinfo( self.__fid ) if self.__fid else [];                 # Reading clears the change notification
+    self.__mounts = {}
+    self.__uuids  = {}
+    if not self.direct:
+      for device in lsblkDevices( json.loads( check_output( LSBLK ) ) ):
+        uuid, point = device.get('uuid', None), device.get('mountpoint', None)
+        if uuid and point and (uuid not in self.__mounts or len(point) < len(self.__mounts[uuid])):
+          self.__mounts[uuid] = point
+      return
+    devices = readByUUID( self.by_uuid )
+    byDev   = {dev : uuid for uuid, (dev, _) in devices.items()}
+    byPath  = {path : uuid for uuid, (_, path) in devices.items()}
+    for dev, point, source in mounts:
+      uuid = byDev.get( dev, None )
+      if uuid is None and source.startswith( '/dev/' ):                         # Anonymous device number; e.g., btrfs
+        uuid = byPath.get( os.path.realpath( source ), None )
+      if uuid is None: continue
+      self.__uuids[dev] = uuid
+      if uuid not in self.__mounts or len(point) < len(self.__mounts[uuid]):    # Shortest of several mounts
+        self.__mounts[uuid] = point
+    self.log.debug( 'Device cache updated; {} file systems mounted'.format(len(self.__mounts)) )
+
+DEVICES = deviceCache()
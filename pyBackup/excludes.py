@@ -0,0 +1,337 @@
+import logging;
+
+import os, re, json, time;
+
+from . import APPDIR, utils
+
+FILTER    = '.exclude.filter';                                                  # Compiled rsync filter file in the backup directory; hidden, so not a backup
+TAGGED    = os.path.join( APPDIR, 'tagged.json' );                              # Directories found to hold a cache tag or marker file, by source directory
+CACHE_TAG = 'CACHEDIR.TAG'
+SIGNATURE = b'Signature: 8a477f597d28d172789f06886806bc55';                     # First bytes of a valid CACHEDIR.TAG; see bford.info/cachedir
+CACHES    = ['.cache/', '__pycache__/', 'Library/Caches/', 'Cache/', 'Code Cache/', 'GPUCache/',
+             'ShaderCache/', '.npm/_cacache/', '.gradle/caches/'];                   # Browser and tool caches; suggested, only excluded if added to cache_excludes
+MARKERS   = ['.nobackup'];                                                      # Default exclude_markers
+REASONS   = {'known' : 'known cache', 'name' : 'cache-like name', 'churn' : 'high churn'}
+HINTS     = re.compile( r'(^|[._ -])(cache|caches|cached|tmp|temp|build|builds|dist|target|'
+                        r'node_modules|__pycache__|logs?|thumbnails|trash|\.?venv)([._ -]|$)', re.I )
+
+def translate( pattern ):
+  '''
+  Purpose:
+    Function to convert an rsync exclude pattern to a regular
+    expression matching paths relative to the transfer root. As for
+    rsync, a pattern starting with / is anchored at the root and
+    others match the end of a path; * and ? do not match /, ** does.
+    A match of a directory excludes everything below it, so any
+    ancestor of a path may match.
+  Inputs:
+    pattern : rsync exclude pattern
+  Outputs:
+    Returns regular expression source
+  '''
+  body = pattern.strip('/')
+  out  = []
+  i    = 0
+  while i < len(body):
+    c = body[i]
+    if body.startswith( '**', i ):
+      out.append( '.*' )
+      i += 2
+      continue
+    if c == '\\' and i + 1 < len(body):
+      out.append( re.escape( body[i+1] ) )
+      i += 2
+      continue
+    if c == '*':
+      out.append( '[^/]*' )
+    elif c == '?':
+      out.append( '[^/]' )
+    elif c == '[' and ']' in body[i+2:]:
+      j = body.index( ']', i + 2 )
+      out.append( '[' + body[i+1:j].replace( '\\', '\\\\' ) + ']' )
+      i = j
+    else:
+      out.append( re.escape( c ) )
+    i += 1
+  return ('^' if pattern.startswith('/') else '(?:^|/)') + ''.join( out ) + '(?:/|$)'
+
+def escape( path ):
+  '''Return rsync pattern matching path literally'''
+  return re.sub( r'([*?\[\\])', r'\\\1', path )
+
+def isTagged( path, names = None, markers = (), caches = True ):
+  '''
+  Purpose:
+    Function to check whether a directory is marked to be left out of
+    backups: it holds a CACHEDIR.TAG with the standard signature, or
+    any of the marker files
+  Inputs:
+    path    : Directory path, str or bytes
+  Keywords:
+    names   : Names in the directory, if already listed; saves a stat
+               for each marker
+    markers : Names of marker files
+    caches  : If True, CACHEDIR.TAG is honoured
+  Outputs:
+    Returns name of the tag or marker, or None
+  '''
+  path = os.fsdecode( path )
+  if names is not None: names = set( os.fsdecode(n) for n in names )
+  for marker in markers:
+    if names is not None and marker not in names: continue
+    if os.path.lexists( os.path.join( path, marker ) ): return marker
+  if caches and (names is None or CACHE_TAG in names):
+    try:
+      with open( os.path.join( path, CACHE_TAG ), 'rb' ) as fid:
+        if fid.read( len(SIGNATURE) ) == SIGNATURE: return CACHE_TAG
+    except OSError:
+      pass
+  return None
+
+class excludeFilter( object ):
+  def __init__(self, src_dir, patterns = None, mounts = (), log = None):
+    '''
+    Purpose:
+      Class for the excludes of a backup, compiled once: the exclude
+      and user_exclude patterns and cache_excludes of the config, the
+      mount points of backup disks, and directories holding a
+      CACHEDIR.TAG (if exclude_caches is set) or one of the
+      exclude_markers files. It writes them to one rsync filter file,
+      instead of an --exclude argument each, and matches paths with
+      one regular expression for the backends and move detection,
+      which walk the source themselves.
+    Inputs:
+      src_dir  : Directory to back up
+    Keywords:
+      patterns : rsync exclude patterns; default from config
+      mounts   : Mount points of backup disks; never backed up
+      log      : Logger to use
+    '''
+    super().__init__();
+    self.log      = log or logging.getLogger(__name__);
+    self.src_dir  = src_dir;
+    self.root     = os.path.dirname( src_dir.rstrip(os.sep) ) or os.sep;       # Anchored patterns are relative to this; see rsyncPool
+    if patterns is None:
+      patterns = (utils.CONFIG['exclude'] + utils.CONFIG['user_exclude'] +
+                  utils.CONFIG.get('cache_excludes', []))
+    self.patterns = [ p for p in patterns if p and '\n' not in p ];
+    self.mounts   = list( mounts );
+    self.markers  = utils.CONFIG.get('exclude_markers', MARKERS);
+    self.caches   = utils.CONFIG.get('exclude_caches', True);
+    self.tagged   = [];                                                         # Tagged directories, relative to root
+    self.__regex  = None;
+
+  ##############################################################################
+  def __call__(self, path):
+    return self.excluded( path )
+
+  ##############################################################################
+  def excluded(self, path):
+    '''
+    Purpose:
+      Method to check whether a path is excluded
+    Inputs:
+      path : Absolute path, str or bytes
+    Outputs:
+      Returns True if the path, or a directory above it, is excluded
+    '''
+    if self.__regex is None: self.__compile()
+    path = os.fsdecode( path )
+    if any( path == m or path.startswith( m.rstrip(os.sep) + os.sep ) for m in self.mounts ): return True
+    rel  = os.path.relpath( path, self.root )
+    if rel.startswith( os.pardir ): return False
+    return self.__regex.search( rel.replace( os.sep, '/' ) ) is not None
+
+  ##############################################################################
+  def tag(self, path, names = None):
+    '''
+    Purpose:
+      Method to check a directory for a cache tag or marker file, for
+      backends that list the source themselves; a tagged directory is
+      remembered for rsync backups
+    Inputs:
+      path  : Directory path, str or bytes
+    Keywords:
+      names : Names in the directory, if already listed
+    Outputs:
+      Returns True if the directory is tagged
+    '''
+    if not self.markers and not self.caches: return False
+    if not isTagged( path, names, self.markers, self.caches ): return False
+    rel = os.path.relpath( os.fsdecode( path ), self.root )
+    if rel not in self.tagged:
+      self.tagged.append( rel )
+      self.__regex = None
+    return True
+
+  ##############################################################################
+  def discover(self, catalog = None):
+    '''
+    Purpose:
+      Method to find tagged directories without walking the source:
+      the ones found before, and directories whose cache tag or
+      marker file is in the catalog, i.e., was backed up. Each is
+      checked on the source, so a removed tag stops excluding its
+      directory. A new tag is found by the backup after the one that
+      copied it.
+    Keywords:
+      catalog : snapshotCatalog of the backup directory
+    Outputs:
+      Returns list of tagged directories, relative to the root
+    '''
+    names = list( self.markers ) + ([CACHE_TAG] if self.caches else [])
+    if not names: return []
+    found = set( loadTagged().get( self.src_dir, [] ) )
+    if catalog is not None:
+      for path in catalog.named( names ):
+        found.add( os.path.dirname( os.fsdecode( path ) ) )
+    tagged = []
+    for rel in sorted( found ):
+      if rel and not self.__below( rel, tagged ) and isTagged( os.path.join( self.root, rel ),
+          markers = self.markers, caches = self.caches ):
+        tagged.append( rel )
+    self.tagged  = tagged
+    self.__regex = None
+    saveTagged( self.src_dir, tagged )
+    if tagged: self.log.info( 'Excluding {} tagged directories'.format(len(tagged)) )
+    return tagged
+
+  ##############################################################################
+  def rules(self):
+    '''Return list of rsync filter rules'''
+    rules = [ '- {}'.format(m) for m in self.mounts ]
+    rules.extend( '- {}'.format(p) for p in self.patterns )
+    rules.extend( '- /{}/*'.format( escape( rel ) ) for rel in self.tagged );    # The directory is kept, empty
+    return rules
+
+  ##############################################################################
+  def write(self, path):
+    '''
+    Purpose:
+      Method to write the rules to a filter file, for rsync's
+      --filter='merge FILE'
+    Inputs:
+      path : Path of the filter file
+    Outputs:
+      Returns path
+    '''
+    tmp = path + '.tmp'
+    with open( tmp, 'w', encoding = 'utf8', errors = 'surrogateescape' ) as fid:
+      fid.write( '# Written by pyBackup {}; changes are overwritten\n'.format( time.strftime('%Y-%m-%dT%H:%M:%S') ) )
+      fid.write( '\n'.join( self.rules() ) + '\n' )
+    os.replace( tmp, path )
+    return path
+
+  ##############################################################################
+  def __below(self, rel, tagged):
+    '''Private method; True if rel is inside one of the tagged directories'''
+    return any( rel.startswith( t + os.sep ) for t in tagged )
+
+  ##############################################################################
+  def __compile(self):
+    '''Private method to compile all patterns to one regular expression'''
+    parts = [ translate( p ) for p in self.patterns ]
+    parts.extend( translate( '/' + escape( rel ) + '/*' ) for rel in self.tagged )
+    self.__regex = re.compile( '|'.join( parts ) ) if parts else re.compile( '(?!)' )
+
+def loadTagged( path = TAGGED ):
+  '''Return dictionary of source directory: list of tagged directories'''
+  try:
+    with open( path, 'r' ) as fid:
+      return json.load( fid )
+  except (OSError, ValueError):
+    return {}
+
+def saveTagged( src_dir, tagged, path = TAGGED ):
+  '''Record the tagged directories of a source directory; only written if they changed'''
+  data = loadTagged( path )
+  if data.get( src_dir, [] ) == tagged: return
+  data[src_dir] = tagged
+  tmp = path + '.tmp'
+  with open( tmp, 'w' ) as fid:
+    json.dump( data, fid )
+  os.replace( tmp, path )
+
+def suggest( backup_dir, src_dir = '/', runs = 10, min_size = 100 * 1024**2, log = None ):
+  '''
+  Purpose:
+    Function to suggest excludes from the transfer logs of recent
+    backups (see transferLog). Bytes written to new and updated files
+    are summed for each directory, over the last runs backups. A
+    directory is suggested if it is a well-known cache directory (see
+    CACHES) that changed in any of the runs; if its name says it holds
+    caches, build outputs, logs, or the like (see HINTS) and it changed
+    in at least half of the runs; or if it changed in at least 80% of
+    the runs and took at least min_size bytes per run. Directories
+    already excluded are left out. The time saved is estimated from the median transfer
+    rate in the run history.
+  Inputs:
+    backup_dir : Backup directory
+  Keywords:
+    src_dir    : Directory backed up
+    runs       : Number of recent backups to look at
+    min_size   : Bytes per run for a directory to count as high churn
+    log        : Logger to use
+  Outputs:
+    Returns list of dictionaries with 'path', 'pattern', 'reason',
+    'runs', 'files_per_run', 'bytes_per_run', and 'seconds_per_run'
+    keys, sorted by bytes_per_run
+  '''
+  from .transferLog import TRANSFERS, SUFFIX, readLog
+  from .metrics import readHistory, percentile
+
+  log   = log or logging.getLogger(__name__)
+  known = re.compile( '|'.join( translate( p ) for p in CACHES ) )
+  try:
+    names = sorted( n for n in os.listdir( os.path.join( backup_dir, TRANSFERS ) ) if n.endswith( SUFFIX ) )
+  except OSError:
+    names = []
+  names = names[-runs:]
+  if not names: return []
+  dirs  = {}
+  for i, name in enumerate( names ):
+    try:
+      for record in readLog( os.path.join( backup_dir, TRANSFERS, name ) ):
+        if record.get('action') not in ('new', 'updated'): continue
+        parts  = record['path'].rstrip('/').split('/')[:-1]
+        key, reason = None, 'churn'
+        for j, part in enumerate( parts ):                                     # Outermost directory named like a cache
+          sub = '/'.join( parts[:j+1] )
+          if known.search( sub ):
+            key, reason = sub, 'known'
+            break
+          if HINTS.search( part ):
+            key, reason = sub, 'name'
+            break
+        if key is None: key = '/'.join( parts )
+        if not key: continue
+        info = dirs.setdefault( key, {'reason' : reason, 'runs' : set(), 'files' : 0, 'bytes' : 0} )
+        info['runs'].add( i )
+        info['files'] += 1
+        info['bytes'] += record.get('size') or 0
+    except (OSError, EOFError) as err:
+      log.warning( 'Failed to read transfer log {}: {}'.format(name, err) )
+
+  rate   = percentile( [r.get('bytes_per_second') or None for r in readHistory( last = 50 )], 50 )
+  filt   = excludeFilter( src_dir )
+  filt.discover()
+  nruns  = len( names )
+  out    = []
+  for key, info in dirs.items():
+    changed = len( info['runs'] ) / nruns
+    perRun  = info['bytes'] / nruns
+    if info['reason'] == 'name':
+      if changed < 0.5: continue
+    elif info['reason'] == 'churn' and (changed < 0.8 or perRun < min_size):
+      continue
+    path = os.path.join( filt.root, key )
+    if filt.excluded( path ): continue
+    out.append( {'path'            : path,
+                 'pattern'         : '/' + escape( key ) + '/',
+                 'reason'          : REASONS[ info['reason'] ],
+                 'runs'            : len( info['runs'] ),
+                 'files_per_run'   : info['files'] / nruns,
+                 'bytes_per_run'   : perRun,
+                 'seconds_per_run' : perRun / rate if rate else None} )
+  out.sort( key = lambda s: -s['bytes_per_run'] )
+  return out
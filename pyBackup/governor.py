@@ -0,0 +1,295 @@
+import logging;
+
+import os, sys, glob, time, signal, ctypes, platform;
+from threading import Thread, Event, Lock;
+
+from . import utils
+
+GOVERNOR = {'enabled'           : True,
+            'nice'              : 10,                                           # Niceness of rsync and the reaper
+            'ionice'            : True,                                         # Idle I/O class for rsync and the reaper; Linux only
+            'interval'          : 1.0,                                          # Seconds between samples
+            'max_bwlimit'       : 0,                                            # rsync --bwlimit in KiB/s; zero for none
+            'battery_bwlimit'   : 10240,                                        # --bwlimit while on battery
+            'full_speed_on_ac'  : True,                                         # No --bwlimit while on AC power and the system is idle
+            'idle_io_pressure'  : 2.0,                                          # Below this the system counts as idle
+            'io_pressure'       : 20.0,                                         # Percent of time some tasks stall on I/O (avg10) that counts as busy
+            'cpu_pressure'      : 50.0,                                         # Same for CPU
+            'disk_busy'         : 80.0,                                         # Percent busy time of the backup disk that counts as busy
+            'load'              : 1.5,                                          # Load average per CPU that counts as busy
+            'pause_io_pressure' : 60.0,                                         # I/O pressure at which the backup is paused
+            'max_pause'         : 30.0,                                         # Seconds of pauses in a row; then it runs at min_duty until the system is calm
+            'min_duty'          : 0.1}                                          # Smallest fraction of time the backup runs while busy
+
+IOPRIO_CLASS_IDLE  = 3
+IOPRIO_WHO_PROCESS = 1
+SYS_IOPRIO_SET     = {'x86_64' : 251, 'aarch64' : 30, 'i686' : 289, 'i386' : 289,
+                      'armv7l' : 314, 'ppc64le' : 273, 's390x' : 282}
+
+def settings():
+  '''Return the governor settings of the config merged over the defaults'''
+  return dict( GOVERNOR, **(utils.CONFIG.get('governor', None) or {}) )
+
+def setIdleIO( tid = 0 ):
+  '''Put a process or thread (zero for the caller) in the idle I/O class; returns True on success'''
+  number = SYS_IOPRIO_SET.get( platform.machine(), None )
+  if not sys.platform.startswith('linux') or number is None: return False
+  try:
+    libc = ctypes.CDLL( None, use_errno = True )
+    return libc.syscall( number, IOPRIO_WHO_PROCESS, tid, IOPRIO_CLASS_IDLE << 13 ) == 0
+  except (OSError, AttributeError):
+    return False
+
+def lowerPriority( nice, ionice = True ):
+  '''Lower the CPU and I/O priority of the calling process; e.g., in a worker process'''
+  try:
+    os.nice( nice )
+  except OSError:
+    pass
+  if ionice: setIdleIO()
+
+def readPressure( resource ):
+  '''Return the avg10 of 'some' in /proc/pressure/<resource>, or None if unavailable'''
+  try:
+    with open( os.path.join( '/proc/pressure', resource ) ) as fid:
+      for line in fid:
+        if line.startswith('some'):
+          return float( line.split()[1].split('=')[1] )
+  except (OSError, IndexError, ValueError):
+    pass
+  return None
+
+def diskTicks( dev ):
+  '''Return milliseconds spent doing I/O by the block device with st_dev dev, or None'''
+  if dev is None: return None
+  major, minor = os.major( dev ), os.minor( dev )
+  try:
+    with open( '/proc/diskstats' ) as fid:
+      for line in fid:
+        cols = line.split()
+        if int(cols[0]) == major and int(cols[1]) == minor:
+          return int( cols[12] )
+  except (OSError, IndexError, ValueError):
+    pass
+  return None
+
+def onAC():
+  '''Return True on AC power, False on battery, and None if there is no battery'''
+  battery = False
+  for supply in glob.glob( '/sys/class/power_supply/*' ):
+    try:
+      with open( os.path.join( supply, 'type' ) ) as fid:
+        kind = fid.read().strip()
+      if kind == 'Mains':
+        with open( os.path.join( supply, 'online' ) ) as fid:
+          if fid.read().strip() == '1': return True
+      elif kind == 'Battery':
+        battery = True
+    except OSError:
+      continue
+  return False if battery else None
+
+class resourceGovernor( object ):
+  def __init__(self, path = None, config = None, log = None):
+    '''
+    Purpose:
+      Class to keep backups from hurting the responsiveness of the
+      system. rsync runs niced and in the idle I/O class, and with a
+      --bwlimit ceiling unless on AC power and idle. A monitor thread
+      samples CPU and I/O pressure (/proc/pressure), the load average,
+      and the busy time of the backup disk (/proc/diskstats) every
+      interval seconds, and adjusts the fraction of time the backup
+      runs: halved while the system is busy, raised again while it is
+      not, and zero, i.e., paused, while I/O pressure is severe. rsync
+      is duty cycled with SIGSTOP and SIGCONT, as its --bwlimit cannot
+      be changed while it runs, and deletion threads wait in wait().
+      Decisions are counted in stats, for the run metrics.
+    Inputs:
+      None.
+    Keywords:
+      path   : Path on the backup disk; its device is watched
+      config : Settings; default is settings()
+      log    : Logger to use
+    '''
+    super().__init__();
+    self.log      = log or logging.getLogger(__name__);
+    self.config   = config or settings();
+    self.enabled  = bool( self.config['enabled'] );
+    self.duty     = 1.0;                                                        # Fraction of time the backup runs
+    self.level    = 'full';                                                     # One of full, throttled, or paused
+    self.stats    = {'governor_throttled_s' : 0.0, 'governor_paused_s' : 0.0,
+                     'governor_changes' : 0, 'governor_min_duty' : 1.0};
+    self.__dev    = None
+    if path:
+      try:
+        self.__dev = os.stat( path ).st_dev
+      except OSError:
+        pass
+    self.__procs  = set();                                                      # Processes that are duty cycled
+    self.__lock   = Lock();
+    self.__run    = Event();                                                    # Set while the backup may run
+    self.__run.set()
+    self.__stop   = Event();
+    self.__thread = None;
+    self.__ticks  = None;                                                       # Last (time, disk ticks) sample
+    self.__paused = 0.0;                                                        # Seconds paused in a row
+
+  ##############################################################################
+  def start(self):
+    '''Start the monitor thread'''
+    if not self.enabled or self.__thread: return
+    self.__stop.clear()
+    self.__thread = Thread( target = self.__monitor, daemon = True )
+    self.__thread.start()
+
+  ##############################################################################
+  def stop(self):
+    '''Stop the monitor thread and let everything run'''
+    self.__stop.set()
+    if self.__thread: self.__thread.join()
+    self.__thread = None
+    self.__resume()
+
+  ##############################################################################
+  def bwlimit(self):
+    '''Return --bwlimit, in KiB/s, for an rsync started now; zero for none'''
+    if not self.enabled: return 0
+    ac = onAC()
+    if ac is False: return self.config['battery_bwlimit']
+    if self.config['full_speed_on_ac'] and self.__idle(): return 0
+    return self.config['max_bwlimit']
+
+  ##############################################################################
+  def preexec(self):
+    '''
+    Lower the priority of a child process; passed to Popen as preexec_fn.
+    The child gets a process group of its own, so the processes rsync
+    forks are stopped along with it.
+    '''
+    os.setpgid( 0, 0 )
+    if self.enabled: lowerPriority( self.config['nice'], self.config['ionice'] )
+
+  ##############################################################################
+  def lowerThread(self, tid):
+    '''Lower the I/O priority of a thread, e.g., of the trash reaper'''
+    if self.enabled and self.config['ionice']: setIdleIO( tid )
+
+  ##############################################################################
+  def watch(self, proc):
+    '''Duty cycle a process'''
+    with self.__lock:
+      self.__procs.add( proc )
+      if not self.__run.is_set(): self.__signal( proc, signal.SIGSTOP )
+
+  ##############################################################################
+  def unwatch(self, proc):
+    with self.__lock:
+      self.__procs.discard( proc )
+    self.__signal( proc, signal.SIGCONT )
+
+  ##############################################################################
+  def wait(self, timeout = None):
+    '''Block while the backup is stopped; cheap when it is not'''
+    if not self.__run.is_set(): self.__run.wait( timeout )
+
+  ##############################################################################
+  def sample(self):
+    '''
+    Purpose:
+      Method to measure how busy the system is
+    Inputs:
+      None.
+    Outputs:
+      Returns dictionary with io and cpu pressure, load per CPU, and
+      busy percent of the backup disk; None where unknown
+    '''
+    now   = time.monotonic()
+    ticks = diskTicks( self.__dev )
+    busy  = None
+    if ticks is not None and self.__ticks is not None and now > self.__ticks[0]:
+      busy = min( 100.0, (ticks - self.__ticks[1]) / (now - self.__ticks[0]) / 10.0 )
+    self.__ticks = (now, ticks) if ticks is not None else None
+    try:
+      load = os.getloadavg()[0] / (os.cpu_count() or 1)
+    except OSError:
+      load = None
+    return {'io' : readPressure('io'), 'cpu' : readPressure('cpu'), 'load' : load, 'busy' : busy}
+
+  ##############################################################################
+  def decide(self, sample):
+    '''
+    Purpose:
+      Method to adjust the duty cycle to a sample
+    Inputs:
+      sample : Dictionary returned by sample()
+    Outputs:
+      Returns the new duty cycle
+    '''
+    cfg   = self.config
+    def over( key, limit ):
+      return sample[key] is not None and sample[key] >= limit
+    if over( 'io', cfg['pause_io_pressure'] ) and self.__paused < cfg['max_pause']:
+      duty = 0.0
+    elif (over( 'io', cfg['io_pressure'] ) or over( 'cpu', cfg['cpu_pressure'] ) or
+          over( 'busy', cfg['disk_busy'] ) or over( 'load', cfg['load'] )):
+      duty = max( (self.duty or cfg['min_duty']) / 2.0, cfg['min_duty'] )
+    else:
+      duty = min( self.duty + 0.25, 1.0 )
+    level = 'paused' if duty == 0 else 'full' if duty >= 1.0 else 'throttled'
+    if level != self.level:
+      self.log.info( 'Governor: {} (duty {:.0%}); {}'.format( level, duty,
+        ', '.join( '{} {:.1f}'.format(k, v) for k, v in sample.items() if v is not None ) ) )
+      self.stats['governor_changes'] += 1
+    self.level = level
+    self.duty  = duty
+    self.stats['governor_min_duty'] = min( self.stats['governor_min_duty'], duty )
+    return duty
+
+  ##############################################################################
+  def __idle(self):
+    io = readPressure('io')
+    return io is None or io < self.config['idle_io_pressure']
+
+  ##############################################################################
+  def __monitor(self):
+    '''Private method of the monitor thread'''
+    interval = self.config['interval']
+    while not self.__stop.is_set():
+      duty = self.decide( self.sample() )
+      if duty >= 1.0:
+        self.__paused = 0.0
+        self.__stop.wait( interval )
+        continue
+      if duty > 0:
+        self.__stop.wait( interval * duty )
+      if self.__stop.is_set(): break
+      self.__pause()
+      self.__stop.wait( interval * (1.0 - duty) )
+      self.__resume()
+      key = 'governor_paused_s' if duty == 0 else 'governor_throttled_s'
+      self.stats[key] += interval * (1.0 - duty)
+      if duty == 0: self.__paused += interval
+
+  ##############################################################################
+  def __pause(self):
+    with self.__lock:
+      self.__run.clear()
+      for proc in self.__procs: self.__signal( proc, signal.SIGSTOP )
+
+  ##############################################################################
+  def __resume(self):
+    with self.__lock:
+      for proc in self.__procs: self.__signal( proc, signal.SIGCONT )
+      self.__run.set()
+
+  ##############################################################################
+  def __signal(self, proc, sig):
+    '''Private method to signal the process group of a process'''
+    if proc.poll() is not None: return
+    try:
+      if os.getpgid( proc.pid ) == proc.pid:
+        os.killpg( proc.pid, sig )
+      else:
+        proc.send_signal( sig )
+    except OSError:
+      pass
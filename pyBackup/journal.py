@@ -0,0 +1,587 @@
+import logging;
+
+import os, json, time, fcntl, errno, select, signal, struct, hashlib;
+import ctypes, ctypes.util;
+from contextlib import contextmanager;
+
+from . import APPDIR
+from .excludes import excludeFilter
+
+JOURNALDIR     = os.path.join( APPDIR, 'journal' )                              # Directory with watcher state and journal files
+STATE          = 'state.json'                                                   # Written by the watcher; generation and readiness
+LOCK           = 'watcher.lock'                                                 # Held by the running watcher
+CHANGES        = 'changes.log'                                                  # Changes recorded since the last backup started
+CONSUME        = 'changes.consume'                                              # Changes being backed up
+ROTATE         = 'changes.lock'                                                 # Held while appending to or taking the changes
+COMMITTED      = 'committed.json'                                               # Generation and mounts of the last successful backup
+MOUNTINFO      = '/proc/self/mountinfo'
+
+DIR            = b'd'                                                           # Contents or metadata of a directory changed
+TREE           = b'r'                                                           # New directory; whole tree must be copied
+FILE           = b'f'                                                           # Data or metadata of a file changed
+OVERFLOW       = b'O'                                                           # Events were lost; journal is incomplete
+MOUNTS         = b'M'                                                           # Mounts below the source directory changed
+TIME           = b'T'                                                           # Time the following records were written
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = os.O_NONBLOCK
+IN_CLOEXEC     = getattr(os, 'O_CLOEXEC', 0o2000000)
+WATCH_MASK     = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+EVENT          = struct.Struct( 'iIII' )                                        # wd, mask, cookie, len of struct inotify_event
+
+def isUnder( path, top ):
+  '''Return True if bytes path is top or inside top'''
+  return top == b'/' or path == top or path.startswith( top + b'/' )
+
+@contextmanager
+def changesLock( journal_dir ):
+  '''
+  Purpose:
+    Context manager holding the lock on the changes file; the
+    watcher appends to the file, and a backup takes it, only while
+    holding it, so no records are written to a file being taken
+  Inputs:
+    journal_dir : Journal directory
+  '''
+  fd = os.open( os.path.join(journal_dir, ROTATE), os.O_RDWR | os.O_CREAT, 0o644 )
+  try:
+    fcntl.flock( fd, fcntl.LOCK_EX )
+    yield
+  finally:
+    os.close( fd );                                                             # Also releases the lock
+
+def mountFingerprint( src_dir, excluded = None ):
+  '''
+  Purpose:
+    Function to compute a fingerprint of the mounts at or below the
+    source directory; it changes when anything is mounted, unmounted,
+    or replaced there
+  Inputs:
+    src_dir  : Directory being backed up
+  Keywords:
+    excluded : Function returning True for excluded paths; mounts in
+                excluded directories are ignored
+  Outputs:
+    Returns hex digest, or None if mount information is unavailable
+  '''
+  top = os.fsencode( src_dir.rstrip(os.sep) or os.sep )
+  try:
+    with open( MOUNTINFO, 'rb' ) as fid:
+      lines = fid.read().splitlines()
+  except OSError:
+    return None
+  mounts = []
+  for line in lines:
+    pre, _, post = line.partition( b' - ' )
+    fields = pre.split()
+    if len(fields) < 5: continue
+    point  = fields[4].decode('unicode_escape').encode('latin-1')              # Mount points have octal escapes; e.g., \040
+    if not isUnder( point, top ): continue
+    if excluded and excluded( point ): continue
+    mounts.append( b' '.join( [point, fields[2], fields[3]] + post.split()[:2] ) )
+  return hashlib.sha1( b'\n'.join( sorted(mounts) ) ).hexdigest()
+
+def readState( journal_dir = JOURNALDIR ):
+  '''
+  Purpose:
+    Function to read the state of the watcher
+  Keywords:
+    journal_dir : Journal directory
+  Outputs:
+    Returns state dictionary, or None if no watcher is running
+  '''
+  try:
+    fd = os.open( os.path.join(journal_dir, LOCK), os.O_RDONLY )
+  except OSError:
+    return None
+  try:
+    fcntl.flock( fd, fcntl.LOCK_SH | fcntl.LOCK_NB )                             # Only succeeds if the watcher is NOT holding the lock
+  except OSError as err:
+    if err.errno not in (errno.EWOULDBLOCK, errno.EAGAIN): return None
+  else:
+    return None
+  finally:
+    os.close( fd )
+  try:
+    with open( os.path.join(journal_dir, STATE), 'r' ) as fid:
+      return json.load( fid )
+  except (OSError, ValueError):
+    return None
+
+def writeJSON( path, data ):
+  '''Write data to a JSON file atomically'''
+  tmp = path + '.tmp'
+  with open( tmp, 'w' ) as fid:
+    json.dump( data, fid )
+  os.replace( tmp, path )
+
+def changesPending( src_dir, excludes = None, journal_dir = JOURNALDIR ):
+  '''
+  Purpose:
+    Function to check, without taking them, whether changes were
+    recorded since the last successful backup; see changeJournal
+  Inputs:
+    src_dir     : Directory being backed up
+  Keywords:
+    excludes    : rsync exclude patterns; default from config
+    journal_dir : Journal directory
+  Outputs:
+    Returns False if the journal can be trusted and holds no changes,
+    True if it holds changes, and None if it can not be trusted, so
+    a full scan is needed
+  '''
+  state = readState( journal_dir )
+  if state is None or state.get('src_dir') != src_dir or not state.get('ready'): return None
+  try:
+    with open( os.path.join(journal_dir, COMMITTED), 'r' ) as fid:
+      committed = json.load( fid )
+  except (OSError, ValueError):
+    return None
+  if committed.get('generation') != state['generation']: return None
+  for name in (CHANGES, CONSUME):
+    try:
+      if os.path.getsize( os.path.join(journal_dir, name) ) > 0: return True
+    except OSError:
+      pass
+  mounts = mountFingerprint( src_dir, excludeFilter( src_dir, patterns = excludes ) )
+  if mounts is None or committed.get('mounts') != mounts: return None
+  return False
+
+class inotify( object ):
+  '''Minimal ctypes wrapper around the Linux inotify API'''
+  def __init__(self):
+    libc = ctypes.CDLL( ctypes.util.find_library('c'), use_errno = True )
+    self.__add = libc.inotify_add_watch
+    self.__add.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    self.__rm  = libc.inotify_rm_watch
+    self.__rm.argtypes  = [ctypes.c_int, ctypes.c_int]
+    self.fd    = libc.inotify_init1( IN_NONBLOCK | IN_CLOEXEC )
+    if self.fd < 0:
+      err = ctypes.get_errno()
+      raise OSError( err, os.strerror(err) )
+  def addWatch(self, path, mask = WATCH_MASK):
+    wd = self.__add( self.fd, path, mask )
+    if wd < 0:
+      err = ctypes.get_errno()
+      raise OSError( err, os.strerror(err), path )
+    return wd
+  def rmWatch(self, wd):
+    self.__rm( self.fd, wd )
+  def read(self):
+    '''Return list of (wd, mask, cookie, name) tuples; empty if none are ready'''
+    try:
+      data = os.read( self.fd, 256 * 1024 )
+    except BlockingIOError:
+      return []
+    events = []
+    offset = 0
+    while offset < len(data):
+      wd, mask, cookie, size = EVENT.unpack_from( data, offset )
+      offset += EVENT.size
+      events.append( (wd, mask, cookie, data[offset:offset+size].rstrip(b'\0')) )
+      offset += size
+    return events
+  def close(self):
+    os.close( self.fd )
+
+class journalWatcher( object ):
+  def __init__(self, src_dir = '/', excludes = None, journal_dir = JOURNALDIR,
+                flush = 5.0, log = None):
+    '''
+    Purpose:
+      Class for the watcher daemon that records what changed below
+      the source directory between backups. Every directory gets an
+      inotify watch; events are reduced to a set of changed files,
+      changed directories, and new directory trees, which is appended
+      to a compact journal every few seconds. Queue overflows, failing
+      to add a watch, and changes to the mounts below the source are
+      recorded too, so the next backup falls back to a full scan.
+    Inputs:
+      None.
+    Keywords:
+      src_dir     : Directory to watch
+      excludes    : rsync exclude patterns; excluded directories are
+                     not watched. Default from config
+      journal_dir : Directory to write the journal to
+      flush       : Seconds between writes of the journal
+      log         : Logger to use
+    '''
+    super().__init__();
+    self.log         = log or logging.getLogger(__name__);
+    self.src_dir     = src_dir;
+    self.top         = os.fsencode( src_dir.rstrip(os.sep) or os.sep );
+    self.excluded    = excludeFilter( src_dir, patterns = excludes, log = self.log );
+    self.journal_dir = journal_dir;
+    self.flush       = flush;
+    self.state       = {};
+    self.__wds       = {};                                                      # Path of each watch descriptor
+    self.__records   = set();                                                   # Records not yet written to the journal
+    self.__moves     = {};                                                      # Directories moved away, by cookie
+    self.__mounts    = None;                                                    # Fingerprint of mounts below the source
+    self.__running   = False;
+    self.__inotify   = None;
+
+  ##############################################################################
+  def stop(self, *args):
+    self.__running = False
+
+  ##############################################################################
+  def run(self):
+    '''
+    Purpose:
+      Method to run the watcher until it is stopped or signaled
+    Inputs:
+      None.
+    Outputs:
+      Returns exit code
+    '''
+    os.makedirs( self.journal_dir, exist_ok = True )
+    lock = os.open( os.path.join(self.journal_dir, LOCK), os.O_RDWR | os.O_CREAT, 0o644 )
+    try:
+      fcntl.flock( lock, fcntl.LOCK_EX | fcntl.LOCK_NB )
+    except OSError:
+      self.log.error( 'Another watcher is already running' )
+      os.close( lock )
+      return 1
+    for sig in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP]:
+      signal.signal( sig, self.stop )
+
+    try:
+      with open( '/proc/sys/kernel/random/boot_id', 'r' ) as fid:
+        boot = fid.read().strip()
+    except OSError:
+      boot = ''
+    self.state = {'generation' : '{}-{}-{}'.format(boot, os.getpid(), time.time_ns()),
+                  'src_dir'    : self.src_dir,
+                  'pid'        : os.getpid(),
+                  'ready'      : False}
+    self.__writeState()
+    self.__inotify = inotify()
+    mounts         = open( MOUNTINFO, 'rb' ) if os.path.exists( MOUNTINFO ) else None
+    poller         = select.poll()
+    poller.register( self.__inotify.fd, select.POLLIN )
+    if mounts: poller.register( mounts, select.POLLPRI | select.POLLERR );      # mountinfo signals changes with POLLPRI
+    self.__running = True
+    self.__mounts  = mountFingerprint( self.src_dir, self.excluded )
+    self.__rewalk()
+    last = time.monotonic()
+    try:
+      while self.__running:
+        for fd, event in poller.poll( self.flush * 1000 ):
+          if fd == self.__inotify.fd:
+            self.__handle( self.__inotify.read() )
+          elif mounts and fd == mounts.fileno():
+            mounts.seek( 0 ); mounts.read()
+            fingerprint = mountFingerprint( self.src_dir, self.excluded )
+            if fingerprint != self.__mounts:                                    # Something was mounted or unmounted below the source
+              self.log.info( 'Mounts changed; rescanning' )
+              self.__mounts = fingerprint
+              self.__records.add( MOUNTS )
+              self.__rewalk()
+        if time.monotonic() - last >= self.flush:
+          self.__flush()
+          last = time.monotonic()
+    finally:
+      self.__flush()
+      self.__inotify.close()
+      if mounts: mounts.close()
+      os.close( lock )
+    return 0
+
+  ##############################################################################
+  def __writeState(self):
+    writeJSON( os.path.join(self.journal_dir, STATE), self.state )
+
+  ##############################################################################
+  def __rewalk(self):
+    '''Add watches to every directory below the source; readiness is cleared meanwhile'''
+    self.state['ready'] = False
+    self.__writeState()
+    t0 = time.monotonic()
+    self.__watchTree( self.top )
+    self.state['ready'] = True
+    self.__writeState()
+    self.log.info( 'Watching {} directories; took {:.1f} s'.format(len(self.__wds), time.monotonic()-t0) )
+
+  ##############################################################################
+  def __watchTree(self, top):
+    '''Add watches to top and all directories below it'''
+    stack = [top]
+    while stack and self.__running:
+      path = stack.pop()
+      if self.excluded( path ): continue
+      try:
+        wd = self.__inotify.addWatch( path )
+      except OSError as err:
+        if err.errno == errno.ENOSPC:                                           # Out of watches; journal cannot be complete
+          self.log.error( 'Out of inotify watches; raise fs.inotify.max_user_watches' )
+          self.__records.add( OVERFLOW )
+        continue
+      self.__wds[wd] = path
+      try:
+        with os.scandir( path ) as it:
+          for entry in it:
+            if entry.is_dir( follow_symlinks = False ):
+              stack.append( entry.path )
+      except OSError:
+        pass
+
+  ##############################################################################
+  def __handle(self, events):
+    '''
+    Purpose:
+      Private method to reduce inotify events to journal records
+    Inputs:
+      events : List of events from inotify.read()
+    Outputs:
+      None.
+    '''
+    records = self.__records
+    for wd, mask, cookie, name in events:
+      if mask & IN_Q_OVERFLOW:
+        self.log.warning( 'inotify queue overflowed' )
+        records.add( OVERFLOW )
+        continue
+      if mask & IN_IGNORED:                                                     # Watch removed; directory deleted or unmounted
+        self.__wds.pop( wd, None )
+        continue
+      parent = self.__wds.get( wd, None )
+      if parent is None: continue
+      if not name:                                                              # Event on the watched directory itself
+        records.add( DIR + parent )
+        continue
+      path = os.path.join( parent, name )
+      if self.excluded( path ): continue
+      if mask & IN_ISDIR:
+        records.add( DIR + parent )
+        if mask & IN_MOVED_FROM:
+          self.__moves[cookie] = path
+        elif mask & IN_MOVED_TO and cookie in self.__moves:
+          self.__rename( self.__moves.pop( cookie ), path )
+          records.add( TREE + path )
+        elif mask & (IN_CREATE | IN_MOVED_TO):
+          self.__watchTree( path );                                             # Watch first, then copy the whole tree
+          records.add( TREE + path )
+        elif mask & IN_ATTRIB:
+          records.add( DIR + path )
+      elif mask & (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE):
+        records.add( FILE + path )
+      else:                                                                     # Created, deleted, or moved
+        records.add( DIR + parent )
+    for cookie, path in self.__moves.items():                                   # Moved out of the watched tree
+      self.__forget( path )
+    self.__moves.clear()
+
+  ##############################################################################
+  def __rename(self, old, new):
+    '''Update paths of watches after a directory was moved'''
+    for wd, path in list( self.__wds.items() ):
+      if isUnder( path, old ):
+        self.__wds[wd] = new + path[len(old):]
+
+  ##############################################################################
+  def __forget(self, top):
+    '''Remove watches of a directory tree that left the watched tree'''
+    for wd, path in list( self.__wds.items() ):
+      if isUnder( path, top ):
+        self.__inotify.rmWatch( wd )
+        del self.__wds[wd]
+
+  ##############################################################################
+  def __flush(self):
+    '''Append pending records to the journal'''
+    if not self.__records: return
+    records, self.__records = self.__records, set()
+    with changesLock( self.journal_dir ), open( os.path.join(self.journal_dir, CHANGES), 'ab' ) as fid:
+      fid.write( TIME + str( int( time.time() ) ).encode() + b'\0' )
+      fid.write( b''.join( record + b'\0' for record in records ) )
+
+class journalChanges( object ):
+  def __init__(self, src_dir, records):
+    '''
+    Purpose:
+      Class holding the changes below the source directory since the
+      last backup, reduced so no path is covered twice
+    Inputs:
+      src_dir : Directory being backed up
+      records : Iterable of journal records
+    '''
+    super().__init__();
+    top        = os.fsencode( src_dir.rstrip(os.sep) or os.sep )
+    self.root  = os.fsencode( os.path.dirname( src_dir.rstrip(os.sep) ) or os.sep );
+    dirs, trees, files = set(), set(), set()
+    self.times = {};                                                            # Time each path was last recorded
+    stamp      = 0
+    for record in records:
+      kind, path = record[:1], record[1:]
+      if kind == TIME:
+        stamp = int( path )
+        continue
+      if not isUnder( path, top ): continue
+      self.times[path] = stamp
+      if kind == TREE:
+        trees.add( path )
+      elif kind == DIR:
+        dirs.add( path )
+      elif kind == FILE:
+        files.add( path )
+        dirs.add( os.path.dirname( path ) )
+    self.trees = []
+    for path in sorted( trees, key = lambda p: p.replace(b'/', b'\0') ):       # Children sort right after their parents
+      if not self.trees or not isUnder( path, self.trees[-1] ):
+        self.trees.append( path )
+    self.__set = set( self.trees )
+    self.dirs  = sorted( d for d in dirs if not self.__inTree( d ) )
+    self.files = sorted( files )
+
+  ##############################################################################
+  def __len__(self):
+    return len(self.dirs) + len(self.trees) + len(self.files)
+
+  ##############################################################################
+  def __inTree(self, path):
+    '''Return True if path is in one of the new trees'''
+    while True:
+      if path in self.__set: return True
+      parent = os.path.dirname( path )
+      if parent == path: return False
+      path = parent
+
+  ##############################################################################
+  def changedSince(self, top, stamp):
+    '''Return True if anything at or below bytes path top was recorded after stamp'''
+    return any( t >= stamp and isUnder( path, top ) for path, t in self.times.items() )
+
+  ##############################################################################
+  def relative(self, path):
+    '''Return path relative to the transfer root'''
+    return os.path.relpath( path, self.root )
+
+  ##############################################################################
+  def write(self, dirs_file, trees_file):
+    '''
+    Purpose:
+      Method to write NUL separated lists for rsync --files-from;
+      changed directories end in '/.' so only their contents are
+      copied, new trees are copied recursively
+    Inputs:
+      dirs_file  : Path of list of changed directories
+      trees_file : Path of list of new directory trees
+    Outputs:
+      Returns list of (path, recursive) tuples for non-empty lists
+    '''
+    lists = []
+    for path, items, recursive in [(dirs_file, self.dirs, False), (trees_file, self.trees, True)]:
+      if not items: continue
+      with open( path, 'wb' ) as fid:
+        for item in items:
+          rel = self.relative( item )
+          fid.write( (rel if recursive or rel == b'.' else rel + b'/.') + b'\0' )
+      lists.append( (path, recursive) )
+    return lists
+
+class changeJournal( object ):
+  def __init__(self, src_dir, excludes = None, journal_dir = JOURNALDIR, log = None):
+    '''
+    Purpose:
+      Class used by a backup to take the changes recorded by the
+      watcher. The journal is only trusted when the same watcher has
+      been running, fully set up, since the last successful backup
+      started, nothing overflowed, and the mounts below the source
+      are the same; otherwise a full scan is needed.
+    Inputs:
+      src_dir     : Directory being backed up
+    Keywords:
+      excludes    : rsync exclude patterns; mounts in excluded
+                     directories are ignored. Default from config
+      journal_dir : Journal directory
+      log         : Logger to use
+    '''
+    super().__init__();
+    self.log         = log or logging.getLogger(__name__);
+    self.src_dir     = src_dir;
+    self.excluded    = excludeFilter( src_dir, patterns = excludes, log = self.log );
+    self.journal_dir = journal_dir;
+    self.__begin     = None;                                                    # Committed on success
+
+  ##############################################################################
+  def begin(self):
+    '''
+    Purpose:
+      Method to take the recorded changes; new changes go to a fresh
+      journal from now on
+    Inputs:
+      None.
+    Outputs:
+      Returns journalChanges instance, or None if a full scan is
+      needed
+    '''
+    state = readState( self.journal_dir )
+    if state is None or state.get('src_dir') != self.src_dir:
+      self.log.info( 'No change journal for {}; full scan'.format(self.src_dir) )
+      return None
+    changes = os.path.join( self.journal_dir, CHANGES )
+    consume = os.path.join( self.journal_dir, CONSUME )
+    with changesLock( self.journal_dir ):                                        # Watcher is not appending meanwhile
+      if os.path.exists( changes ):
+        if os.path.exists( consume ):                                           # Left by a failed backup; merge
+          with open( consume, 'ab' ) as out, open( changes, 'rb' ) as fid:
+            out.write( fid.read() )
+          os.remove( changes )
+        else:
+          os.rename( changes, consume );                                        # Watcher appends to a new file from now on
+    records = []
+    if os.path.exists( consume ):
+      with open( consume, 'rb' ) as fid:
+        records = [r for r in fid.read().split( b'\0' ) if r]
+
+    mounts       = mountFingerprint( self.src_dir, self.excluded )
+    self.__begin = {'generation' : state['generation'] if state.get('ready') else None,
+                    'mounts'     : mounts}
+    try:
+      with open( os.path.join(self.journal_dir, COMMITTED), 'r' ) as fid:
+        committed = json.load( fid )
+    except (OSError, ValueError):
+      committed = {}
+    if committed.get('generation') is None or committed.get('generation') != state['generation']:
+      self.log.info( 'Change journal started after the last backup; full scan' )
+    elif mounts is None or committed.get('mounts') != mounts or MOUNTS in records:
+      self.log.info( 'Mounts changed since the last backup; full scan' )
+    elif OVERFLOW in records:
+      self.log.info( 'Change journal overflowed; full scan' )
+    else:
+      return journalChanges( self.src_dir, records )
+    return None
+
+  ##############################################################################
+  def lists(self, changes):
+    '''Write the rsync --files-from lists for changes; returns list of (path, recursive) tuples'''
+    return changes.write( os.path.join(self.journal_dir, 'files.dirs'),
+                          os.path.join(self.journal_dir, 'files.trees') )
+
+  ##############################################################################
+  def commit(self):
+    '''Mark the changes as backed up'''
+    if self.__begin is None: return
+    writeJSON( os.path.join(self.journal_dir, COMMITTED), self.__begin )
+    consume = os.path.join( self.journal_dir, CONSUME )
+    if os.path.exists( consume ): os.remove( consume )
+    self.__begin = None
+
+  ##############################################################################
+  def abort(self):
+    '''Keep the changes for the next backup'''
+    self.__begin = None
@@ -0,0 +1,184 @@
+import logging;
+
+import os, time, fcntl, errno, socket;
+
+LOCKNAME = '.pyBackup.lock'                                                     # Lock file in each backup directory
+
+def pidAlive( pid ):
+  '''Return True if a process with the given PID exists'''
+  try:
+    os.kill( pid, 0 )
+  except ProcessLookupError:
+    return False
+  except PermissionError:                                                       # Exists, but owned by someone else
+    return True
+  return True
+
+class processLock( object ):
+  def __init__(self, path, log = None):
+    '''
+    Purpose:
+      Class for an exclusive lock held by one process at a time; e.g.,
+      on a backup directory. The lock is an flock on the lock file, so
+      it is released by the kernel when the holder exits, however it
+      exits; the file is never removed, which would race with other
+      processes opening it. The PID, host, and start time of the
+      holder are written to the file so that a busy lock can be
+      reported. On file systems without flock, the file is created
+      exclusively instead and a lock whose holder no longer runs on
+      this host is stale and taken over.
+    Inputs:
+      path : Path of the lock file
+    Keywords:
+      log  : Logger to use
+    '''
+    super().__init__();
+    self.log    = log or logging.getLogger(__name__);
+    self.path   = path;
+    self.__fd   = None;
+    self.__flock = True;                                                        # False if the file system does not support flock
+
+  ##############################################################################
+  def __enter__(self):
+    if not self.acquire():
+      raise BlockingIOError( errno.EWOULDBLOCK, 'Lock is held', self.path )
+    return self
+  def __exit__(self, *args):
+    self.release()
+
+  ##############################################################################
+  def locked(self):
+    '''Return True if this instance holds the lock'''
+    return self.__fd is not None
+
+  ##############################################################################
+  def acquire(self):
+    '''
+    Purpose:
+      Method to take the lock without waiting
+    Inputs:
+      None.
+    Outputs:
+      Returns True if the lock was taken, False if another process
+      holds it
+    '''
+    if self.__fd is not None: return True
+    fd = os.open( self.path, os.O_RDWR | os.O_CREAT, 0o644 )
+    try:
+      fcntl.flock( fd, fcntl.LOCK_EX | fcntl.LOCK_NB )
+    except OSError as err:
+      os.close( fd )
+      if err.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
+        self.__busy()
+        return False
+      self.log.debug( 'flock not supported for {}: {}'.format(self.path, err) )
+      self.__flock = False
+      return self.__acquireExclusive()
+    self.__fd = fd
+    self.__write()
+    return True
+
+  ##############################################################################
+  def release(self):
+    '''Release the lock, if held'''
+    if self.__fd is None: return
+    if self.__flock:
+      os.ftruncate( self.__fd, 0 );                                             # No holder; the file stays
+      fcntl.flock( self.__fd, fcntl.LOCK_UN )
+      os.close( self.__fd )
+    else:
+      os.close( self.__fd )
+      try:
+        os.remove( self.path )
+      except OSError:
+        pass
+    self.__fd = None
+
+  ##############################################################################
+  def busy(self):
+    '''
+    Purpose:
+      Method to check whether another process holds the lock, without
+      taking it or creating the lock file
+    Inputs:
+      None.
+    Outputs:
+      Returns True if the lock is held by another process
+    '''
+    if self.__fd is not None: return False
+    try:
+      fd = os.open( self.path, os.O_RDONLY )
+    except OSError:
+      return False
+    try:
+      fcntl.flock( fd, fcntl.LOCK_SH | fcntl.LOCK_NB )
+    except OSError as err:
+      if err.errno in (errno.EWOULDBLOCK, errno.EAGAIN): return True
+      info = self.holder();                                                     # No flock; the file exists while held
+      return info is not None and info['alive'] is not False
+    finally:
+      os.close( fd );                                                           # Also releases a lock just taken
+    return False
+
+  ##############################################################################
+  def holder(self):
+    '''
+    Purpose:
+      Method to read who holds, or last held, the lock
+    Inputs:
+      None.
+    Outputs:
+      Returns dictionary with 'pid', 'host', 'started', and 'alive'
+      keys, or None if unknown; alive is None for other hosts
+    '''
+    try:
+      with open( self.path, 'r' ) as fid:
+        pid, host, started = fid.read().split()
+      pid, started = int(pid), float(started)
+    except (OSError, ValueError):
+      return None
+    alive = pidAlive( pid ) if host == socket.gethostname() else None
+    return {'pid' : pid, 'host' : host, 'started' : started, 'alive' : alive}
+
+  ##############################################################################
+  def __write(self):
+    '''Write the PID, host, and start time to the lock file'''
+    os.ftruncate( self.__fd, 0 )
+    os.lseek( self.__fd, 0, os.SEEK_SET )
+    os.write( self.__fd, '{} {} {:.0f}\n'.format(
+      os.getpid(), socket.gethostname(), time.time() ).encode() )
+
+  ##############################################################################
+  def __acquireExclusive(self):
+    '''Take the lock by creating the lock file; for file systems without flock'''
+    for attempt in range(2):
+      try:
+        fd = os.open( self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644 )
+      except FileExistsError:
+        info = self.holder()
+        if info is None or info['alive'] is False:                             # Empty, or the holder is gone
+          self.log.warning( 'Removing stale lock: {}'.format(self.path) )
+          try:
+            os.remove( self.path )
+          except OSError:
+            pass
+          continue
+        self.__busy()
+        return False
+      self.__fd = fd
+      self.__write()
+      return True
+    return False
+
+  ##############################################################################
+  def __busy(self):
+    '''Log who holds the lock'''
+    info = self.holder()
+    if info is None:
+      self.log.info( 'Locked by another process: {}'.format(self.path) )
+    elif info['alive'] is False:
+      self.log.warning( 'Locked by PID {}, which no longer runs; the lock was inherited by another process: {}'.format(
+        info['pid'], self.path ) )
+    else:
+      self.log.info( 'Locked by PID {} on {} since {}: {}'.format(
+        info['pid'], info['host'], time.ctime( info['started'] ), self.path ) )
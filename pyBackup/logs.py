@@ -0,0 +1,53 @@
+import logging;
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener;
+
+import os, atexit;
+from queue import SimpleQueue;
+from threading import Lock;
+
+FORMAT     = '%(asctime)s [%(levelname)s] %(message)s'
+_listeners = {};                                                                # Dictionary of log file path: (QueueHandler, QueueListener)
+_lock      = Lock()
+
+def addFileHandler( log, log_file, level = logging.DEBUG, maxBytes = 10 * 1024**2, backupCount = 4 ):
+  '''
+  Purpose:
+    Function to log to a rotating file without writing it on the thread
+    that logs. Records are put on a queue by a QueueHandler and written
+    by a QueueListener thread, so a slow disk or a rotation never
+    stalls a backup. There is one handler per log file and process; the
+    daemon creates many backup instances. Records still queued are
+    written at exit.
+  Inputs:
+    log         : Logger to add the handler to
+    log_file    : Path of the log file
+  Keywords:
+    level       : Level of the handler
+    maxBytes    : Size at which the file is rotated
+    backupCount : Number of rotated files to keep
+  Outputs:
+    Returns the QueueHandler
+  '''
+  path = os.path.abspath( log_file )
+  with _lock:
+    if path not in _listeners:
+      os.makedirs( os.path.dirname( path ), exist_ok = True )
+      rotFile = RotatingFileHandler( path, maxBytes = maxBytes, backupCount = backupCount, encoding = 'utf8' )
+      rotFile.setFormatter( logging.Formatter( FORMAT ) )
+      queue    = SimpleQueue()
+      listener = QueueListener( queue, rotFile, respect_handler_level = False )
+      listener.start()
+      if not _listeners: atexit.register( stopListeners )
+      _listeners[path] = (QueueHandler( queue ), listener)
+    handler = _listeners[path][0]
+  handler.setLevel( level )
+  if handler not in log.handlers: log.addHandler( handler )
+  return handler
+
+def stopListeners():
+  '''Write all queued records and stop the writer threads'''
+  with _lock:
+    for handler, listener in _listeners.values():
+      listener.stop()
+      for target in listener.handlers: target.close()
+    _listeners.clear()
@@ -0,0 +1,245 @@
+import logging;
+
+import os, json, time, fcntl, tempfile;
+from contextlib import contextmanager;
+
+from . import APPDIR, utils
+
+HISTORY  = os.path.join( APPDIR, 'history.ndjson' );                            # One JSON record per backup run
+PROMFILE = 'pyBackup_{}.prom';                                                  # Name of textfile for the Prometheus node exporter; per destination
+
+def appendHistory( record, path = HISTORY, keep = 1000 ):
+  '''
+  Purpose:
+    Function to append a run record to the history file as one line
+    of JSON. The file is locked while writing; once it holds about
+    twice keep records, it is rewritten with the newest keep.
+  Inputs:
+    record : Dictionary to append
+  Keywords:
+    path   : Path of the history file
+    keep   : Number of records to keep
+  Outputs:
+    None.
+  '''
+  line = (json.dumps( record, separators = (',', ':') ) + '\n').encode( 'utf8' )
+  fd   = os.open( path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644 )
+  try:
+    fcntl.flock( fd, fcntl.LOCK_EX )
+    os.write( fd, line )
+    size = os.fstat( fd ).st_size
+    if keep and size > 2 * keep * len(line):                                    # Rarely; records are about the same size
+      with open( path, 'rb' ) as fid:
+        lines = fid.read().splitlines( True )[-keep:]
+      tmp = path + '.tmp'
+      with open( tmp, 'wb' ) as fid:
+        fid.writelines( lines )
+      os.replace( tmp, path )
+  finally:
+    os.close( fd );                                                             # Also releases the lock
+
+def readHistory( path = HISTORY, last = None, destination = None ):
+  '''
+  Purpose:
+    Function to read run records from the history file
+  Keywords:
+    path        : Path of the history file
+    last        : Only return this many of the newest records
+    destination : Only return records of this destination UUID
+  Outputs:
+    Returns list of dictionaries, oldest first
+  '''
+  records = []
+  try:
+    with open( path, 'r', encoding = 'utf8' ) as fid:
+      for line in fid:
+        try:
+          record = json.loads( line )
+        except ValueError:                                                      # Torn line from a crash
+          continue
+        if destination is None or record.get('destination', None) == destination:
+          records.append( record )
+  except OSError:
+    return []
+  return records[-last:] if last else records
+
+def writeTextfile( record, directory ):
+  '''
+  Purpose:
+    Function to export a run record in the Prometheus text format,
+    for the textfile collector of the node exporter. The file is
+    written to a temporary file and renamed, so it is never read
+    half written.
+  Inputs:
+    record    : Run record
+    directory : Directory the collector reads
+  Outputs:
+    None.
+  '''
+  labels = 'destination="{}",backend="{}"'.format( record.get('destination', ''), record.get('backend', '') )
+  lines  = []
+  def metric( name, value, kind = 'gauge', extra = '' ):
+    if value is None: return
+    lines.append( '# TYPE pybackup_{} {}'.format(name, kind) )
+    lines.append( 'pybackup_{}{{{}{}}} {}'.format(name, labels, extra, value) )
+  metric( 'last_run_timestamp_seconds',   record['start'] )
+  metric( 'last_run_status',              record['status'] )
+  metric( 'run_duration_seconds',         record['duration'] )
+  for key in ['files_scanned', 'files_transferred', 'bytes_transferred', 'hard_links',
+              'bytes_freed', 'bytes_per_second', 'files_per_second']:
+    metric( key, record.get(key, None) )
+  lines.append( '# TYPE pybackup_phase_duration_seconds gauge' )
+  for phase, seconds in record['phases'].items():
+    lines.append( 'pybackup_phase_duration_seconds{{{},phase="{}"}} {}'.format(labels, phase, seconds) )
+  path    = os.path.join( directory, PROMFILE.format( record.get('destination', '') or 'default' ) )
+  fd, tmp = tempfile.mkstemp( dir = directory, prefix = '.tmp' )
+  with os.fdopen( fd, 'w' ) as fid:
+    fid.write( '\n'.join( lines ) + '\n' )
+  os.chmod( tmp, 0o644 )
+  os.replace( tmp, path )
+
+def percentile( values, q ):
+  '''Return the q-th percentile of a list of numbers, or None if empty'''
+  values = sorted( v for v in values if v is not None )
+  if not values: return None
+  return values[ min( int( q / 100.0 * len(values) ), len(values) - 1 ) ]
+
+def summarize( records ):
+  '''
+  Purpose:
+    Function to summarise the trends of a list of run records
+  Inputs:
+    records : List of run records, oldest first
+  Outputs:
+    Returns dictionary with the number of runs and failures, the
+    median and 90th percentile of the duration of each phase and of
+    the whole run, the median throughput, and the change in median
+    run duration from the older half of the runs to the newer half
+  '''
+  done   = [r for r in records if r.get('status', None) == 0]
+  phases = {}
+  for record in done:
+    for phase, seconds in record.get('phases', {}).items():
+      phases.setdefault( phase, [] ).append( seconds )
+  out = {'runs'     : len(records),
+         'failed'   : len(records) - len(done),
+         'duration' : {'median' : percentile( [r['duration'] for r in done], 50 ),
+                       'p90'    : percentile( [r['duration'] for r in done], 90 )},
+         'phases'   : {phase : {'median' : percentile( values, 50 ), 'p90' : percentile( values, 90 )}
+                         for phase, values in phases.items()},
+         'bytes_per_second' : percentile( [r.get('bytes_per_second', None) for r in done], 50 ),
+         'files_per_second' : percentile( [r.get('files_per_second', None) for r in done], 50 ),
+         'trend'    : None}
+  half = len(done) // 2
+  if half:
+    old = percentile( [r['duration'] for r in done[:half]], 50 )
+    new = percentile( [r['duration'] for r in done[half:]], 50 )
+    if old: out['trend'] = (new - old) / old
+  return out
+
+class runMetrics( object ):
+  def __init__(self, backend = 'rsync', log = None):
+    '''
+    Purpose:
+      Class to collect the metrics of one backup run: the wall time
+      of each phase and counters for what was done. Timing a phase
+      costs two clock reads and counters are plain additions, so
+      neither adds noticeable overhead; the record is written once,
+      at the end of the run.
+    Inputs:
+      None.
+    Keywords:
+      backend : Name of the backend doing the backup
+      log     : Logger to use
+    '''
+    super().__init__();
+    self.log         = log or logging.getLogger(__name__);
+    self.backend     = backend;
+    self.destination = None;                                                    # UUID of the destination; set once the run starts
+    self.phases      = {};                                                      # Dictionary of phase: seconds
+    self.counters    = {};
+    self.start       = None;
+    self.__t0        = None;
+
+  ##############################################################################
+  def begin(self, destination):
+    '''Start the run; only runs that began are recorded'''
+    self.destination = destination
+    self.start       = time.time()
+    self.__t0        = time.monotonic()
+
+  ##############################################################################
+  @contextmanager
+  def phase(self, name):
+    '''Context manager adding the wall time of the block to a phase'''
+    t0 = time.monotonic()
+    try:
+      yield
+    finally:
+      self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - t0
+
+  ##############################################################################
+  def count(self, key, value = 1):
+    '''Add to a counter'''
+    self.counters[key] = self.counters.get(key, 0) + value
+
+  ##############################################################################
+  def finish(self, status, stats = None, returncode = None):
+    '''
+    Purpose:
+      Method to build the record of the run
+    Inputs:
+      status     : 0 if the backup succeeded, 1 otherwise
+    Keywords:
+      stats      : Transfer stats of the backup
+      returncode : Return code of rsync
+    Outputs:
+      Returns the record dictionary
+    '''
+    stats    = stats or {}
+    transfer = self.phases.get('transfer', 0.0)
+    record   = {'start'             : round( self.start, 3 ),
+                'destination'       : self.destination,
+                'backend'           : self.backend,
+                'status'            : status,
+                'returncode'        : returncode,
+                'duration'          : round( time.monotonic() - self.__t0, 3 ),
+                'phases'            : {k : round(v, 3) for k, v in self.phases.items()},
+                'files_scanned'     : stats.get('number_of_files', 0),
+                'files_transferred' : stats.get('number_of_regular_files_transferred', 0),
+                'bytes_transferred' : stats.get('total_transferred_file_size', 0),
+                'hard_links'        : stats.get('number_of_linked_files', 0) + self.counters.get('moved_links', 0),
+                'bytes_freed'       : self.counters.get('bytes_freed', 0)}
+    if transfer > 0:
+      record['bytes_per_second'] = round( record['bytes_transferred'] / transfer )
+      record['files_per_second'] = round( record['files_scanned'] / transfer, 1 )
+    for key, value in self.counters.items():
+      record.setdefault( key, value )
+    return record
+
+  ##############################################################################
+  def save(self, status, stats = None, returncode = None):
+    '''
+    Purpose:
+      Method to finish the run and append it to the history; it is
+      also exported for Prometheus if 'metrics_dir' is set in the
+      config. Failures are logged, never raised.
+    Inputs:
+      status     : 0 if the backup succeeded, 1 otherwise
+    Keywords:
+      stats      : Transfer stats of the backup
+      returncode : Return code of rsync
+    Outputs:
+      Returns the record, or None if the run never began
+    '''
+    if self.start is None: return None
+    record = self.finish( status, stats = stats, returncode = returncode )
+    try:
+      appendHistory( record, keep = utils.CONFIG.get('history_max', 1000) )
+      directory = utils.CONFIG.get('metrics_dir', '')
+      if directory: writeTextfile( record, directory )
+    except OSError as err:
+      self.log.warning( 'Failed to save run metrics: {}'.format(err) )
+    self.log.info( 'Run took {:.1f}s: {}'.format( record['duration'],
+      ', '.join( '{} {:.1f}s'.format(k, v) for k, v in record['phases'].items() ) ) )
+    return record
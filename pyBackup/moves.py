@@ -0,0 +1,138 @@
+import logging;
+
+import os, stat, time, hashlib;
+
+MTIME_FMT = '%Y/%m/%d-%H:%M:%S';                                                # Format of modification times in the catalog; rsync %M
+
+def sameContent( a, b, block = 1024**2 ):
+  '''Return True if two files have the same blake2b digest'''
+  digests = []
+  for path in (a, b):
+    h = hashlib.blake2b()
+    with open( path, 'rb' ) as fid:
+      for data in iter( lambda: fid.read( block ), b'' ):
+        h.update( data )
+    digests.append( h.digest() )
+  return digests[0] == digests[1]
+
+class moveDetector( object ):
+  def __init__(self, src_dir, catalog, snapshots, excluded = None,
+                min_size = 1024**2, verify = False, log = None):
+    '''
+    Purpose:
+      Class to find files that were moved or copied on the source
+      since the previous backups and hard link them into the new
+      backup before rsync runs. rsync --link-dest only finds a file
+      at the same path, so a renamed directory would otherwise be
+      copied again in full. Files of new directory trees, as recorded
+      by the change journal, are matched to files of recent backups
+      by size and modification time, from an index read out of the
+      catalog; a match is then checked with an lstat of the backed up
+      file, whose size, modification time, permissions, and ownership
+      must equal those of the source, and optionally by comparing
+      contents. rsync finds the linked files up to date and leaves
+      them alone.
+    Inputs:
+      src_dir   : Directory being backed up
+      catalog   : snapshotCatalog of the backup directory
+      snapshots : List of paths of backups to link from; preferred
+                   first
+    Keywords:
+      excluded  : Function taking a bytes path and returning True if
+                   it is excluded from the backup
+      min_size  : Smaller files are left to rsync
+      verify    : If set, contents are compared before linking
+      log       : Logger to use
+    '''
+    super().__init__();
+    self.log       = log or logging.getLogger(__name__);
+    self.src_dir   = src_dir;
+    self.catalog   = catalog;
+    self.snapshots = snapshots;
+    self.excluded  = excluded or (lambda path: False);
+    self.min_size  = min_size;
+    self.verify    = verify;
+    self.root      = os.fsencode( os.path.dirname( src_dir.rstrip(os.sep) ) or os.sep );# Paths in backups are relative to this
+    self.linked    = 0;
+    self.bytes     = 0;
+    self.__index   = None;                                                      # Dictionary of (size, mtime): list of backed up paths
+
+  ##############################################################################
+  def index(self):
+    '''
+    Purpose:
+      Method to build the index of files in the backups to link from;
+      only files of at least min_size are indexed
+    Inputs:
+      None.
+    Outputs:
+      Returns the number of indexed files
+    '''
+    self.__index = {}
+    for snap in self.snapshots:
+      sid = self.catalog.snapshotId( os.path.basename( snap ) )
+      if sid is None: continue
+      rows = self.catalog.db.execute(
+        'SELECT p.path, e.size, e.mtime FROM entries AS e JOIN paths AS p ON p.id = e.path '
+        "WHERE e.snapshot = ? AND e.kind = 'f' AND e.size >= ?", (sid, self.min_size) )
+      for path, size, mtime in rows:
+        self.__index.setdefault( (size, mtime), [] ).append( os.path.join( os.fsencode(snap), path ) )
+    return sum( len(paths) for paths in self.__index.values() )
+
+  ##############################################################################
+  def link(self, prog_dir, trees, files = ()):
+    '''
+    Purpose:
+      Method to hard link moved files into the backup in progress
+    Inputs:
+      prog_dir : The .inprogress directory
+      trees    : List of bytes paths of new directory trees
+    Keywords:
+      files    : List of bytes paths of other new or changed files
+    Outputs:
+      Returns number of files linked
+    '''
+    if self.__index is None: self.index()
+    if not self.__index: return 0
+    prog = os.fsencode( prog_dir )
+    for tree in trees:
+      for root, dnames, fnames in os.walk( tree ):
+        dnames[:] = [d for d in dnames if not self.excluded( os.path.join(root, d) )]
+        for name in fnames:
+          path = os.path.join( root, name )
+          if not self.excluded( path ): self.__link( prog, path )
+    for path in files:
+      self.__link( prog, path )
+    if self.linked:
+      self.log.info( 'Linked {} moved files, {} bytes, from previous backups'.format(self.linked, self.bytes) )
+    return self.linked
+
+  ##############################################################################
+  def __link(self, prog, path):
+    '''Private method to link one source file if a backed up copy matches'''
+    try:
+      info = os.lstat( path )
+    except OSError:
+      return
+    if not stat.S_ISREG( info.st_mode ) or info.st_size < self.min_size: return
+    key  = (info.st_size, time.strftime( MTIME_FMT, time.localtime( info.st_mtime ) ))
+    dst  = os.path.join( prog, os.path.relpath( path, self.root ) )
+    if os.path.lexists( dst ): return
+    for src in self.__index.get( key, () ):
+      try:
+        copy = os.lstat( src )
+      except OSError:
+        continue
+      if copy.st_size != info.st_size or int(copy.st_mtime) != int(info.st_mtime): continue
+      if copy.st_mtime_ns != info.st_mtime_ns and copy.st_mtime_ns % 10**9: continue;# Backup keeps nanoseconds; they must match too
+      if (copy.st_mode, copy.st_uid, copy.st_gid) != (info.st_mode, info.st_uid, info.st_gid): continue;# rsync would change the shared inode
+      try:
+        if self.verify and not sameContent( path, src ): continue
+        os.makedirs( os.path.dirname( dst ), exist_ok = True )
+        os.link( src, dst )
+      except OSError as err:
+        self.log.debug( 'Failed to link {}: {}'.format(os.fsdecode(dst), err) )
+        return
+      self.linked += 1
+      self.bytes  += info.st_size
+      return
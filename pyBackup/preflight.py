@@ -0,0 +1,69 @@
+import os, sys;
+
+from . import CONFIGFILE
+
+def preflight( src_dir ):
+  '''
+  Purpose:
+    Function to find out, in a few milliseconds, whether a scheduled
+    backup has anything to do, before the modules that run backups
+    are imported. Only the config, the mount table, the lock files of
+    the backup directories, and the change journal are read; nothing
+    is written. A backup is skipped when no backup disk is mounted,
+    when every mounted one is locked by a running backup, or when the
+    change journal can be trusted and recorded no changes since the
+    last backup, which has then nothing to clean up either.
+  Inputs:
+    src_dir : Directory to back up
+  Outputs:
+    Returns tuple of (status, reason); status is None if the backup
+    should run, otherwise the exit code the backup would have
+    returned
+  '''
+  if not os.path.isfile( CONFIGFILE ):                                          # Never set up; do not create anything
+    return 1, 'Backup disk NOT set!'
+  from . import utils
+  from .destinations import destinations, connected
+  from .lock import processLock, LOCKNAME
+
+  dests = destinations()
+  if not dests: return 1, 'Backup disk NOT set!'
+  mounted = connected()
+  if not mounted: return 1, 'Backup disk NOT mounted!'
+  free    = [ (dest, path) for dest, path in mounted
+                if not processLock( os.path.join( path, LOCKNAME ) ).busy() ]
+  if not free: return None, 'Backup directory locked, is there a backup running?'
+  if not utils.CONFIG.get('journal', False) or len(dests) > 1:
+    return None, 'No change journal; full scan'
+
+  from .trashReaper import TRASH
+  from .journal import changesPending
+
+  dest, path = free[0]
+  if dest['backend'] == 'cas':
+    from .casStore import casStore
+    if not casStore( path ).snapshots(): return None, 'First backup'
+  elif not os.path.isdir( os.path.join( path, 'Latest' ) ):
+    return None, 'First backup'
+  try:
+    names = os.listdir( path )
+    trash = os.listdir( os.path.join( path, TRASH ) ) if TRASH in names else []
+  except OSError:
+    return None, 'Backup directory not readable'
+  if any( name.endswith( '.inprogress' ) for name in names ):
+    return None, 'Resuming canceled backup'
+  if trash: return None, 'Old backups left to delete'
+
+  pending = changesPending( src_dir )
+  if pending is None: return None, 'Change journal can not be trusted; full scan'
+  if pending:         return None, 'Changes recorded since the last backup'
+  return 0, 'No changes recorded since the last backup, skipping backup'
+
+if __name__ == "__main__":
+  import argparse
+  parser = argparse.ArgumentParser(description="Check whether a backup has anything to do; exits 0 if it does")
+  parser.add_argument("src_dir", type = str, default=os.path.expanduser('~'), nargs='?', help = "Directory to backup; recusively")
+  args = parser.parse_args()
+  status, reason = preflight( args.src_dir )
+  print( reason )
+  sys.exit( 0 if status is None else 1 )
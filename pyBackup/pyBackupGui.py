@@ -1,5 +1,6 @@
 import logging
 import os, shutil, time;
+from subprocess import Popen, DEVNULL;
 from crontab import CronTab;
 from threading import Thread;
 
@@ -17,15 +18,16 @@ class disabledMessage( QMessageBox ):
     return self.clickedButton() == self.accept;
 
 from pyBackup.version import __version__
-from pyBackup.rsyncBackup import rsyncBackup;
-from pyBackup import utils;
+from pyBackup import utils, daemon, worker;
+
+EMIT_INTERVAL = 0.5;                                                            # Seconds between updates of the progress widgets
 
 # Set up some directory paths
 _home     = os.path.expanduser('~');
 _desktop  = os.path.join( _home, 'Desktop' );
 
 #############################################
-class pyBackupSettings( rsyncBackup, QMainWindow ):
+class pyBackupSettings( QMainWindow ):
   statusSignal    = QtCore.pyqtSignal(str);
   butTxtSignal    = QtCore.pyqtSignal(str)
   lastLabelSignal = QtCore.pyqtSignal(str)
@@ -33,6 +35,7 @@ class pyBackupSettings( rsyncBackup, QMainWindow ):
   pBarTxtSignal   = QtCore.pyqtSignal(bool);
   def __init__(self, *args, **kwargs):
     super().__init__( *args, **kwargs );                                        # Initialize the base class
+    self.log           = logging.getLogger(__name__);
     self.setWindowTitle('pyBackup');                                            # Set the window title
     self.backupDisk    = None;                                                  # Set attribute for destination data directory to None
     self.dst_dirFull   = None;                                                  # Set attribute for destination data directory to None
@@ -41,9 +44,13 @@ class pyBackupSettings( rsyncBackup, QMainWindow ):
     self.statusFMT     = 'Status: {}';
     self._running      = False;
     self.is_root       = os.geteuid() == 0;                                     # Determine if running as root
-    self.backupThread  = None;
+    self.worker        = None;                                                  # workerClient of the backup worker process
+    self.workerProc    = None;                                                  # Popen instance of a worker started here
     self.monitorThread = None
+    self._closing      = False;
     self.initUI();                                                              # Run method to initialize user interface
+    client = worker.workerClient.connect();                                     # Backup started by an earlier window
+    if client: self._attach( client )
 
   ##############################################################################
   def initUI(self):
@@ -136,28 +143,96 @@ class pyBackupSettings( rsyncBackup, QMainWindow ):
     if not self.is_root:                                                        # If not running as root
       disabledMessage().exec_();                                                # Display a dialog saying cannot do unles root
       return;
-    if not self.backupThread:                                                   # If there is NOT a backup thread running
-      self.backupThread  = Thread( target = super().backup      )               # Initialize new thread
-      self.monitorThread = Thread( target = self._monitorStatus )
-      self.backupThread.start();                                                # Start the thread
-      self.monitorThread.start()
+    if self.worker:                                                             # Cancel the backup of the worker
+      self.worker.cancel()
+      return
+    if daemon.request('status') is not None:                                    # The daemon is running; let it do the backup
+      if self.monitorThread and self.monitorThread.is_alive():
+        daemon.request('cancel')
+      else:
+        daemon.request('trigger')
+        self.monitorThread = Thread( target = self._monitorDaemon )
+        self.monitorThread.start()
+      return
+    self.workerProc, client = worker.start()                                    # Backup runs in its own process
+    if client is None:
+      self.log.error( 'Backup worker did not start' )
+      self.lastLabelSignal.emit( 'Failed!' )
+      return
+    self._attach( client )
+
+  ##############################################################################
+  def _attach(self, client):
+    '''Show the progress of the worker connected to by client'''
+    self.worker        = client
+    self.monitorThread = Thread( target = self._monitorWorker )
+    self.monitorThread.start()
+
+  ##############################################################################
+  def _monitorWorker(self, *args, **kwargs):
+    '''
+    Show the progress events streamed by the backup worker; the widgets
+    are updated at most every EMIT_INTERVAL seconds, and right away
+    when the phase changes
+    '''
+    self.butTxtSignal.emit( 'Cancel' )
+    self.statusSignal.emit( self.statusFMT.format('Backing up') )
+    self.pBarTxtSignal.emit(True)
+
+    status = None
+    phase  = None
+    last   = 0.0
+    for event in self.worker.events():
+      if event['event'] == 'finished':
+        status = event['status']
+        break
+      now = time.monotonic()
+      if event['phase'] == phase and now - last < EMIT_INTERVAL: continue
+      phase, last = event['phase'], now
+      txt = event['phase']
+      if event['mb_per_s'] > 0:
+        txt += ' ({:.1f} MB/s'.format( event['mb_per_s'] )
+        if event['eta'] is not None:
+          txt += ', {:.0f} min left'.format( event['eta'] / 60.0 )
+        txt += ')'
+      self.statusSignal.emit( self.statusFMT.format( txt ) )
+      self.pBarSignal.emit(   int( event['progress'] ) )
+
+    if self._closing: return;                                                   # Detached; the backup goes on
+    if status is None and self.workerProc:                                      # Connection lost; the exit code tells
+      status = self.workerProc.wait()
+    self.worker.close()
+    self.worker     = None
+    self.workerProc = None
+    if status == 0:
+      self.lastLabelSignal.emit( self.lastBackupFMT.format('0 days ago') )
     else:
-      self.cancel()
-      self.backupThread = None
+      self.lastLabelSignal.emit( 'Failed!' )
+
+    self.statusSignal.emit( self.statusFMT.format('') )
+    self.pBarTxtSignal.emit( False )
+    self.pBarSignal.emit( 0 )
+    self.butTxtSignal.emit( 'Backup now!' )
 
   ##############################################################################
-  def _monitorStatus(self, *args, **kwargs):
+  def _monitorDaemon(self, *args, **kwargs):
+    '''Show the status of a backup run by the daemon until it finishes'''
     self.butTxtSignal.emit( 'Cancel' )
     self.statusSignal.emit( self.statusFMT.format('Backing up') )
     self.pBarTxtSignal.emit(True)
 
-    while self.backupThread and self.backupThread.is_alive():
-      self.statusSignal.emit( self.statusFMT.format( self.statusTXT ) )
-      self.pBarSignal.emit(   int( self.progress ) )
-      time.sleep(1.0);
+    started  = False
+    deadline = time.time() + 10.0                                               # The daemon starts the backup right away
+    info     = None
+    for info in daemon.watch():
+      if info['running']:
+        started = True
+        self.statusSignal.emit( self.statusFMT.format( info['status'] ) )
+        self.pBarSignal.emit(   int( info['progress'] ) )
+      elif started or time.time() > deadline:
+        break
 
-    time.sleep(2.0)
-    if (self.rsyncStatus == 0): 
+    if started and info['last_status'] == 0:
       self.lastLabelSignal.emit( self.lastBackupFMT.format('0 days ago') )
     else:
       self.lastLabelSignal.emit( 'Failed!' )
@@ -166,7 +241,6 @@ class pyBackupSettings( rsyncBackup, QMainWindow ):
     self.pBarTxtSignal.emit( False )
     self.pBarSignal.emit( 0 )
     self.butTxtSignal.emit( 'Backup now!' )
-    self.backupThread = None
 
   ##############################################################################
   def autoBackup(self):
@@ -174,25 +248,40 @@ class pyBackupSettings( rsyncBackup, QMainWindow ):
       disabledMessage().exec_();                                                # Display a dialog saying cannot do unles root
       return;
     my_cron = CronTab( user = os.environ['LOGNAME'] );
-    utils.CONFIG['auto_backup'] = not utils.CONFIG['auto_backup'];                # Set to opposit value
-    if utils.CONFIG['auto_backup']:
-      self.autoButton.setText( self.autoBackupFMT.format('Enabled') )
-      cmd = os.path.join( utils._dir, utils.CONFIG['cron_cmd'] );
-      cmd = "/usr/bin/env python3 {}".format( cmd )
+    my_cron.remove_all( comment = utils.CONFIG['cron_cmt'] );                   # Remove old jobs; e.g., the hourly job of earlier versions
+    if not utils.CONFIG['auto_backup']:
+      cmd = daemon.command()                                                    # Not the cron_cmd of old configs; it named the hourly script
+      if cmd is None:
+        self.log.error( 'Daemon script {} not found'.format( daemon.COMMAND ) )
+        QMessageBox.warning( self, 'pyBackup',
+          'Automatic backups need the {} script, which is not installed'.format( daemon.COMMAND ) )
+        my_cron.write();                                                        # The old jobs are gone either way
+        return
       job = my_cron.new( command = cmd, comment = utils.CONFIG['cron_cmt'] )
-      job.every(1).hour();
-      my_cron.write();
+      job.every_reboot();                                                       # The daemon schedules the backups itself
+      if daemon.request('status') is None:
+        try:
+          Popen( [cmd], stdin = DEVNULL, stdout = DEVNULL, stderr = DEVNULL,
+            start_new_session = True );                                         # Start it now too; it outlives the GUI
+        except OSError as err:
+          self.log.error( 'Failed to start the daemon: {}'.format( err ) )
+          QMessageBox.warning( self, 'pyBackup',
+            'Failed to start the daemon; it starts at the next boot' )
+      utils.CONFIG['auto_backup'] = True
+      self.autoButton.setText( self.autoBackupFMT.format('Enabled') )
     else:
+      utils.CONFIG['auto_backup'] = False
       self.autoButton.setText( self.autoBackupFMT.format('Disabled') )
-      for job in my_cron:
-        if job.comment == utils.CONFIG['cron_cmt']:
-          my_cron.remove(job);
-          my_cron.write();
-          break;
+      daemon.request('stop')
+    my_cron.write();
     utils.CONFIG.saveConfig( )                                            # Update config file
 
   ##############################################################################
   def closeEvent(self, event):
-    self.cancel()
-    self.log.info('Quitting')
+    if self.worker:                                                             # Detach; the worker finishes the backup
+      self._closing = True
+      self.worker.close()
+      self.log.info('Quitting; backup continues in the background')
+    else:
+      self.log.info('Quitting')
     event.accept()
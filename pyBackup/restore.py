@@ -0,0 +1,250 @@
+import logging;
+
+import os, stat, shutil, time;
+from threading import Lock, BoundedSemaphore;
+from concurrent.futures import ThreadPoolExecutor;
+
+from .destinations import connected, getState
+from .catalog import snapshotCatalog, CATALOG
+
+def getBackupDir():
+  '''
+  Purpose:
+    Function to get the top-level backup directory on the first
+    mounted backup disk
+  Inputs:
+    None.
+  Outputs:
+    Returns path to the backup directory, or None if the disk is not
+    mounted
+  '''
+  dests = connected()
+  return dests[0][1] if dests else None
+
+def getSnapshots( backup_dir ):
+  '''Return sorted list of names of complete backups in backup_dir'''
+  snaps = []
+  for name in os.listdir( backup_dir ):
+    if name.startswith('.') or name.endswith('.inprogress'): continue
+    path = os.path.join( backup_dir, name )
+    if os.path.isdir( path ) and not os.path.islink( path ):
+      snaps.append( name )
+  return sorted( snaps )
+
+def sourceDir( backup_dir ):
+  '''Return directory backed up to backup_dir, as recorded by its last backup, or None'''
+  backup_dir = os.path.realpath( backup_dir )
+  for dest, path in connected():
+    if os.path.realpath( path ) == backup_dir:
+      return getState( dest['uuid'], 'src_dir', None )
+  return None
+
+def relativePath( backup_dir, snapshots, path, src_dir = None ):
+  '''
+  Purpose:
+    Function to convert a path on the source disk to the path inside
+    the backups. Backups of '/' keep the full path while backups of
+    other directories start at the name of that directory. When the
+    backed up directory is known, the path must be inside it.
+    Otherwise leading components are stripped to find the path in a
+    backup, and if it is found more than one way, it is ambiguous.
+  Inputs:
+    backup_dir : Top-level backup directory
+    snapshots  : List of backup names to look in; newest last
+    path       : Absolute or relative path on the source disk
+  Keywords:
+    src_dir    : Directory that was backed up, if known
+  Outputs:
+    Returns path relative to the backup directories, or None; raises
+    ValueError if the path is ambiguous
+  '''
+  path = os.path.abspath( path )
+  if src_dir:
+    top = src_dir.rstrip(os.sep) or os.sep
+    if path != top and not path.startswith( top.rstrip(os.sep) + os.sep ): return None
+    tries = [ os.path.relpath( path, os.path.dirname( top ) ) ]
+  else:
+    parts = [p for p in path.split( os.sep ) if p]
+    tries = [ os.path.join( *parts[i:] ) for i in range( len(parts) ) ]
+  found = [ rel for rel in tries
+            if any( os.path.lexists( os.path.join( backup_dir, snap, rel ) ) for snap in snapshots ) ]
+  if len(found) > 1:
+    raise ValueError( 'Path is ambiguous, found as {}'.format( ' and '.join(found) ) )
+  return found[0] if found else None
+
+def listVersions( backup_dir, path, src_dir = None ):
+  '''
+  Purpose:
+    Function to list every version of a path across all backups.
+    Backups that share the same inode hold the same, unchanged,
+    version and are collapsed into one entry. The catalog is used
+    when it knows about the path; otherwise each backup is stat'ed.
+  Inputs:
+    backup_dir : Top-level backup directory
+    path       : Path on the source disk
+  Keywords:
+    src_dir    : Directory that was backed up, if known
+  Outputs:
+    Returns list of dictionaries with 'snapshots', 'size', and
+    'mtime' keys, oldest first; raises ValueError if the path is
+    ambiguous
+  '''
+  snapshots = getSnapshots( backup_dir )
+  rel       = relativePath( backup_dir, snapshots, path, src_dir = src_dir )
+  if rel is None: return []
+  rows    = []
+  catalog = os.path.join( backup_dir, CATALOG )
+  if os.path.isfile( catalog ):
+    cat  = snapshotCatalog( catalog )
+    rows = [(name, size, mtime, inode) for name, size, mtime, inode, change in cat.versions( rel )
+              if name in snapshots]
+    cat.close()
+  if not rows:                                                                  # Not in catalog; stat each backup
+    for name in snapshots:
+      try:
+        info = os.lstat( os.path.join( backup_dir, name, rel ) )
+      except OSError:
+        continue
+      mtime = time.strftime( '%Y/%m/%d-%H:%M:%S', time.localtime( info.st_mtime ) )
+      rows.append( (name, info.st_size, mtime, info.st_ino) )
+  versions = []
+  for name, size, mtime, inode in rows:
+    if versions and versions[-1]['inode'] == inode:                             # Same inode as previous backup; unchanged version
+      versions[-1]['snapshots'].append( name )
+    else:
+      versions.append( {'snapshots' : [name], 'size' : size, 'mtime' : mtime,
+                        'inode' : inode, 'path' : rel} )
+  return versions
+
+class snapshotRestore( object ):
+  def __init__(self, workers = 4, callback = None, log = None):
+    '''
+    Purpose:
+      Class to restore a file or directory tree from a backup. The
+      tree is walked in one thread while files are copied by a pool
+      of threads; hard links within the restored tree are recreated
+      once all files are copied, and directory metadata is set last
+      so copying into the directories does not change it.
+    Inputs:
+      None.
+    Keywords:
+      workers  : Number of files to copy at once
+      callback : Function called with (files, bytes, seconds) about
+                  once a second
+      log      : Logger to use
+    '''
+    super().__init__();
+    self.log      = log or logging.getLogger(__name__);
+    self.workers  = max( int(workers or 1), 1 );
+    self.callback = callback;
+    self.files    = 0;
+    self.bytes    = 0;
+    self.errors   = [];
+    self.is_root  = hasattr(os, 'geteuid') and os.geteuid() == 0;
+    self.__lock   = Lock();
+    self.__t0     = None;
+    self.__report = 0.0;
+
+  ##############################################################################
+  def restore(self, src, dst):
+    '''
+    Purpose:
+      Method to restore a path
+    Inputs:
+      src : Path inside a backup
+      dst : Path to restore to; must not exist
+    Outputs:
+      Returns True if everything was restored
+    '''
+    self.__t0 = time.monotonic()
+    links     = {};                                                             # Destination of first copy of each multiply linked inode
+    deferred  = [];                                                             # Hard links to create once copies are done
+    dirs      = [];                                                             # Directories to set metadata on at the end
+    slots     = BoundedSemaphore( self.workers * 4 );                           # Limit number of queued copies
+    with ThreadPoolExecutor( max_workers = self.workers ) as pool:
+      def submit( s, d, info ):
+        if info.st_nlink > 1:
+          key = (info.st_dev, info.st_ino)
+          if key in links:
+            deferred.append( (links[key], d) )
+            return
+          links[key] = d
+        slots.acquire()
+        future = pool.submit( self.__copy, s, d, info )
+        future.add_done_callback( lambda f: slots.release() )
+
+      info = os.lstat( src )
+      if not stat.S_ISDIR( info.st_mode ):
+        submit( src, dst, info )
+      else:
+        for root, dnames, fnames in os.walk( src ):
+          droot = os.path.join( dst, os.path.relpath( root, src ) )
+          os.makedirs( droot, exist_ok = True )
+          dirs.append( (root, droot) )
+          for name in dnames:
+            s = os.path.join( root, name )
+            if os.path.islink( s ):                                             # os.walk lists links to directories as directories
+              fnames.append( name )
+          dnames[:] = [name for name in dnames if not os.path.islink( os.path.join(root, name) )]
+          for name in fnames:
+            s = os.path.join( root, name )
+            submit( s, os.path.join( droot, name ), os.lstat( s ) )
+
+    for first, d in deferred:                                                   # All copies are done; create the hard links
+      try:
+        os.link( first, d )
+        self.__count( 1, 0 )
+      except OSError as err:
+        self.errors.append( (d, err) )
+    for s, d in reversed( dirs ):                                               # Deepest directories first
+      self.__copyMeta( s, d )
+    self.__progress( force = True )
+    for path, err in self.errors:
+      self.log.error( 'Failed to restore {}: {}'.format(path, err) )
+    return len(self.errors) == 0
+
+  ##############################################################################
+  def __copy(self, src, dst, info):
+    '''Copy one non-directory entry with its metadata'''
+    try:
+      mode = info.st_mode
+      if stat.S_ISLNK( mode ):
+        os.symlink( os.readlink( src ), dst )
+      elif stat.S_ISREG( mode ):
+        shutil.copyfile( src, dst );                                            # Uses in-kernel copy where available
+      elif self.is_root:
+        os.mknod( dst, mode, info.st_rdev )
+      else:
+        self.log.warning( 'Skipping special file: {}'.format(src) )
+        return
+      self.__copyMeta( src, dst, info )
+      self.__count( 1, info.st_size if stat.S_ISREG( mode ) else 0 )
+    except OSError as err:
+      with self.__lock:
+        self.errors.append( (dst, err) )
+
+  ##############################################################################
+  def __copyMeta(self, src, dst, info = None):
+    '''Copy ownership, permissions, and times; ownership only as root'''
+    try:
+      if info is None: info = os.lstat( src )
+      if self.is_root:
+        os.chown( dst, info.st_uid, info.st_gid, follow_symlinks = False )
+      shutil.copystat( src, dst, follow_symlinks = False )
+    except (OSError, NotImplementedError) as err:
+      with self.__lock:
+        self.errors.append( (dst, err) )
+
+  ##############################################################################
+  def __count(self, files, nbytes):
+    with self.__lock:
+      self.files += files
+      self.bytes += nbytes
+    self.__progress()
+
+  ##############################################################################
+  def __progress(self, force = False):
+    now = time.monotonic()
+    if self.callback and (force or now - self.__report > 1.0):
+      self.__report = now
+      self.callback( self.files, self.bytes, now - self.__t0 )
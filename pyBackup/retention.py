@@ -0,0 +1,186 @@
+import logging;
+
+import calendar;
+from datetime import datetime;
+
+from . import utils
+
+HOUR    = 3600
+TIERS   = [[24, 1], [30 * 24, 24], [None, 7 * 24]]                              # Default retention; [max age, interval] in hours
+
+def parseTiers( tiers ):
+  '''
+  Purpose:
+    Function to convert retention tiers from the config file to
+    seconds
+  Inputs:
+    tiers : List of [max age, interval] pairs in hours, youngest
+             first; max age of None means no limit
+  Outputs:
+    Returns list of (max age, interval) tuples in seconds
+  '''
+  out = []
+  for age, interval in tiers:
+    out.append( (None if age is None else age * HOUR, max(interval, 0) * HOUR) )
+  if not out or out[-1][0] is not None:                                         # Everything older than the last tier is kept too
+    out.append( (None, out[-1][1] if out else 7 * 24 * HOUR) )
+  return out
+
+class retentionPlanner( object ):
+  def __init__(self, tiers = None, date_FMT = None, usage = None, log = None):
+    '''
+    Purpose:
+      Class to decide which backups to delete, Time Machine style.
+      Backups are sorted into tiers by age and, within each tier,
+      only the oldest backup of every interval is kept; e.g., hourly
+      backups for a day, daily backups for a month, and weekly ones
+      after that. The other backups are redundant. When space is
+      needed, the smallest set of backups that frees it is chosen,
+      redundant backups first, using the disk usage accounting to
+      find the bytes a set of backups frees when deleted together.
+    Inputs:
+      None.
+    Keywords:
+      tiers    : List of [max age, interval] pairs in hours; default
+                  from the 'retention' config key
+      date_FMT : Format of backup directory names; default from the
+                  config
+      usage    : diskUsage instance; without it, sizes are unknown
+      log      : Logger to use
+    '''
+    super().__init__();
+    self.log      = log or logging.getLogger(__name__);
+    self.tiers    = parseTiers( tiers or utils.CONFIG.get('retention', None) or TIERS );
+    self.date_FMT = date_FMT or utils.CONFIG['date_FMT'];
+    self.usage    = usage;
+
+  ##############################################################################
+  def classify(self, names, now = None):
+    '''
+    Purpose:
+      Method to sort backups into ones the retention tiers keep and
+      redundant ones
+    Inputs:
+      names : List of backup directory names
+    Keywords:
+      now   : Current time as UTC timestamp; default is now
+    Outputs:
+      Returns tuple of (keep, thin) lists of names, both oldest first.
+      Names that are not dates are always kept.
+    '''
+    now   = now or calendar.timegm( datetime.utcnow().timetuple() )
+    keep  = []
+    thin  = []
+    seen  = set()
+    dated = []
+    for name in names:
+      try:
+        date = datetime.strptime( name, self.date_FMT )
+      except ValueError:
+        keep.append( name )
+      else:
+        dated.append( (calendar.timegm( date.timetuple() ), name) )
+    dated.sort()
+    for i, (stamp, name) in enumerate( dated ):
+      age = now - stamp
+      for tier, (max_age, interval) in enumerate( self.tiers ):
+        if max_age is None or age < max_age: break
+      key = (tier, stamp // interval if interval > 0 else stamp)
+      if key in seen and i < len(dated)-1:                                      # The newest backup is always kept
+        thin.append( name )
+      else:
+        seen.add( key )
+        keep.append( name )
+    return sorted( keep ), thin
+
+  ##############################################################################
+  def plan(self, names, need, protect = (), now = None):
+    '''
+    Purpose:
+      Method to plan which backups to delete to free space
+    Inputs:
+      names   : List of backup directory names
+      need    : Number of bytes to free; if zero or less, nothing is
+                  deleted
+    Keywords:
+      protect : Names of backups never to delete; e.g., the link
+                  destination
+      now     : Current time as UTC timestamp; default is now
+    Outputs:
+      Returns dictionary with keys:
+        keep    : Backups kept by the retention tiers
+        thin    : Redundant backups
+        order   : All deletable backups in the order they should be
+                   deleted; redundant ones first, each oldest first
+        delete  : Backups to delete to free need bytes; empty when
+                   sizes are unknown
+        reclaim : Bytes freed by deleting 'delete', or None if unknown
+        sizes   : Dictionary of bytes each backup frees on its own, or
+                   None if unknown
+    '''
+    keep, thin = self.classify( names, now = now )
+    newest     = max( names, default = None )
+    thin       = [n for n in thin if n not in protect]
+    kept       = [n for n in keep if n not in protect and n != newest]
+    order      = thin + kept
+    result     = {'keep' : keep, 'thin' : thin, 'order' : order,
+                  'delete' : [], 'reclaim' : 0, 'sizes' : None}
+    shares     = self.usage.shares( names ) if self.usage is not None else None
+    if shares is None:
+      result['reclaim'] = None
+      return result
+    links, refs     = shares
+    sizes           = {name : sum( refs[key][0] for key, n in links[name] if n == refs[key][1] )
+                         for name in names}
+    result['sizes'] = sizes
+    if need <= 0: return result
+
+    chosen, freed = self.__select( sorted( thin, key = lambda n: -sizes[n] ), need, sizes, shares ); # Largest redundant backups first
+    if freed < need:                                                            # Redundant backups are not enough; add kept ones, oldest first
+      chosen, freed = self.__select( thin + kept, need, sizes, shares )
+    result['delete']  = [n for n in order if n in chosen]
+    result['reclaim'] = freed
+    return result
+
+  ##############################################################################
+  def __select(self, candidates, need, sizes, shares):
+    '''
+    Purpose:
+      Private method to select a small set of backups that frees
+      need bytes. Candidates are added in order until enough is freed
+      together; then any that can be left out, smallest first, are
+      removed again. The bytes freed are kept as a running total: an
+      inode (or chunk) is freed once the chosen backups hold all of
+      its links, so adding or removing a backup only touches the
+      inodes it links to.
+    Inputs:
+      candidates : Ordered list of backup names
+      need       : Number of bytes to free
+      sizes      : Dictionary of bytes each backup frees on its own
+      shares     : Tuple returned by the shares() method of usage
+    Outputs:
+      Returns tuple of (list of names, bytes they free together)
+    '''
+    links, refs = shares
+    held        = {};                                                           # Links of each inode held by the chosen backups
+    freed       = [0]
+    def change( name, sign ):
+      for key, n in links[name]:
+        size, total = refs[key]
+        before      = held.get( key, 0 )
+        held[key]   = before + sign * n
+        freed[0]   += size * ((held[key] == total) - (before == total))
+
+    chosen = []
+    for name in candidates:
+      chosen.append( name )
+      change( name, 1 )
+      if freed[0] >= need: break
+    if freed[0] < need: return chosen, freed[0]
+    for name in sorted( chosen, key = lambda n: sizes[n] ):
+      change( name, -1 )
+      if freed[0] >= need:
+        chosen.remove( name )
+      else:
+        change( name, 1 )
+    return chosen, freed[0]
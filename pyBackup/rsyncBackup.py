@@ -1,44 +1,40 @@
 import logging;
-from logging.handlers import RotatingFileHandler;
 
-import os, sys, time, shutil, re, signal;
+import os, sys, time, shutil, signal;
+from subprocess import check_call, CalledProcessError;
+from threading import Thread;
 from datetime import datetime;
-from subprocess import Popen, PIPE, STDOUT, DEVNULL;
 
 from . import LOGDIR, utils
+from .rsyncPool import rsyncPool, sourcePlan, rsync_errors
+from .lock import processLock, LOCKNAME
+from .destinations import destinations, getState, setState
+from .trashReaper import trashReaper
+from .catalog import snapshotCatalog, CATALOG
+from .usage import diskUsage
+from .retention import retentionPlanner
+from .journal import changeJournal
+from .excludes import excludeFilter, FILTER
+from .moves import moveDetector
+from .metrics import runMetrics, readHistory
+from .governor import resourceGovernor
+from .logs import addFileHandler
+from .transferLog import transferLog, prune as pruneTransferLogs
+from .checkpoint import backupCheckpoint, CHECKPOINT
+from .verify import snapshotVerifier
+from .casBackup import casBackup
 
-LINESEP      = str.encode( os.linesep )
-CARRET       = str.encode( '\r' )
-BUFFER       = 1024 * 4 
-rsync_errors = [1, 2, 3, 4, 5, 6, 10, 11, 12, 13, 14, 20, 21, 22, 25, 30, 35]
-part_regex   = re.compile( r'\s*((?:\d{1,3},?)+)\s+(?:\d{1,3}\%)');
-trans_regex  = re.compile( r'\s*((?:\d{1,3},?)+)\s+(?:\d{1,3}\%).+\(.+\)');
-size_regex   = re.compile( r'Total transferred file size:\s((?:\d{1,3},?)+)\sbytes' )
-
-def readLines( pipe, previous = None ):
-  data = pipe.read(BUFFER).replace(CARRET, LINESEP)
-  if previous: data = previous + data
-  try:
-    index = data.index( LINESEP )
-  except:
-    return None, data
-  else:
-    return data[:index+1], data[index+1:]
+ESTIMATE_RUNS = 10;                                                             # Runs whose transfer sizes the estimate is based on
 
 class rsyncBackup( object ):
-  def __init__(self, src_dir = '/', loglevel = logging.DEBUG):
+  def __init__(self, src_dir = '/', loglevel = logging.DEBUG, signals = True,
+                destination = None, plan = None):
     super().__init__();
     self.log         = logging.getLogger(__name__);
     self.loglevel    = loglevel;
-    self.log_file    = os.path.join(LOGDIR, 'pyBackup_rsync.log')
-    rotFile  = RotatingFileHandler(self.log_file,
-      maxBytes = 10 * 1024**2, backupCount = 4, encoding = 'utf8' );            # Initialize rotating file handler
-    rotFile.setFormatter( logging.Formatter( '%(asctime)s [%(levelname)s] %(message)s' ) )
-    rotFile.setLevel( self.loglevel );                                          # Set level to INFO
-    self.log.addHandler( rotFile );                                             # Add file handler to logger
+    self.log_file    = os.path.join(LOGDIR, 'pyBackup_rsync.log');              # Handler added when the backup runs; creating an instance writes nothing
 
     self.cmd         = ['rsync', '-a', '--stats'];                              # Base command for rsync
-    self.__updateLastBackup()
     self.mountPoint  = None;                                                    # Get the backup disk mount point
     self.backup_dir  = None;                                                    # Full path to top-level backup directory
     self.exclude_dir = None;                                                    #
@@ -49,14 +45,36 @@ class rsyncBackup( object ):
     self.prog_dir    = None;
     self.src_dir     = src_dir;
     self.link_dir    = None;
+    self.link_dirs   = [];                                                      # Backups given to rsync as link destinations; link_dir first
     self.backup_size = None;
-    self.progress    = 0.0;
-    self.lock_file   = '/tmp/pyBackup.lock'
+    self.destination = destination;                                             # Destination dictionary; default is the first configured
+    self.uuid        = None;                                                    # UUID of the destination disk
+    self.plan        = plan;                                                    # sourcePlan shared with backups to other destinations
+    self.stats       = {};                                                      # Stats parsed from rsync --stats output
+    self.metrics     = runMetrics( 'rsync', log = self.log );                   # Phase timings and counters of the run
+    self.__pool      = None;                                                    # rsyncPool instance running the transfer
+    self.__reaper    = None;                                                    # trashReaper instance deleting old backups
+    self.__catalog   = None;                                                    # snapshotCatalog of backup contents
+    self.__usage     = None;                                                    # diskUsage accounting of space used by backups
+    self.__journal   = None;                                                    # changeJournal of paths changed since the last backup
+    self.__recorded  = None;                                                    # journalChanges, even when not used for the transfer
+    self.__checkpoint = None;                                                   # backupCheckpoint of finished subtrees
+    self.__transfers = None;                                                    # transferLog of the files of this backup
+    self.__governor  = None;                                                    # resourceGovernor throttling rsync and deletion
+    self.__verifier  = None;                                                    # snapshotVerifier checksumming backed up files
+    self.__filter    = None;                                                    # excludeFilter of the source
+    self.__mounts    = [];                                                      # Mount points of backup disks; never backed up
+    self.__waiting   = False;                                                   # Set while waiting for old backups to be deleted
+    self.__pruneProgress = 0.0;
+    self.__pruneStatus   = 0.0;                                                 # Time of last prune status update
+    self.__lock      = None;                                                    # processLock of the backup directory
+    self.__resumed   = False;                                                   # Set if a canceled backup is finished by this run
     self.statusTXT   = '';
     self.rsyncStatus = -1;
     self.__cancel    = False;
-    for sig in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT]:
-      signal.signal(sig, self.cancel);
+    if signals:                                                                 # The daemon handles signals itself
+      for sig in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT]:
+        signal.signal(sig, self.cancel);
 
   ##############################################################################
   @property
@@ -77,160 +95,476 @@ class rsyncBackup( object ):
     if value != '': self.log.info( value );
     self.__statusTXT = value;                                                  # Set private variable
   
+  #########
+  @property
+  def progress(self):
+    '''Percent complete of deleting old backups or of the transfer'''
+    if self.__waiting: return self.__pruneProgress
+    return self.__pool.progress if self.__pool else 0.0
+  #########
+  @property
+  def eta(self):
+    '''Estimated time remaining for the transfer, in seconds'''
+    return self.__pool.eta if self.__pool else None
+  #########
+  @property
+  def bytes_done(self):
+    '''Bytes transferred so far'''
+    return self.__pool.bytes if self.__pool else 0
+  #########
+  @property
+  def files_done(self):
+    '''Files done so far; only counted when rsync output is itemized'''
+    return self.__pool.files if self.__pool else 0
+
   ##############################################################################
   def cancel(self, *args):
     self.log.error( args )
     self.statusTXT = 'Canceling backup'
     self.__cancel  = True;
+    if self.__governor: self.__governor.stop();                                 # Resume anything paused, so it can stop
+    if self.__pool:   self.__pool.cancel();
+    if self.__reaper: self.__reaper.cancel();
+    if self.__verifier: self.__verifier.cancel();
   
   ##############################################################################
-  def backup(self):
-   # Check for lock file
-    if os.path.isfile( self.lock_file ):                                        # If lock file exists
-      self.log.debug('Lock file exists, is there a backup running?')
-      return;                                                                   # Return from method
-    else:
-      self.log.debug('Creating lock file')
-      open( self.lock_file, 'w' ).close();                                      # Create lock file
- 
+  def backup(self, mountPoint = None):
+    '''
+    Purpose:
+      Method to run a backup and record its metrics in the run history
+    Keywords:
+      mountPoint : Mount point of the backup disk; default looks it up
+    Outputs:
+      Returns 0 on success, 1 on failure, and None if the backup
+      directory is locked by another process
+    '''
+    addFileHandler( self.log, self.log_file, self.loglevel );                   # Written by a background thread
+    self.__updateLastBackup()
+    self.metrics = runMetrics( 'rsync', log = self.log )
+    try:
+      status     = self.__backup( mountPoint )
+    except BaseException:                                                       # Keep what the journal recorded; the partial backup is resumed or cleaned up next run
+      if self.__journal:   self.__journal.abort()
+      if self.__transfers: self.__transfers.discard()
+      if self.__pool:      self.__pool.cancel()
+      if self.__reaper:                                                         # Stop deleting before the lock is released
+        self.__reaper.cancel()
+        self.__reaper.join()
+      raise
+    finally:
+      if self.__governor: self.__governor.stop()
+      self.__removeLock();                                                      # Also on errors; a resident daemon would keep the disk locked otherwise
+    if status is not None:
+      if self.__governor:                                                       # Throttling decisions go in the run record
+        for key, value in self.__governor.stats.items():
+          self.metrics.count( key, round( value, 3 ) )
+      self.metrics.save( status, stats = self.stats, returncode = self.rsyncStatus if status else 0 )
+    return status
+
+  ##############################################################################
+  def __backup(self, mountPoint = None):
     # Check backup disk set
-    if not utils.CONFIG['disk_UUID']:                                            # If the backup disk has not been setup yet
+    if self.destination is None:
+      dests = destinations()
+      self.destination = dests[0] if dests else None
+    if not self.destination:                                                    # If the backup disk has not been setup yet
       self.log.error( 'Backup disk NOT set!' )
-      self.__removeLock();
       return 1
+    self.uuid = self.destination['uuid']
 
     # Check backup disk mounted
-    self.mountPoint = utils.get_MountPoint( utils.CONFIG['disk_UUID'] );         # Get the backup disk mount point
+    self.mountPoint = mountPoint or utils.get_MountPoint( self.uuid );          # Get the backup disk mount point, unless already known
     if not self.mountPoint:                                                     # If no mount point found, i.e, not mounted
       self.log.info( 'Backup disk NOT mounted!' )
-      self.__removeLock();
       return 1
+    self.backup_dir  = os.path.join(self.mountPoint, self.destination['backup_dir']);# Full path to top-level backup directory
+
+    # Lock the backup directory
+    self.__lock = processLock( os.path.join( self.backup_dir, LOCKNAME ), log = self.log )
+    if not self.__lock.acquire():
+      self.log.debug('Backup directory locked, is there a backup running?')
+      return;                                                                   # Return from method
+    self.metrics.begin( self.uuid )
 
     ## Exclude directories
-    cmd = self.cmd + [ '--exclude={}'.format( self.mountPoint) ];               # Append src directory path as exclude
-    # Backing up!
-    self.backup_dir  = os.path.join(self.mountPoint, utils.CONFIG['backup_dir']);# Full path to top-level backup directory
-    for dir in utils.CONFIG['exclude']:
-      cmd.append( '--exclude={}'.format( dir ) );      
-    for dir in utils.CONFIG['user_exclude']: 
-      cmd.append( '--exclude={}'.format( dir ) );
+    self.__mounts = [ self.mountPoint ]
+    for dest in destinations():                                                 # Never back up other backup disks
+      other = utils.get_MountPoint( dest['uuid'] ) if dest['uuid'] != self.uuid else None
+      if other: self.__mounts.append( other )
+    self.__filter = excludeFilter( self.src_dir, mounts = self.__mounts, log = self.log )
 
     self.latest_dir  = os.path.join( self.backup_dir, 'Latest' );               # Set the Latest link path in the backup directory
+    self.__governor  = resourceGovernor( self.backup_dir, log = self.log )
+    self.__governor.start()
+    self.__reaper    = trashReaper( self.backup_dir,
+      workers  = utils.CONFIG.get('prune_workers', 4),
+      callback = self.__pruneCallback,
+      governor = self.__governor, log = self.log )
+    self.__reaper.start();                                                      # Resume deleting anything left in the trash by an earlier run
+    if utils.CONFIG.get('catalog', True):
+      self.__catalog = snapshotCatalog( os.path.join(self.backup_dir, CATALOG), log = self.log )
+      self.__usage   = diskUsage( self.__catalog, log = self.log )
+    self.__filter.discover( self.__catalog );                                   # Directories with a cache tag or marker file
+    cmd = self.cmd + ['--filter=merge {}'.format( self.__filter.write( os.path.join( self.backup_dir, FILTER ) ) )]
     date             = datetime.utcnow();                                       # Get current UTC date
     date_str         = date.strftime( utils.CONFIG['date_FMT']    );             # Format date to string
 
-    self.__getDirList( self.backup_dir );                                       # Get list of vaild backup directories
+    with self.metrics.phase( 'list' ):
+      self.__getDirList( self.backup_dir );                                     # Get list of vaild backup directories
+      if self.__usage: self.__checkUsage();
     self.dst_dir  = os.path.join(  self.backup_dir, date_str );                 # Set up destination directory
     self.prog_dir = self.dst_dir + '.inprogress';                               # Set up progress directory
     if len( self.backups['partial'] ) > 0:                                      # If there are canceled backups still hanging around
       self.log.info('Using latested canceled backup, should save some time.')
       os.rename( self.backups['partial'][-1], self.prog_dir );                  # Rename the newest canceled backup to match the current .inprogress directory, this may save some time
+      self.__resumed = True
+      if os.path.isfile( self.backups['partial'][-1] + CHECKPOINT ):            # Keep its checkpoint so finished subtrees are skipped
+        os.rename( self.backups['partial'][-1] + CHECKPOINT, self.prog_dir + CHECKPOINT )
       cmd.append( '--delete' );                                                 # Append delete option to cmd; there may be flies in the canceled backup that no longer exists on the computer
     self.backups['partial'].append( self.prog_dir );                            # Append current in progress directory to that list
 
     # Link directory to reduce backup size
     self.link_dir = self.__getLinkDir();
-    if self.link_dir: cmd.append( '--link-dest={}'.format( self.link_dir ) );   # If a directory is returned, add link directory to cmd
 
-    self.backup_size = self.__getTransferSize( cmd );
-    if self.backup_size == 0:                                                   # If nothing has changed:
-      self.log.info('No files have changed, skipping backup');
-      self.__removeLock();
-      return 0;
+    changes = self.__journalChanges();                                          # None means a full scan
+    if self.__unchanged():                                                      # Decided before anything is transferred or linked
+      self.log.info('No changes recorded since the last backup, skipping backup');
+      self.__journal.commit();
+      self.__cleanUp();
+      self.statusTXT   = 'Finished'
+      self.rsyncStatus = 0
+      return 0
 
-    self.__removeDirs( );
-    self.rsyncStatus = self.__transfer( cmd );
+    self.backup_size = self.__estimateTransferSize();                          # Estimate from previous run; no dry run needed
+    with self.metrics.phase( 'prune' ):
+      self.metrics.count( 'bytes_freed', self.__removeDirs( ) )
+    self.link_dirs = self.__getLinkDirs();                                      # After expiring, so all of them still exist
+    for link_dir in self.link_dirs:
+      cmd.append( '--link-dest={}'.format( link_dir ) );                        # rsync links from the first that has the file unchanged
+    self.rsyncStatus = self.__transfer( cmd, changes );
     if (self.rsyncStatus not in rsync_errors) and (not self.__cancel):          # If no bad error has ben returned from rsync AND backup has NOT been canceled
+      if self.__journal: self.__journal.commit();
+      if self.__checkpoint: self.__checkpoint.remove();
+      if self.__identical():                                                    # Without the journal, known only once rsync scanned the source
+        self.log.info('No files have changed, skipping backup');
+        if self.__catalog: self.__catalog.drop();
+        if self.__transfers: self.__transfers.discard();
+        self.__reaper.trash( self.prog_dir );                                   # Snapshot is identical to link_dir, so drop it
+        self.__cleanUp();
+        self.statusTXT   = 'Finished'
+        self.rsyncStatus = 0
+        return 0
+      if self.__catalog:
+        self.statusTXT = 'Updating catalog'
+        with self.metrics.phase( 'catalog' ):
+          self.__catalog.finish( self.prog_dir );
+          self.__usage.add( os.path.basename( self.dst_dir ) );
       self.log.info( 'Moving : {} ---> {}'.format(self.prog_dir, self.dst_dir ) )
       os.rename(  self.prog_dir, self.dst_dir );                                # Move the .inprogress directory to normal name
+      if self.__transfers and self.__transfers.close():
+        self.log.info( 'Files: {}; listed in {}'.format(self.__transfers.summary(), self.__transfers.path) )
       if os.path.exists( self.latest_dir):
         os.remove(  self.latest_dir );                                          # Delete the 'Latest' link
       os.symlink( self.dst_dir, self.latest_dir );                              # Create 'Latest' link pointed at newest backup
-      utils.CONFIG['backup_size'] += self.backup_size;
-      utils.CONFIG['last_backup']  = date_str;                                  # Update the last backup date string
-      utils.CONFIG['days_since_last_backup'] = 0;                               # Update days since last backup
-      utils.CONFIG.saveConfig( )                                                # Update the config file
+      with utils.CONFIG.transaction():                                          # Written to the config file at once
+        if self.__usage: setState( self.uuid, backup_size = self.__usage.total() );# Exact size of all accounted backups
+        setState( self.uuid, last_backup = date_str, last_stats = self.stats,  # Recorded stats are the source of truth for the next run
+                  src_dir = self.src_dir );                                     # Where restored paths are relative to
+        utils.CONFIG['last_backup']  = date_str;                                # Update the last backup date string
+        utils.CONFIG['days_since_last_backup'] = 0;                             # Update days since last backup
+      self.__verify();
       self.__cleanUp();
       self.statusTXT   = 'Finished'
       self.rsyncStatus = 0
       return 0
     elif (self.rsyncStatus != 0):
       self.log.critical('Backup failed! Return code : {}'.format(self.rsyncStatus) )
+    if self.__journal: self.__journal.abort();
+    if self.__transfers: self.__transfers.discard();
+    if self.__catalog:
+      if self.__checkpoint:
+        self.__catalog.flush();                                                 # Keep entries for resuming
+      else:
+        self.__catalog.drop();
+    self.__emptyTrash();
     self.__removeLock();
     self.rsyncStatus = 1
     return 1
   
+  ##############################################################################
+  def __verify(self):
+    '''
+    Purpose:
+      Private method to checksum the files the new backup wrote and
+      read back a budgeted sample of older ones; see snapshotVerifier.
+      Damaged files are logged; the backup itself succeeded.
+    Inputs:
+      None.
+    Outputs:
+      None.
+    '''
+    if not self.__catalog or not utils.CONFIG.get('checksums', True): return
+    self.__verifier = snapshotVerifier( self.backup_dir, self.__catalog, log = self.log )
+    rate = utils.CONFIG.get('verify_rate', 0)
+    self.statusTXT = 'Checksumming files'
+    with self.metrics.phase( 'checksum' ):
+      self.__verifier.record( os.path.basename( self.dst_dir ), rate = rate )
+    self.metrics.count( 'bytes_checksummed', self.__verifier.stats['bytes'] )
+    budget = utils.CONFIG.get('verify_budget', 0)
+    if budget and not self.__cancel:
+      self.statusTXT = 'Verifying backups'
+      with self.metrics.phase( 'verify' ):
+        bad = self.__verifier.verify( budget = budget, rate = rate )
+      self.metrics.count( 'bytes_verified', self.__verifier.stats['bytes'] )
+      self.metrics.count( 'files_damaged', len(bad) )
+
   ##############################################################################
   def __removeLock(self):
-    if os.path.isfile( self.lock_file ): 
-      self.log.debug('Removing lock file');
-      os.remove( self.lock_file );                                              # Delete lock file
+    if self.__lock and self.__lock.locked():
+      self.log.debug('Releasing lock');
+      self.__lock.release();                                                    # Release lock of the backup directory
   
   ##############################################################################
   def __cleanUp(self):
+    with self.metrics.phase( 'cleanup' ):
+      self.__cleanUpDirs()
+
+  ##############################################################################
+  def __cleanUpDirs(self):
     self.statusTXT = 'Cleaning up'
     for dir in self.backups['partial']:                                         # Iterate over directories where backup was in progress
       if os.path.isdir( dir ):
-        shutil.rmtree( dir );                                                   # Delete the directory
+        self.__reaper.trash( dir );                                             # Move the directory to the trash
+      if os.path.isfile( dir + CHECKPOINT ):
+        os.remove( dir + CHECKPOINT );
     for dir in self.backups['cancelled']:                                       # Iterate over directories where backup was in progress
       if os.path.isdir( dir ):
-        shutil.rmtree( dir );                                                   # Delete the directory
+        self.__reaper.trash( dir );                                             # Move the directory to the trash
+    pruneTransferLogs( self.backup_dir );                                       # Logs of backups that were deleted
     if not os.path.lexists( self.latest_dir ):                                  # If the 'Latest' directory does NOT exists
       if self.link_dir:                                                         # If the link_dir attribute is set
         os.symlink( self.link_dir, self.latest_dir );                           # Create symlink to link-dest dir
+    self.__emptyTrash();
     self.__removeLock();
-  
+
   ##############################################################################
-  def __getTransferSize(self, cmd):
-    self.statusTXT = 'Calculating backup size'
-    proc = Popen( cmd + ['-n', self.src_dir, self.prog_dir], 
-      stdout = PIPE, stderr = STDOUT) 
-
-    lines = proc.stdout.read( BUFFER ).splitlines(True)
-    while lines and (not self.__cancel):
-      line = lines.pop(0)
-      if not line.endswith(LINESEP):                                            # If line not end in line separater
-        lines = line + b''.join(lines) + proc.stdout.read(BUFFER)               # Join lines list on '', prepend line, and append another read
-        lines = lines.splitlines(True)
-      else:
-        line       = line.decode()
-        trans_size = size_regex.findall( line );
-        if len(trans_size) == 1:
-          backup_size = int( trans_size[0].replace(',','') );
-          self.log.info( 'Backup size: {}'.format(backup_size) )
-          break
-    if self.__cancel:
-      proc.terminate();
-      backup_size = None;
-    proc.communicate();
-    return backup_size;
+  def __emptyTrash(self):
+    '''
+    Purpose:
+      Private method to wait for the background deletion of trashed
+      backups to finish; the new backup is already in place by now.
+      The lock is held until then so that two runs never delete the
+      same trash.
+    Inputs:
+      None.
+    Outputs:
+      None.
+    '''
+    if self.__reaper.running():
+      self.statusTXT = 'Emptying trash'
+      self.__reaper.join()
+    self.__reaper.takeFreed()
   
   ##############################################################################
-  def __transfer(self, cmd):
-    self.statusTXT = 'Backing up {}'.format(self.__size_fmt(self.backup_size));
-    cmd  = cmd + ['--progress', self.src_dir, self.prog_dir]
-    self.log.info( 'Full rsync cmd : {}'.format(cmd) )
-    proc = Popen( cmd, stdout=PIPE, stderr=STDOUT )    # Run rsync command
-    transfered = 0;                                                             # Initialize total transferd size
-    line, remain = readLines( proc.stdout )                                     # Read first line form stdout
-    while (line or remain) and (not self.__cancel):                             # While line is NOT empty
-      if line and line.endswith(LINESEP):                                       # If line not end in line separater
-          line = line.decode()
-          trans_size = part_regex.findall( line )                               # Try to find total size of transfered file
-          if len(trans_size) == 0 and (line != os.linesep):                     # If no number found, assume it is a file path
-            self.log.debug( line.rstrip() )                                     # Log the file being backed up
-          elif len(trans_size) == 1:                                            # If only one number found
-            trans_size    = int( trans_size[0].replace(',','') )                # Convert file size to integer
-            self.progress = 100 * (transfered + trans_size) / self.backup_size  # Set progress to fraction of transfered file size
-            if '(' in line: transfered += trans_size;                           # If there is a '(' in file, it means file finished transfering
-      line, remain = readLines( proc.stdout, previous = remain )      
-
-    self.progress = 100;                                                        # Ensure that percentage is 100
-    if self.__cancel:
-      proc.terminate();
-
-    proc.communicate();                                                         # Close the PIPEs and everything
-    return proc.returncode
+  def __estimateTransferSize(self):
+    '''
+    Purpose:
+      Private method to estimate the size of the upcoming transfer
+      without running a dry run of rsync over the whole source tree.
+      The largest 'Total transferred file size' of the last few runs
+      to this destination, times transfer_margin, is used, and never
+      less than transfer_floor bytes, so a burst of changes does not
+      catch the pruning short; if the disk fills anyway, more old
+      backups are deleted and the transfer retried (see __transfer).
+      It is only used for pruning old backups before the transfer.
+    Inputs:
+      None.
+    Outputs:
+      Returns estimated transfer size in bytes
+    '''
+    sizes = [ r.get('bytes_transferred', 0) for r in
+                readHistory( last = ESTIMATE_RUNS, destination = self.uuid ) if r.get('status', None) == 0 ]
+    sizes.append( self.__lastStats().get('total_transferred_file_size', 0) )
+    size  = max( max( sizes ) * utils.CONFIG.get('transfer_margin', 1.5),
+                 utils.CONFIG.get('transfer_floor', 1024**3) )
+    self.log.info( 'Estimated backup size: {}'.format(self.__size_fmt(size)) )
+    return int( size )
+
+  ##############################################################################
+  def __unchanged(self):
+    '''
+    Purpose:
+      Private method to determine, before anything is transferred,
+      that nothing changed on the source since the previous backup,
+      so the backup can be skipped. The change journal is the only
+      cheap source of truth for that; without it (or when it can not
+      be trusted) the backup runs, as finding out otherwise takes the
+      same scan of the source as the backup itself, and unchanged
+      files are only hard linked.
+    Inputs:
+      None.
+    Outputs:
+      Returns True if nothing changed, False otherwise
+    '''
+    if self.__recorded is None or len(self.__recorded) != 0: return False
+    if not self.link_dir or os.path.exists( self.prog_dir ): return False;      # Nothing to skip to, or a partial backup to finish
+    return True
+
+  ##############################################################################
+  def __identical(self):
+    '''
+    Purpose:
+      Private method to determine, after the transfer, that the new
+      backup is identical to link_dir, so it can be dropped and the
+      'Latest' link kept; this is how idle hours are skipped without
+      the change journal. The stats of the transfer must show no
+      files transferred or deleted, and the same number of files of
+      the same total size as the stats recorded for the previous run.
+    Inputs:
+      None.
+    Outputs:
+      Returns True if nothing changed, False otherwise
+    '''
+    last_stats = self.__lastStats()
+    if not last_stats or not self.link_dir or not self.stats: return False
+    if self.__resumed or self.rsyncStatus != 0: return False;                 # Partial tree may differ from link_dir; vanished files are changes
+    if self.stats.get('number_of_regular_files_transferred', 1) != 0: return False
+    if self.stats.get('number_of_deleted_files', 0) != 0: return False
+    for key in ['number_of_files', 'total_file_size']:
+      if self.stats.get(key, None) != last_stats.get(key, None): return False
+    return True
+
+  ##############################################################################
+  def __transfer(self, cmd, changes = None):
+    '''
+    Purpose:
+      Private method to run the actual transfer. Progress and ETA are
+      streamed from the overall progress output of rsync and the
+      transfer stats are parsed from the --stats summary at the end,
+      so the source tree is only walked once. When more than one
+      worker is configured, the top-level subtrees of the source are
+      transferred by that many rsync processes at once. When changes
+      from the journal are given, the previous backup is cloned and
+      only the changed paths are transferred.
+    Inputs:
+      cmd     : Base rsync command
+    Keywords:
+      changes : journalChanges instance, or None for a full scan
+    Outputs:
+      Returns the rsync return code
+    '''
+    if self.backup_size:
+      self.statusTXT = 'Backing up ~{}'.format(self.__size_fmt(self.backup_size));
+    else:
+      self.statusTXT = 'Backing up'
+    history     = utils.CONFIG.get('subtree_stats', None) or {}
+    with self.metrics.phase( 'clone' ):
+      files_from = self.__cloneLinkDir( changes ) if changes is not None else None
+    if files_from is None and utils.CONFIG.get('checkpoints', True):
+      self.__checkpoint = backupCheckpoint( self.prog_dir + CHECKPOINT, self.src_dir,
+        os.path.basename( self.dst_dir ),
+        changes = self.__recorded,
+        log     = self.log )
+    with self.metrics.phase( 'moves' ):
+      self.__linkMoved( changes if files_from is not None else None )
+    if self.__catalog:
+      link = os.path.basename( self.link_dir ) if self.link_dir else None
+      self.__catalog.begin( os.path.basename( self.dst_dir ), link = link,
+        carry  = files_from is not None,
+        resume = self.__checkpoint.resumed if self.__checkpoint else None )
+    if utils.CONFIG.get('transfer_log', True):
+      self.__transfers = transferLog( self.backup_dir, os.path.basename( self.dst_dir ), log = self.log )
+    self.__pool = rsyncPool( cmd, self.src_dir, self.prog_dir,
+      workers    = utils.CONFIG.get('rsync_workers', 1),
+      history    = history.get( self.src_dir, None ),
+      catalog    = self.__catalog,
+      files_from = files_from,
+      checkpoint = self.__checkpoint,
+      plan       = self.plan if files_from is None else None,
+      transfers  = self.__transfers,
+      governor   = self.__governor,
+      log        = self.log )
+    if self.__cancel: return 20
+    with self.metrics.phase( 'transfer' ):
+      returncode = self.__pool.run()
+    if returncode != 0 and self.__pool.nospace and not self.__cancel:          # Estimate fell short; make room once more
+      if self.__makeRoom():
+        self.statusTXT = 'Retrying backup'
+        with self.metrics.phase( 'transfer' ):
+          returncode = self.__pool.run()
+    self.stats = self.__pool.stats
+    if files_from is not None:                                                  # Only changes were scanned; totals are those of the previous run
+      last_stats = self.__lastStats()
+      for key in ['number_of_files', 'total_file_size']:
+        self.stats[key] = last_stats.get( key, self.stats.get(key, 0) )
+    elif returncode == 0:
+      history[ self.src_dir ]       = self.__pool.subtreeStats;                # Save per-subtree stats for balancing the next run
+      utils.CONFIG['subtree_stats'] = history
+    self.backup_size = self.stats.get('total_transferred_file_size', self.backup_size)
+    return returncode
+
+  ##############################################################################
+  def __journalChanges(self):
+    '''
+    Purpose:
+      Private method to take the changes recorded by the watcher since
+      the last backup. The journal is rotated whenever it is enabled,
+      so a full scan also makes the next run able to use it.
+    Inputs:
+      None.
+    Outputs:
+      Returns journalChanges instance, or None if a full scan is
+      needed
+    '''
+    self.__journal  = None
+    self.__recorded = None
+    if not utils.CONFIG.get('journal', False): return None
+    if len( destinations() ) > 1:                                               # One journal can not track what each destination has
+      self.log.info( 'Change journal is only used with one destination; full scan' )
+      return None
+    self.__journal  = changeJournal( self.src_dir, log = self.log );            # Same excludes as the transfer
+    changes         = self.__journal.begin()
+    self.__recorded = changes;                                                  # Also used to decide which checkpointed subtrees changed
+    if changes is None: return None
+    if not self.link_dir or os.path.exists( self.prog_dir ):                    # Nothing to clone, or resuming a partial backup
+      self.log.info( 'No previous backup to clone; full scan' )
+      return None
+    if len(changes) > utils.CONFIG.get('journal_max', 100000):
+      self.log.info( '{} changes recorded; full scan'.format(len(changes)) )
+      return None
+    self.log.info( 'Changes recorded since last backup: {} directories, {} new trees, {} files'.format(
+      len(changes.dirs), len(changes.trees), len(changes.files) ) )
+    return changes
+
+  ##############################################################################
+  def __cloneLinkDir(self, changes):
+    '''
+    Purpose:
+      Private method to prepare a transfer of only the changed paths.
+      The previous backup is cloned into the .inprogress directory
+      with hard links; rsync then updates the changed directories and
+      copies the new trees. Changed files are unlinked from the clone
+      first, so rsync never changes the metadata of an inode that is
+      shared with older backups.
+    Inputs:
+      changes : journalChanges instance
+    Outputs:
+      Returns list for rsyncPool files_from, or None if the clone
+      failed and a full scan is needed
+    '''
+    self.statusTXT = 'Cloning previous backup'
+    try:
+      check_call( ['cp', '-al', self.link_dir, self.prog_dir] )
+    except (OSError, CalledProcessError) as err:
+      self.log.error( 'Failed to clone previous backup, doing full scan: {}'.format(err) )
+      if os.path.isdir( self.prog_dir ): self.__reaper.trash( self.prog_dir );
+      return None
+    prog = os.fsencode( self.prog_dir )
+    for path in changes.files:
+      dst = os.path.join( prog, changes.relative( path ) )
+      if os.path.lexists( dst ) and not os.path.isdir( dst ):
+        os.unlink( dst )
+    return self.__journal.lists( changes )
 
   ##############################################################################
   def __getDirList( self, backup_dir ):
@@ -240,6 +574,7 @@ class rsyncBackup( object ):
     self.backups = {'full' : [], 'partial' : [], 'cancelled' : []};             # Dictionary with lists of various backup directories
     for dir in listdir:                                                         # Iterate over directories in listdir
       tmp = os.path.join( backup_dir, dir);                                     # Generate full file path
+      if dir.startswith('.'): continue;                                         # Skip hidden directories; e.g., the trash
       if os.path.isdir(tmp) and ( not os.path.islink(tmp) ):                    # If the path is a directory and is NOT a symbolic link
         if '.inprogress' in dir:                                                # If the directory has '.inprogress' in the name
           self.backups['partial'].append( tmp );                                # Directory is in progress
@@ -264,45 +599,223 @@ class rsyncBackup( object ):
     self.log.debug('Latest dir : {}'.format( link_dir ) )
     return link_dir;                                                            # Return link_dir
 
+  ##############################################################################
+  def __getLinkDirs(self):
+    '''
+    Purpose:
+      Private method to get the backups to offer rsync as link
+      destinations; the 'Latest' backup first, then the newest others,
+      up to 'link_dest_count'. A file that changed since the latest
+      backup but matches an older one, e.g., one that was restored, is
+      then linked instead of copied.
+    Inputs:
+      None.
+    Outputs:
+      Returns list of paths
+    '''
+    if not self.link_dir: return []
+    count = min( max( utils.CONFIG.get('link_dest_count', 3), 1 ), 20 );        # rsync accepts at most 20
+    dirs  = [self.link_dir]
+    for path in reversed( self.backups['full'] ):
+      if len(dirs) >= count: break
+      if os.path.realpath( path ) != os.path.realpath( self.link_dir ): dirs.append( path )
+    return dirs
+
+  ##############################################################################
+  def __linkMoved(self, changes = None):
+    '''
+    Purpose:
+      Private method to hard link files that were moved on the source
+      into the .inprogress directory before the transfer, so rsync
+      does not copy them again (see moveDetector). The catalog is the
+      index of backed up files, so this needs it, and the change
+      journal tells which trees and files are new. Without the
+      journal, finding them would take another walk of the source
+      before rsync walks it, so moves are left to rsync.
+    Keywords:
+      changes : journalChanges instance, or None for a full scan; the
+                 changes the journal recorded are used then, if any
+    Outputs:
+      None.
+    '''
+    if not utils.CONFIG.get('move_detection', True) or not self.link_dir or not self.__catalog: return
+    changes = changes if changes is not None else self.__recorded
+    if changes is None or not (changes.trees or changes.files): return
+    detector = moveDetector( self.src_dir, self.__catalog, self.link_dirs,
+      excluded = self.__filter,
+      min_size = utils.CONFIG.get('move_min_size', 1024**2),
+      verify   = utils.CONFIG.get('move_verify', False),
+      log      = self.log )
+    self.statusTXT = 'Looking for moved files'
+    if not detector.index() or self.__cancel: return
+    self.metrics.count( 'moved_links', detector.link( self.prog_dir, changes.trees, changes.files ) )
+
+  ##############################################################################
+  def __checkUsage(self):
+    '''
+    Purpose:
+      Private method to bring the disk usage accounting up to date
+      with the backups on disk. Cataloged backups not yet accounted
+      for are added and backups deleted by hand are removed; the
+      accounted total is then cross-checked against the file system.
+    Inputs:
+      None.
+    Outputs:
+      None.
+    '''
+    self.__usage.update()
+    names  = [os.path.basename(d) for d in self.backups['full']]
+    result = self.__usage.check( self.backup_dir, names )
+    for name in result['stale']:
+      self.__usage.remove( name )
+      self.__catalog.drop( name, prune = False )
+    if result['stale']: self.__catalog.prunePaths()
+    setState( self.uuid, backup_size = self.__usage.total() )
+
+  ##############################################################################
+  def __lastStats(self):
+    '''Return stats of the last backup to this destination'''
+    return getState( self.uuid, 'last_stats', None ) or {}
+
+  ##############################################################################
+  def __makeRoom(self):
+    '''
+    Purpose:
+      Private method to delete more old backups after the backup disk
+      filled up during the transfer. The transfer is expected to need
+      at least what it wrote so far again, on top of the estimate;
+      the backups rsync links from are kept.
+    Inputs:
+      None.
+    Outputs:
+      Returns True if space was freed, or there is room for the
+      transfer now, so it can be retried
+    '''
+    self.log.warning( 'Backup disk full; deleting more old backups' )
+    before           = self.__available()
+    self.backup_size = self.backup_size + max( self.__pool.bytes, self.backup_size )
+    with self.metrics.phase( 'prune' ):
+      self.metrics.count( 'bytes_freed', self.__removeDirs() );                # Waits until the space is actually free
+    available = self.__available()
+    return available > before or available >= self.backup_size
+
   ##############################################################################
   def __removeDirs( self ):
     '''
     Purpose:
-      A function to recursively delete a directory while tracking
-      the size of the directory excluding all hard/symlink sizes.
-      File size is track by ignoring multiply linked files because
-      deleting one copy of a multiply hard linked file does NOT 
-      reduce the size of the top level directory. Only when all
-      copies are delete does the total size of the directory
-      decrease.
+      A function to expire old backups until the current backup fits
+      on the disk. The retention planner picks the backups to expire:
+      redundant backups first, then the oldest kept ones, choosing the
+      smallest set that frees enough space when it is known. Free
+      space is read from the file system, so it is always correct,
+      and the bytes each expired backup frees are taken from the disk
+      usage accounting; only inodes whose last link is in the expired
+      backup count. Expired backups are moved to the trash and deleted
+      in the background; this only blocks when the space a backup
+      frees is not known, or when the current backup does not fit
+      until the trash is emptied. The backup used as link destination
+      is never deleted.
     Inputs:
-      dirPath  : Path to directory to clear out
+      None.
     Outputs:
-      Returns the size of files deleted.
-    '''
-    def localRemove():
-      used = utils.CONFIG['backup_size']+self.backup_size;                       # Compute diskspace used by current backups and current one
-      while used > utils.CONFIG['disk_size']:                                    # While the size of the current backup plus all other backups is larger than the drive size
-        for root, dirs, files in os.walk( self.backups['full'].pop(0), topdown=False ):# Walk the directory tree
-          for file in files:                                                    # Iterate over all files
-            if self.__cancel: return;                                           # If __cancel is set, return
-            path = os.path.join( root, file );                                  # Build the full file path
-            info = os.lstat( path );                                            # Get information about file
-            if info.st_nlink == 1: utils.CONFIG['backup_size'] -= info.st_size;  # If file has only one (1) inode link, then subtract file size from config backup size
-            os.remove( path );                                                  # Delete the file
-          for dir in dirs:                                                      # Iterate over directories in root path
-            if self.__cancel: return;                                           # If __cancel is set, return
-            path = os.path.join( root, dir );                                   # Generate path to directory in root path
-            try:                                                                # Try to...
-              os.rmdir( path );                                                 # Remove directory
-            except:                                                             # on exception
-              os.remove( path );                                                # Try to remove file; may be symlink
-        os.rmdir( dirPath );                                                    # Remove the top level (input) directory
-        used = utils.CONFIG['backup_size']+self.backup_size;                     # Compute diskspace used by current backups and current one      
-        self.log.debug( 'Deleted: {}'.format(dirPath) )
+      Returns the number of bytes expected to be freed.
+    '''
     self.statusTXT = 'Deleting old backups'
-    localRemove();
-    utils.CONFIG.saveConfig(  );                                            # Update the configuration file
+    pending = 0;                                                                # Bytes the reaper will free for backups trashed here
+    freed   = 0
+    dropped = False
+    order   = None
+    while not self.__cancel:
+      pending   = max( pending - self.__reaper.takeFreed(), 0 )
+      available = self.__available()
+      if available >= self.backup_size: break;                                  # Backup fits on the disk as it is right now
+      if order is None: order = self.__expireOrder();                          # Only plan when something has to go
+      name       = order[0] if order else None
+      known      = name is not None and self.__usage is not None and self.__usage.accounted( name )
+      expire     = available + pending < self.backup_size;                      # Not enough even once the trash is emptied
+      if expire and name and (known or not self.__reaper.pending()):
+        path = os.path.join( self.backup_dir, order.pop(0) )
+        self.backups['full'].remove( path )
+        self.__reaper.trash( path )
+        size = self.__usage.remove( name ) if self.__usage else None
+        if self.__catalog: self.__catalog.drop( name, prune = False );
+        dropped = True
+        if size is not None:
+          pending += size
+          freed   += size
+      elif self.__reaper.pending():                                             # Wait for trashed backups to be deleted
+        self.statusTXT = 'Waiting for old backups to be deleted'
+        self.__waiting = True
+        done           = self.__reaper.waitOne()
+        self.__waiting = False
+        if not done: break
+      else:
+        self.log.warning( 'No more old backups to delete' )
+        break
+    if self.__catalog and dropped: self.__catalog.prunePaths();                 # Once for all backups deleted above
+    if self.__usage: setState( self.uuid, backup_size = self.__usage.total() )
+    utils.CONFIG.saveConfig( delay = utils.SAVE_DELAY );                        # Written with the next change, or soon
+    return freed
+
+  ##############################################################################
+  def __expireOrder(self):
+    '''
+    Purpose:
+      Private method to get the order to expire backups in from the
+      retention planner; the planned set comes first, followed by the
+      rest in case the estimates fall short
+    Inputs:
+      None.
+    Outputs:
+      Returns list of backup names
+    '''
+    names   = [os.path.basename(d) for d in self.backups['full']]
+    protect = [os.path.basename(d) for d in (self.link_dirs or [self.link_dir]) if d]
+    planner = retentionPlanner( tiers = self.destination['retention'], usage = self.__usage, log = self.log )
+    plan    = planner.plan( names, self.backup_size - self.__available(), protect = protect )
+    if plan['delete']:
+      self.log.info( 'Expiring {} backups to free {}'.format(
+        len(plan['delete']), self.__size_fmt(plan['reclaim']) ) )
+    return plan['delete'] + [n for n in plan['order'] if n not in plan['delete']]
+
+  ##############################################################################
+  def __available(self):
+    '''
+    Purpose:
+      Private method to get the space available for backups right
+      now, keeping a fraction of the disk free
+    Inputs:
+      None.
+    Outputs:
+      Returns available space in bytes
+    '''
+    info    = os.statvfs( self.backup_dir )
+    free    = info.f_bavail * info.f_frsize
+    total   = info.f_blocks * info.f_frsize
+    reserve = self.destination['disk_reserve']
+    return free - reserve * total
+
+  ##############################################################################
+  def __pruneCallback( self, files, freed ):
+    '''
+    Purpose:
+      Private method to report progress while deleting old backups.
+      The number of files in the last backup is used as the expected
+      number of entries; status updates are limited to once a second.
+    Inputs:
+      files : Number of entries deleted so far
+      freed : Number of bytes freed so far
+    Outputs:
+      None.
+    '''
+    if not self.__waiting: return
+    last_stats = self.__lastStats()
+    expected   = max( last_stats.get('number_of_files', 0), 1 )
+    self.__pruneProgress = min( 100.0 * files / expected, 100.0 )
+    if time.monotonic() - self.__pruneStatus > 1.0:
+      self.__pruneStatus = time.monotonic()
+      self.statusTXT     = 'Deleting old backups: {} files, {} freed'.format(
+        files, self.__size_fmt(freed) )
 
   ########################################################
   def __size_fmt(self, num, suffix='B'):
@@ -329,4 +842,118 @@ class rsyncBackup( object ):
       days = (datetime.utcnow() - last_backup).days                             # Compute days since last backp
       self.log.info( 'Days since last backup: {}'.format(days) )
     utils.CONFIG['days_since_last_backup'] = days;                               # Update days since last backup
-    utils.CONFIG.saveConfig( );                                          # Update config settings
+    utils.CONFIG.saveConfig( delay = utils.SAVE_DELAY );                         # Only written if it changed
+
+class multiBackup( object ):
+  def __init__(self, src_dir = '/', loglevel = logging.DEBUG, signals = True, log = None):
+    '''
+    Purpose:
+      Class to back up the source to every configured destination disk
+      that is mounted, all at once. Each destination has its own lock,
+      retention, and state, and is backed up by its own rsyncBackup,
+      or casBackup for destinations with the 'cas' backend, in a
+      thread; the source is partitioned once for all of them and
+      read in step (see sourcePlan), so it is only read about once.
+      Provides the same attributes as rsyncBackup for monitoring.
+    Inputs:
+      None.
+    Keywords:
+      src_dir  : Directory to back up
+      loglevel : Logging level
+      signals  : If set, SIGTERM and friends cancel the backups
+      log      : Logger to use
+    '''
+    super().__init__();
+    self.log         = log or logging.getLogger(__name__);
+    self.src_dir     = src_dir;
+    self.loglevel    = loglevel;
+    self.insts       = [];                                                      # rsyncBackup or casBackup instance of each destination
+    self.stats       = {};
+    self.rsyncStatus = -1;
+    self.__cancel    = False;
+    if signals:
+      for sig in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT]:
+        signal.signal(sig, self.cancel);
+
+  ##############################################################################
+  @property
+  def statusTXT(self):
+    if len(self.insts) == 1: return self.insts[0].statusTXT
+    return '; '.join( '{}: {}'.format( inst.mountPoint, inst.statusTXT ) for inst in self.insts )
+  @property
+  def progress(self):
+    if not self.insts: return 0.0
+    return sum( inst.progress for inst in self.insts ) / len(self.insts)
+  @property
+  def eta(self):
+    etas = [inst.eta for inst in self.insts if inst.eta is not None]
+    return max( etas ) if etas else None
+  @property
+  def bytes_done(self):
+    return sum( inst.bytes_done for inst in self.insts )
+  @property
+  def files_done(self):
+    return sum( inst.files_done for inst in self.insts )
+  @property
+  def backup_size(self):
+    '''Estimated bytes to transfer to all destinations, or None if unknown'''
+    sizes = [inst.backup_size for inst in self.insts]
+    return sum( sizes ) if sizes and None not in sizes else None
+
+  ##############################################################################
+  def cancel(self, *args):
+    self.__cancel = True
+    for inst in self.insts: inst.cancel()
+
+  ##############################################################################
+  def backup(self, mounts = None):
+    '''
+    Purpose:
+      Method to back up to all mounted destinations
+    Keywords:
+      mounts : Dictionary of UUID: mount point; default looks them up
+    Outputs:
+      Returns 0 if all backups succeeded, 1 if any failed or no
+      destination is mounted, and None if all were locked by another
+      process
+    '''
+    dests = destinations()
+    if not dests:
+      self.log.error( 'Backup disk NOT set!' )
+      return 1
+    if mounts is None:
+      mounts = {dest['uuid'] : utils.get_MountPoint( dest['uuid'] ) for dest in dests}
+    dests = [dest for dest in dests if mounts.get( dest['uuid'], None )]
+    if not dests:
+      self.log.info( 'Backup disk NOT mounted!' )
+      return 1
+    plan = None
+    if len([dest for dest in dests if dest['backend'] != 'cas']) > 1:
+      history = (utils.CONFIG.get('subtree_stats', None) or {}).get( self.src_dir, None )
+      plan    = sourcePlan( self.src_dir, history = history,
+        window = utils.CONFIG.get('share_window', 4), log = self.log )
+    self.insts = [ (casBackup if dest['backend'] == 'cas' else rsyncBackup)(
+                     src_dir = self.src_dir, loglevel = self.loglevel, signals = False,
+                     destination = dest, plan = plan ) for dest in dests ]
+    if self.__cancel: return 1
+    codes   = [None] * len(self.insts)
+    def run( i ):
+      try:
+        codes[i] = self.insts[i].backup( mounts[ dests[i]['uuid'] ] )
+      except Exception:                                                         # A failed run, not a locked destination
+        self.log.exception( 'Backup to {} failed'.format( dests[i]['uuid'] ) )
+        codes[i] = 1
+    threads = [ Thread( target = run, args = (i,) ) for i in range( len(self.insts) ) ]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    done       = [inst for inst, code in zip(self.insts, codes) if code == 0]
+    self.stats = max( [inst.stats for inst in done] or [{}],
+                   key = lambda stats: stats.get('number_of_regular_files_transferred', 0) )
+    if any( code not in (0, None) for code in codes ):
+      self.rsyncStatus = 1
+    elif all( code is None for code in codes ):
+      return None
+    else:
+      self.rsyncStatus = 0
+    return self.rsyncStatus
@@ -0,0 +1,153 @@
+import re;
+from collections import namedtuple;
+
+READSIZE     = 1024 * 1024                                                      # Size of each read from the pipe
+prog_regex   = re.compile( rb' *((?:\d{1,3},?)+) +(\d{1,3})% +\S+ +\d+:\d{2}:\d{2}' )
+stats_regex  = re.compile( rb'((?:Number of|Total) [\w ]+?): +((?:\d{1,3},?)+)' )
+item_regex   = re.compile( rb'([<>ch.][fdLDS][ .+?a-zA-Z]{9}) (\d+) (\S+) (.+)' )
+delete_regex = re.compile( rb'\*deleting +(?:\d+ \S+ )?(.+)' )                    # Deletions in OUT_FORMAT, or plain
+error_regex  = re.compile( rb'rsync: (.+) \((\d+)\)\s*$' )                           # Error messages end with the errno
+sep_regex    = re.compile( rb'[\r\n]' )
+OUT_FORMAT   = '%i %l %M %n'                                                    # Format of itemized output lines matched by item_regex
+ITEM_FIRST   = frozenset( b'<>ch.' )                                            # Characters itemized lines may start with
+
+FileStarted  = namedtuple( 'FileStarted',  ['path'] );                          # A new file is being transferred; path is raw bytes
+Progress     = namedtuple( 'Progress',     ['bytes', 'percent'] );              # Bytes transferred for the current file, or overall with --info=progress2
+FileFinished = namedtuple( 'FileFinished', ['bytes'] );                         # Transfer of a file finished
+Stats        = namedtuple( 'Stats',        ['key', 'value'] );                  # One value from the --stats summary
+Item         = namedtuple( 'Item',         ['flags', 'size', 'mtime', 'path'] ); # One line of itemized output in OUT_FORMAT; all raw bytes except size
+Deleted      = namedtuple( 'Deleted',      ['path'] );                          # A file was deleted from the destination; path is raw bytes
+Error        = namedtuple( 'Error',        ['errno', 'message'] );              # An error message of rsync with the errno of the failed call
+
+def toInt( val ):
+  '''Convert comma grouped number in bytes to integer'''
+  return int( val.replace(b',', b'') )
+
+class rsyncParser( object ):
+  def __init__(self, pipe, readsize = READSIZE, paths = True, items = False):
+    '''
+    Purpose:
+      Class for incremental parsing of rsync output. Data are read
+      from the pipe in large blocks into a reusable bytearray; all
+      complete lines in a block are split at once (both carriage
+      returns and newlines end a line) and matched in place with
+      bytes regexes, so nothing is decoded or copied unless it is
+      needed. Iterating over an instance yields typed events.
+    Inputs:
+      pipe     : Unbuffered pipe (or file) to read from; must have
+                  a readinto() method
+    Keywords:
+      readsize : Number of bytes to read at once
+      paths    : If False, no FileStarted events are generated, saving
+                  a copy for every file that is transferred
+      items    : If True, lines of itemized output (see OUT_FORMAT)
+                  generate Item events, and deletions generate
+                  Deleted events
+    Error events are always generated for error messages of rsync
+    that give the errno of a failed call; e.g., a full disk.
+    '''
+    super().__init__();
+    self.pipe     = pipe;
+    self.paths    = paths;
+    self.items    = items;
+    self.lines    = 0;                                                          # Number of lines parsed
+    self.__buf    = bytearray( readsize );
+    self.__start  = 0;                                                          # Start of unparsed data in buffer
+    self.__end    = 0;                                                          # End of valid data in buffer
+
+  ##############################################################################
+  def __iter__(self):
+    while self.__read():
+      yield from self.__split()
+    if self.__end > self.__start:                                               # Data left over without a line separator
+      events = []
+      self.__parse( self.__start, self.__end, events )
+      self.__start = self.__end = 0
+      yield from events
+
+  ##############################################################################
+  def __read(self):
+    '''
+    Purpose:
+      Private method to read the next block from the pipe. Unparsed
+      data are moved to the front of the buffer first; the buffer is
+      only grown when a single line does not fit.
+    Inputs:
+      None.
+    Outputs:
+      Returns number of bytes read; zero at end of file
+    '''
+    buf = self.__buf
+    if self.__start > 0:                                                        # Wrap leftover partial line around to the front
+      size = self.__end - self.__start
+      buf[:size]   = buf[self.__start:self.__end]
+      self.__start = 0
+      self.__end   = size
+    if self.__end == len(buf):                                                  # Partial line fills the whole buffer
+      buf.extend( bytes( len(buf) ) )
+    with memoryview( buf ) as view:
+      nbytes = self.pipe.readinto( view[self.__end:] ) or 0
+    self.__end += nbytes
+    return nbytes
+
+  ##############################################################################
+  def __split(self):
+    '''Return list of events for all complete lines in the buffer'''
+    events = []
+    parse  = self.__parse
+    start  = self.__start
+    for match in sep_regex.finditer( self.__buf, start, self.__end ):
+      end = match.start()
+      if end > start:
+        parse( start, end, events )
+      start = end + 1
+    self.__start = start
+    return events
+
+  ##############################################################################
+  def __parse(self, start, end, events):
+    '''
+    Purpose:
+      Private method to convert one line to events
+    Inputs:
+      start  : Start of line in buffer
+      end    : End of line in buffer; excluding separator
+      events : List to append events to
+    Outputs:
+      None.
+    '''
+    buf         = self.__buf
+    self.lines += 1
+    first       = buf[start]
+    if first == 32 or 48 <= first <= 57:                                        # Line starts with space or digit; may be progress
+      match = prog_regex.match( buf, start, end )
+      if match:
+        nbytes = toInt( match.group(1) )
+        events.append( Progress( nbytes, int( match.group(2) ) ) )
+        if buf.find( b'(xfr#', match.end(), end ) >= 0:                         # rsync appends the transfer count once the file is done
+          events.append( FileFinished( nbytes ) )
+        return
+    if first == 78 or first == 84:                                              # 'N' or 'T'; may be stats line
+      match = stats_regex.match( buf, start, end )
+      if match:
+        key = match.group(1).decode().lower().replace(' ', '_')
+        events.append( Stats( key, toInt( match.group(2) ) ) )
+        return
+    if self.items and first in ITEM_FIRST:                                      # May be itemized output
+      match = item_regex.match( buf, start, end )
+      if match:
+        flags, size, mtime, path = match.groups()
+        events.append( Item( flags, int( size ), mtime, path ) )
+        return
+    if self.items and first == 42:                                              # '*'; may be a deletion
+      match = delete_regex.match( buf, start, end )
+      if match:
+        events.append( Deleted( match.group(1) ) )
+        return
+    if first == 114:                                                            # 'r'; may be an error message
+      match = error_regex.match( buf, start, end )
+      if match:
+        events.append( Error( int( match.group(2) ), match.group(1).decode( errors = 'replace' ) ) )
+        return
+    if self.paths:
+      events.append( FileStarted( bytes( buf[start:end] ) ) )
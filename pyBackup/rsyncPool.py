@@ -0,0 +1,418 @@
+import logging;
+
+import os, time, errno;
+from threading import Thread, Lock, Condition;
+from queue import Queue, Empty;
+from subprocess import Popen, PIPE, STDOUT;
+
+from .rsyncParser import rsyncParser, OUT_FORMAT, Progress, Stats, Item, Deleted, Error
+
+FILE_COST    = 64 * 1024                                                        # Cost of one file, in bytes, when balancing subtrees; accounts for metadata work
+rsync_errors = [1, 2, 3, 4, 5, 6, 10, 11, 12, 13, 14, 20, 21, 22, 25, 30, 35]
+
+def subtreeWeight( info ):
+  '''
+  Purpose:
+    Function to compute the balancing weight of a subtree from the
+    stats recorded for it during a previous run
+  Inputs:
+    info : Dictionary with 'number_of_files' and 'total_file_size' keys
+  Outputs:
+    Returns weight of the subtree
+  '''
+  return info.get('number_of_files', 0) * FILE_COST + info.get('total_file_size', 0)
+
+class sourcePlan( object ):
+  def __init__(self, src_dir, history = None, window = 4, log = None):
+    '''
+    Purpose:
+      Class to share one partition of the source directory between the
+      pools backing it up to several destinations at once. The source
+      is listed once and every pool transfers the same subtrees in the
+      same order; a pool may only start a subtree when every other
+      pool has started one at most window subtrees before it, so all
+      destinations read the same part of the source at about the same
+      time and all but the first read hit the page cache.
+    Inputs:
+      src_dir : Directory to backup
+    Keywords:
+      history : Dictionary, keyed by subtree name, of stats from
+                 previous runs; used for balancing
+      window  : Number of subtrees a pool may run ahead of the slowest
+                 one; zero or less lets every pool run freely
+      log     : Logger to use
+    '''
+    super().__init__();
+    self.log     = log or logging.getLogger(__name__);
+    self.src_dir = src_dir;
+    self.history = history or {};
+    self.window  = window;
+    self.__names = None;                                                        # List of (name, weight), largest first
+    self.__next  = {};                                                          # Index of the next subtree of each pool
+    self.__cond  = Condition();
+
+  ##############################################################################
+  def partition(self):
+    '''
+    Purpose:
+      Method to split the source directory into its top-level
+      subdirectories, sorted largest first; listed only once. Subtrees
+      not seen during previous runs get the average weight.
+    Inputs:
+      None.
+    Outputs:
+      Returns list of (name, weight) tuples
+    '''
+    with self.__cond:
+      if self.__names is None:
+        names = []
+        with os.scandir( self.src_dir ) as it:
+          for entry in it:
+            if entry.is_dir( follow_symlinks = False ):
+              names.append( entry.name )
+        weights = [ subtreeWeight(self.history[name]) for name in names if name in self.history ]
+        default = (sum(weights) / len(weights)) if weights else 1
+        self.__names = [ (name, max( subtreeWeight( self.history[name] ) if name in self.history else default, 1 ))
+                           for name in names ]
+        self.__names.sort( key = lambda item: item[1], reverse = True )
+        self.log.debug( 'Partitioned {} into {} subtrees'.format(self.src_dir, len(self.__names)) )
+      return list( self.__names )
+
+  ##############################################################################
+  def join(self, pool):
+    '''Register a pool before it starts transferring subtrees'''
+    with self.__cond:
+      self.__next[ id(pool) ] = 0
+
+  ##############################################################################
+  def leave(self, pool):
+    '''Unregister a pool that finished or was canceled'''
+    with self.__cond:
+      self.__next.pop( id(pool), None )
+      self.__cond.notify_all()
+
+  ##############################################################################
+  def skip(self, pool, index):
+    '''Mark a subtree a pool does not transfer as started; it reads nothing'''
+    with self.__cond:
+      self.__next[ id(pool) ] = max( self.__next.get( id(pool), 0 ), index + 1 )
+      self.__cond.notify_all()
+
+  ##############################################################################
+  def start(self, pool, index, cancelled = lambda: False):
+    '''
+    Purpose:
+      Method to wait until a pool may start a subtree
+    Inputs:
+      pool      : rsyncPool instance
+      index     : Index of the subtree in the partition
+    Keywords:
+      cancelled : Function returning True if the pool was canceled
+    Outputs:
+      None.
+    '''
+    with self.__cond:
+      while self.window > 0 and not cancelled():
+        others = [n for key, n in self.__next.items() if key != id(pool)]
+        if not others or index < min(others) + self.window: break
+        self.__cond.wait( 1.0 )
+      self.__next[ id(pool) ] = max( self.__next.get( id(pool), 0 ), index + 1 )
+      self.__cond.notify_all()
+
+class rsyncJob( object ):
+  '''Class to hold information about one rsync process of the pool'''
+  def __init__(self, name, srcs, weight = 1, index = None):
+    self.name       = name;                                                     # Name of the subtree; key used for historical stats
+    self.index      = index;                                                    # Index of the subtree in a shared sourcePlan
+    self.srcs       = srcs;                                                     # List of source arguments to rsync
+    self.weight     = weight;                                                   # Weight used for balancing and progress
+    self.progress   = 0.0;                                                      # Percent complete
+    self.bytes      = 0;                                                        # Bytes transferred so far
+    self.files      = 0;                                                        # Files itemized so far
+    self.stats      = {};                                                       # Stats parsed from rsync --stats output
+    self.returncode = None;
+    self.proc       = None;
+
+class rsyncPool( object ):
+  def __init__(self, cmd, src_dir, prog_dir, workers = 1, history = None,
+                catalog = None, files_from = None, checkpoint = None, plan = None,
+                transfers = None, governor = None, log = None):
+    '''
+    Purpose:
+      Class to run one or more rsync processes that all write into the
+      same .inprogress directory. With more than one worker, the source
+      directory is partitioned into its top-level subtrees, which are
+      handed out to the workers largest first (based on the file counts
+      and sizes recorded for each subtree during previous runs) so that
+      all workers finish at about the same time.
+    Inputs:
+      cmd      : Base rsync command; includes excludes and --link-dest
+      src_dir  : Directory to backup
+      prog_dir : The .inprogress directory to backup to
+    Keywords:
+      workers  : Number of rsync processes to run at once
+      history  : Dictionary, keyed by subtree name, of stats from
+                  previous runs; used for balancing
+      catalog  : snapshotCatalog to add itemized output of all
+                  workers to
+      files_from : List of (path, recursive) tuples of NUL separated
+                  lists, relative to the parent of src_dir, for
+                  rsync --files-from. If set, only the listed paths
+                  are transferred, one list at a time, into a
+                  prog_dir that already holds a clone of the previous
+                  backup; entries ending in '/.' are directories whose
+                  contents are synced without recursing.
+      checkpoint : backupCheckpoint to record finished subtrees in.
+                  If set, the source is always partitioned, even with
+                  one worker, and subtrees it reports as reusable are
+                  not transferred again.
+      plan     : sourcePlan shared with pools backing up the same
+                  source to other destinations. If set, the source is
+                  always partitioned, using the plan, and subtrees are
+                  started in step with the other pools.
+      transfers : transferLog to add itemized output of all workers
+                  to; replaces logging each file
+      governor : resourceGovernor that lowers the priority of the rsync
+                  processes, sets --bwlimit, and pauses them while the
+                  system is busy
+      log      : Logger to use
+    '''
+    super().__init__();
+    self.log      = log or logging.getLogger(__name__);
+    self.cmd      = cmd;
+    self.src_dir  = src_dir;
+    self.prog_dir = prog_dir;
+    self.workers  = max( int(workers or 1), 1 );
+    self.history  = history or {};
+    self.catalog  = catalog;
+    self.files_from = files_from;
+    self.checkpoint = checkpoint;
+    self.transfers  = transfers;
+    self.governor   = governor;
+    self.plan     = plan or sourcePlan( src_dir, history = history, window = 0, log = self.log );
+    self.shared   = plan is not None;
+    self.jobs     = [];
+    self.stats    = {};
+    self.eta      = None;
+    self.nospace  = False;                                                      # Set if rsync ran out of space on the backup disk
+    self.__lock   = Lock();
+    self.__cancel = False;
+    self.__t0     = None;
+
+  ##############################################################################
+  @property
+  def progress(self):
+    '''Overall progress; progress of each job weighted by its size'''
+    total = sum( job.weight for job in self.jobs )
+    if total == 0: return 0.0
+    return sum( job.weight * job.progress for job in self.jobs ) / total
+
+  ##############################################################################
+  @property
+  def bytes(self):
+    '''Bytes transferred so far by all jobs'''
+    return sum( job.bytes for job in self.jobs )
+  @property
+  def files(self):
+    '''Files itemized so far by all jobs; zero unless output is itemized'''
+    return sum( job.files for job in self.jobs )
+
+  ##############################################################################
+  @property
+  def subtreeStats(self):
+    '''Dictionary of stats for each subtree; saved for balancing the next run'''
+    return {job.name : {key : job.stats.get(key, 0) for key in ['number_of_files', 'total_file_size']}
+              for job in self.jobs if job.name and job.returncode == 0}
+
+  ##############################################################################
+  def cancel(self, *args):
+    self.__cancel = True;
+    if self.governor: self.governor.stop();                                     # Stopped processes do not act on SIGTERM
+    with self.__lock:
+      for job in self.jobs:
+        if job.proc and job.proc.poll() is None:
+          job.proc.terminate();
+
+  ##############################################################################
+  def run(self):
+    '''
+    Purpose:
+      Method to run the transfer
+    Inputs:
+      None.
+    Outputs:
+      Returns the worst return code of all the rsync processes
+    '''
+    self.__t0    = time.monotonic()
+    self.nospace = False
+    if self.files_from:                                                         # Only transfer what changed
+      root      = os.path.dirname( self.src_dir.rstrip(os.sep) ) or os.sep
+      self.jobs = []
+      for path, recursive in self.files_from:
+        opts = ['--files-from={}'.format(path), '--from0', '--delete']
+        opts.append( '--recursive' if recursive else '--dirs' )
+        self.jobs.append( rsyncJob( None, [root], weight = 1 ) )
+        self.__runJob( self.jobs[-1], opts )
+        if self.__cancel or self.jobs[-1].returncode in rsync_errors: break
+    elif self.workers == 1 and self.checkpoint is None and not self.shared:     # If only one worker
+      self.jobs = [ rsyncJob( None, [self.__root()] ) ];                        # Transfer whole tree with one process
+      self.__runJob( self.jobs[0], ['--relative'] )
+    else:
+      root         = self.__root()
+      skeleton     = rsyncJob( None, [root], weight = 0 );                      # Job to create top-level directories and files
+      self.jobs    = [ skeleton ] + self.__partition( root )
+      self.__runJob( skeleton, ['--relative', '--no-recursive', '--dirs'] )
+      self.plan.join( self )
+      try:
+        if skeleton.returncode not in rsync_errors:
+          queue = Queue()
+          for job in self.jobs[1:]:
+            stats = self.checkpoint.reusable( job.name ) if self.checkpoint else None
+            if stats is None:
+              queue.put( job )
+            else:                                                               # Finished by an earlier, interrupted run
+              self.log.info( 'Skipping finished subtree: {}'.format(job.name) )
+              job.stats, job.returncode, job.progress = stats, 0, 100.0
+              self.plan.skip( self, job.index )
+          threads = [ Thread( target = self.__worker, args = (queue,) )
+                        for i in range( min(self.workers, queue.qsize()) ) ]
+          for thread in threads: thread.start()
+          for thread in threads: thread.join()
+      finally:
+        self.plan.leave( self )
+
+    self.__combineStats()
+    self.eta = 0
+    return self.__returnCode()
+
+  ##############################################################################
+  def __root(self):
+    '''
+    Private method to return the source path with a relative path
+    marker, for --relative; the backup holds the source directory by
+    name (or everything, for '/'), with or without a trailing slash
+    '''
+    parent, base = os.path.split( self.src_dir.rstrip(os.sep) or os.sep )
+    return os.path.join( parent, '.', base, '' )
+
+  ##############################################################################
+  def __partition(self, root):
+    '''
+    Purpose:
+      Private method to create one job per top-level subdirectory of
+      the source, largest first, from the partition of the plan
+    Inputs:
+      root : Source path with relative marker
+    Outputs:
+      Returns list of rsyncJob instances
+    '''
+    return [ rsyncJob( name, [ os.path.join(root, name) ], weight, index = i )
+               for i, (name, weight) in enumerate( self.plan.partition() ) ]
+
+  ##############################################################################
+  def __worker(self, queue):
+    '''Run jobs from the queue until it is empty or the transfer is canceled'''
+    while not self.__cancel:
+      try:
+        job = queue.get_nowait()
+      except Empty:
+        break
+      self.plan.start( self, job.index, lambda: self.__cancel )
+      info = self.checkpoint.start( job.name ) if self.checkpoint else None
+      self.__runJob( job, ['--relative'] )
+      if info and job.returncode not in rsync_errors and not self.__cancel:
+        self.checkpoint.done( job.name, info, job.stats )
+
+  ##############################################################################
+  def __runJob(self, job, opts = []):
+    '''
+    Purpose:
+      Private method to run one rsync process, streaming its overall
+      progress and parsing the --stats summary
+    Inputs:
+      job  : rsyncJob instance to run
+      opts : Extra options for this process
+    Outputs:
+      None; the job attributes are updated
+    '''
+    cmd = self.cmd + opts + ['--info=progress2']
+    if self.catalog:                                                            # Itemize all files, including unchanged ones
+      cmd += ['--out-format={}'.format(OUT_FORMAT), '--info=name2']
+    elif self.transfers:                                                        # Itemize changed files only
+      cmd += ['--out-format={}'.format(OUT_FORMAT)]
+    bwlimit = self.governor.bwlimit() if self.governor else 0
+    if bwlimit: cmd.append( '--bwlimit={}'.format(bwlimit) )
+    cmd += job.srcs + [self.prog_dir]
+    self.log.info( 'Full rsync cmd : {}'.format(cmd) )
+    with self.__lock:
+      if self.__cancel: return
+      job.proc = Popen( cmd, stdout=PIPE, stderr=STDOUT, bufsize=0,
+        preexec_fn = self.governor.preexec if self.governor else None )         # Run rsync command; unbuffered pipe for the parser
+      if self.governor: self.governor.watch( job.proc )
+    parser = rsyncParser( job.proc.stdout, paths = False,
+      items = self.catalog is not None or self.transfers is not None );          # Files are listed in the transfer log, not the human-facing log
+    linked = 0;                                                                 # Files linked to a previous backup; known from itemized output
+    for event in parser:
+      if self.__cancel: break
+      if isinstance(event, Progress):
+        self.__updateProgress( job, event )
+      elif isinstance(event, (Item, Deleted)):
+        if self.catalog:   self.catalog.add( event )
+        if self.transfers: self.transfers.add( event )
+        if isinstance(event, Item) and event.flags[1:2] == b'f':
+          job.files += 1
+          if event.flags[0:1] in b'.h': linked += 1
+      elif isinstance(event, Stats):
+        job.stats[ event.key ] = event.value
+      elif isinstance(event, Error) and event.errno == errno.ENOSPC and not self.nospace:
+        self.log.error( 'Backup disk full: {}'.format(event.message) )
+        self.nospace = True
+    if linked: job.stats['number_of_linked_files'] = linked
+    if self.__cancel:
+      job.proc.terminate();
+    job.proc.communicate();                                                     # Close the PIPEs and everything
+    if self.governor: self.governor.unwatch( job.proc )
+    job.returncode = job.proc.returncode
+    job.progress   = 100.0
+    if job.returncode != 0:
+      self.log.error( 'rsync of {} returned : {}'.format(job.srcs, job.returncode) )
+
+  ##############################################################################
+  def __updateProgress(self, job, event):
+    '''
+    Purpose:
+      Private method to update progress and ETA from a progress event
+      of rsync --info=progress2 output. The overall percentage reported
+      by rsync is used for progress; the ETA is extrapolated from the
+      elapsed time and overall progress of all jobs.
+    Inputs:
+      job   : rsyncJob instance the event belongs to
+      event : Progress event
+    Outputs:
+      None.
+    '''
+    job.progress = float( event.percent )
+    job.bytes    = event.bytes
+    progress     = self.progress
+    if progress > 0:
+      elapsed  = time.monotonic() - self.__t0
+      self.eta = elapsed * (100.0 - progress) / progress
+
+  ##############################################################################
+  def __combineStats(self):
+    '''Sum the stats of all jobs'''
+    self.stats = {}
+    for job in self.jobs:
+      for key, val in job.stats.items():
+        self.stats[key] = self.stats.get(key, 0) + val
+    self.stats['elapsed'] = time.monotonic() - self.__t0
+
+  ##############################################################################
+  def __returnCode(self):
+    '''Return first fatal return code, else largest non-fatal code'''
+    codes = [job.returncode for job in self.jobs if job.returncode is not None]
+    if len(codes) != len(self.jobs):                                            # Some jobs never ran; i.e., canceled
+      return 20
+    for code in codes:
+      if code in rsync_errors: return code
+    return max( codes )
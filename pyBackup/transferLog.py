@@ -0,0 +1,175 @@
+import logging;
+
+import os, gzip, json;
+from queue import Queue;
+from threading import Thread;
+
+from .rsyncParser import Item, Deleted
+
+TRANSFERS = '.transfers';                                                       # Directory of transfer logs in the backup directory; hidden, so not a backup
+SUFFIX    = '.ndjson.gz'
+BATCH     = 1024;                                                               # Lines compressed at once
+QUEUED    = 64 * BATCH;                                                         # Events queued at most; the thread reading rsync waits beyond that
+
+def action( flags ):
+  '''
+  Purpose:
+    Function to name what rsync did to a file from its itemized flags
+  Inputs:
+    flags : The %i field of itemized output, as bytes
+  Outputs:
+    Returns one of 'new', 'updated', 'created', 'linked', 'attrs', or
+    'unchanged'
+  '''
+  first = flags[0:1]
+  if first in (b'>', b'<'):
+    return 'new' if flags[2:].strip(b'+') == b'' else 'updated'
+  if first == b'c': return 'created'
+  if first == b'h': return 'linked'
+  return 'unchanged' if flags[2:].strip() == b'' else 'attrs'
+
+def logPath( backup_dir, name ):
+  '''Return path of the transfer log of a backup'''
+  return os.path.join( backup_dir, TRANSFERS, name + SUFFIX )
+
+def readLog( path ):
+  '''Yield the records of a transfer log as dictionaries'''
+  with gzip.open( path, 'rt', encoding = 'utf8' ) as fid:
+    for line in fid:
+      try:
+        yield json.loads( line )
+      except ValueError:                                                        # Torn line from a crash
+        return
+
+def prune( backup_dir ):
+  '''Remove transfer logs of backups that no longer exist; returns number removed'''
+  removed = 0
+  try:
+    names = os.listdir( os.path.join( backup_dir, TRANSFERS ) )
+  except OSError:
+    return 0
+  for name in names:
+    if not name.endswith( SUFFIX ): continue
+    if os.path.isdir( os.path.join( backup_dir, name[:-len(SUFFIX)] ) ): continue
+    try:
+      os.remove( os.path.join( backup_dir, TRANSFERS, name ) )
+      removed += 1
+    except OSError:
+      pass
+  return removed
+
+class transferLog( object ):
+  def __init__(self, backup_dir, name, log = None):
+    '''
+    Purpose:
+      Class to write the per-file output of a backup to a compact log
+      kept next to the backup: one JSON line per file, with its path,
+      size, and what was done to it (see action()), gzip compressed.
+      Unlike the rotating human-facing log, it holds the complete list
+      for every backup. Events are only put on a queue by the thread
+      reading rsync; a writer thread encodes and compresses them. The
+      queue is bounded, so a slow disk holds up rsync instead of
+      filling memory.
+    Inputs:
+      backup_dir : Backup directory
+      name       : Name of the backup
+    Keywords:
+      log        : Logger to use
+    '''
+    super().__init__();
+    self.log     = log or logging.getLogger(__name__);
+    self.path    = logPath( backup_dir, name );
+    self.tmp     = self.path + '.inprogress';
+    self.counts  = {};                                                          # Dictionary of action: number of files
+    self.bytes   = 0;                                                           # Bytes of new and updated files
+    self.error   = None;
+    self.__queue = Queue( maxsize = QUEUED );
+    os.makedirs( os.path.dirname( self.path ), exist_ok = True )
+    self.__fid   = gzip.open( self.tmp, 'wb', compresslevel = 3 )
+    self.__thread = Thread( target = self.__run, daemon = True )
+    self.__thread.start()
+
+  ##############################################################################
+  def add(self, event):
+    '''
+    Purpose:
+      Method to log a file; cheap enough to call for every file
+    Inputs:
+      event : Item or Deleted event of rsyncParser, or tuple of (path,
+               size, action) with path as bytes
+    Outputs:
+      None.
+    '''
+    self.__queue.put( event )
+
+  ##############################################################################
+  def close(self):
+    '''Write everything queued and move the log in place; returns its path'''
+    if not self.__stop(): return None
+    os.replace( self.tmp, self.path )
+    return self.path
+
+  ##############################################################################
+  def discard(self):
+    '''Stop writing and delete the log; e.g., the backup was dropped'''
+    self.__stop()
+    try:
+      os.remove( self.tmp )
+    except OSError:
+      pass
+
+  ##############################################################################
+  def summary(self):
+    '''Return one line summary of the counts of each action'''
+    return ', '.join( '{} {}'.format(n, key) for key, n in sorted( self.counts.items() ) ) or 'no files'
+
+  ##############################################################################
+  def __stop(self):
+    '''Private method to stop the writer thread; returns False if writing failed'''
+    if self.__thread is None: return self.error is None
+    self.__queue.put( None )
+    self.__thread.join()
+    self.__thread = None
+    if self.error is not None:
+      self.log.warning( 'Failed to write transfer log {}: {}'.format(self.path, self.error) )
+    return self.error is None
+
+  ##############################################################################
+  def __run(self):
+    '''Private method of the writer thread'''
+    lines  = []
+    counts = self.counts
+    while True:
+      event = self.__queue.get()
+      if event is None: break
+      try:
+        if isinstance(event, Item):
+          kind = action( event.flags )
+          path, size = event.path, event.size
+        elif isinstance(event, Deleted):
+          path, size, kind = event.path, None, 'deleted'
+        else:
+          path, size, kind = event
+        counts[kind] = counts.get(kind, 0) + 1
+        if kind in ('new', 'updated'): self.bytes += size or 0
+        lines.append( json.dumps( {'path' : os.fsdecode( path ), 'size' : size, 'action' : kind} ) )
+      except Exception as err:                                                  # Keep taking events; the queue is bounded
+        self.error = self.error or err
+        continue
+      if len(lines) >= BATCH:
+        self.__write( lines )
+        lines = []
+    self.__write( lines )
+    try:
+      self.__fid.close()
+    except OSError as err:
+      self.error = self.error or err
+
+  ##############################################################################
+  def __write(self, lines):
+    '''Private method to compress lines; errors stop writing but not the backup'''
+    if not lines or self.error is not None: return
+    try:
+      self.__fid.write( ('\n'.join( lines ) + '\n').encode( 'utf8' ) );         # Paths are ASCII escaped by json
+    except OSError as err:
+      self.error = err
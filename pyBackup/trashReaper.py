@@ -0,0 +1,151 @@
+import logging;
+
+import os, time;
+from threading import Thread, Condition, get_native_id;
+
+from .treePruner import treePruner
+
+TRASH    = '.trash'                                                             # Name of trash directory in the backup directory
+LOW_NICE = 19                                                                   # Niceness of the reaper thread while in the background
+
+class trashReaper( object ):
+  def __init__(self, backup_dir, workers = 1, callback = None, governor = None, log = None):
+    '''
+    Purpose:
+      Class to defer deletion of expired and partial backups. Backups
+      are renamed into a trash directory in the backup directory,
+      which is instant, and then deleted by a low priority background
+      thread. Anything left in the trash directory, e.g., after a
+      crash, is picked up again the next time the reaper starts.
+    Inputs:
+      backup_dir : Top-level backup directory
+    Keywords:
+      workers    : Number of threads used by the treePruner
+      callback   : Progress callback passed to the treePruner
+      governor   : resourceGovernor that lowers the I/O priority of the
+                    thread and slows it down while the system is busy
+      log        : Logger to use
+    '''
+    super().__init__();
+    self.log       = log or logging.getLogger(__name__);
+    self.trash_dir = os.path.join( backup_dir, TRASH );
+    self.workers   = workers;
+    self.callback  = callback;
+    self.governor  = governor;
+    self.reaped    = 0;                                                         # Number of trash entries deleted
+    self.__freed   = 0;                                                         # Bytes freed and not yet collected with takeFreed()
+    self.__cond    = Condition();
+    self.__thread  = None;
+    self.__tid     = None;
+    self.__pruner  = None;
+    self.__cancel  = False;
+    os.makedirs( self.trash_dir, exist_ok = True );
+
+  ##############################################################################
+  def pending(self):
+    '''Return sorted list of paths in the trash directory'''
+    return sorted( os.path.join(self.trash_dir, name) for name in os.listdir( self.trash_dir ) )
+
+  ##############################################################################
+  def trash(self, path):
+    '''
+    Purpose:
+      Method to move a backup into the trash directory and start
+      deleting it in the background
+    Inputs:
+      path : Path to backup to delete
+    Outputs:
+      Returns new path of the backup
+    '''
+    name = '{}.{}'.format( os.path.basename( path.rstrip(os.sep) ), time.time_ns() ); # Unique name; same backup may be trashed more than once
+    dst  = os.path.join( self.trash_dir, name )
+    os.rename( path, dst )
+    self.log.debug( 'Trashed: {} ---> {}'.format(path, dst) )
+    self.start()
+    return dst
+
+  ##############################################################################
+  def start(self):
+    '''Start the background thread if there is anything to delete'''
+    with self.__cond:
+      if self.__thread and self.__thread.is_alive(): return
+      if not self.pending(): return
+      self.__cancel = False
+      self.__thread = Thread( target = self.__run, daemon = True )
+      self.__thread.start()
+
+  ##############################################################################
+  def running(self):
+    return self.__thread is not None and self.__thread.is_alive()
+
+  ##############################################################################
+  def waitOne(self):
+    '''
+    Purpose:
+      Method to block until the background thread has finished
+      deleting the current trash entry.
+    Inputs:
+      None.
+    Outputs:
+      Returns True if an entry was deleted, False if nothing was
+      left to delete
+    '''
+    self.start()
+    with self.__cond:
+      reaped = self.reaped
+      while self.reaped == reaped and self.running():
+        self.__cond.wait( 1.0 )
+      return self.reaped != reaped
+
+  ##############################################################################
+  def takeFreed(self):
+    '''Return bytes freed since the last call'''
+    with self.__cond:
+      freed, self.__freed = self.__freed, 0
+    return freed
+
+  ##############################################################################
+  def join(self):
+    '''Wait for the trash to be emptied'''
+    if self.__thread: self.__thread.join()
+
+  ##############################################################################
+  def cancel(self, *args):
+    self.__cancel = True
+    if self.__pruner: self.__pruner.cancel()
+
+  ##############################################################################
+  def __run(self):
+    '''Delete all entries in the trash, oldest first'''
+    self.__tid = get_native_id()
+    self.__setNice( LOW_NICE )
+    if self.governor: self.governor.lowerThread( self.__tid )
+    while not self.__cancel:
+      paths = self.pending()
+      if not paths: break
+      self.__pruner = treePruner( workers  = self.workers,
+                                    callback = self.callback,
+                                    throttle = self.governor.wait if self.governor else None,
+                                    log      = self.log )
+      removed       = self.__pruner.remove( paths[0] )
+      with self.__cond:
+        self.__freed += self.__pruner.freed;                                   # Count partial deletes too
+        if removed: self.reaped += 1
+        self.__cond.notify_all()
+      if removed:
+        self.log.debug( 'Reaped: {}'.format(paths[0]) )
+      else:
+        if not self.__cancel: self.log.error( 'Failed to reap: {}'.format(paths[0]) )
+        break
+    self.__pruner = None
+    with self.__cond:
+      self.__cond.notify_all()
+
+  ##############################################################################
+  def __setNice(self, value):
+    '''Set niceness of the background thread; Linux only, ignored if not permitted'''
+    if self.__tid is None or not hasattr(os, 'setpriority'): return
+    try:
+      os.setpriority( os.PRIO_PROCESS, self.__tid, value )
+    except OSError:
+      pass
@@ -0,0 +1,188 @@
+import logging;
+
+import os, stat;
+from threading import Thread, Lock, Condition;
+
+OPEN_FLAGS = os.O_RDONLY | os.O_DIRECTORY | getattr(os, 'O_NOFOLLOW', 0)
+BATCH      = 1000                                                               # Number of entries between progress updates
+
+class dirNode( object ):
+  '''Class to hold state of one directory while its contents are removed'''
+  def __init__(self, name, parent):
+    self.name    = name;                                                        # Name relative to parent; path for the top directory
+    self.parent  = parent;                                                      # Parent dirNode; None for the top directory
+    self.fd      = None;                                                        # File descriptor of the open directory
+    self.pending = 1;                                                           # Number of unfinished tasks; own contents plus subdirectories
+
+class treePruner( object ):
+  def __init__(self, workers = 4, callback = None, throttle = None, log = None):
+    '''
+    Purpose:
+      Class to delete large directory trees, such as expired backups.
+      Directories are read with os.scandir() on open file descriptors,
+      and entries are removed relative to those descriptors, so paths
+      never need to be resolved again. Several directories are
+      worked on at once by a bounded set of threads, deepest first,
+      which keeps the number of open descriptors low.
+      Bytes freed are counted only for inodes whose last link was
+      removed; files still hard linked into other backups do not free
+      any space.
+    Inputs:
+      None.
+    Keywords:
+      workers  : Number of threads to use
+      callback : Function called with (files, freed) every BATCH entries
+      throttle : Function called before each directory; may block to
+                  slow deletion down (see resourceGovernor.wait)
+      log      : Logger to use
+    '''
+    super().__init__();
+    self.log      = log or logging.getLogger(__name__);
+    self.workers  = max( int(workers or 1), 1 );
+    self.callback = callback;
+    self.throttle = throttle;
+    self.files    = 0;                                                          # Number of entries removed
+    self.freed    = 0;                                                          # Number of bytes freed
+    self.__linkLock = Lock();                                                   # Serializes removal of multiply linked files
+    self.__cond     = Condition();
+    self.__stack    = [];
+    self.__open     = set();                                                    # Nodes with open file descriptors
+    self.__active   = 0;
+    self.__cancel   = False;
+    self.__errors   = [];
+
+  ##############################################################################
+  def cancel(self, *args):
+    with self.__cond:
+      self.__cancel = True;
+      self.__cond.notify_all();
+
+  ##############################################################################
+  def remove(self, path):
+    '''
+    Purpose:
+      Method to remove a directory tree
+    Inputs:
+      path : Path to directory to remove
+    Outputs:
+      Returns True if the tree was removed, False if canceled or
+      an error occured. The files and freed attributes are updated
+      either way.
+    '''
+    top    = dirNode( path, None )
+    self.__errors = []
+    self.__stack  = [ top ]
+    threads = [ Thread( target = self.__worker ) for i in range(self.workers) ]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    for node in list( self.__open ):                                            # Close anything left over after a cancel or error
+      self.__close( node )
+    self.__stack = []
+    self.__report()
+    if self.__errors:
+      self.log.error( 'Failed to remove {}: {}'.format(path, self.__errors[0]) )
+      return False
+    return (not self.__cancel) and (not os.path.lexists( path ))
+
+  ##############################################################################
+  def __worker(self):
+    '''Take directories off the stack until the whole tree is removed'''
+    while True:
+      with self.__cond:
+        while not self.__stack and self.__active > 0 and not self.__cancel:
+          self.__cond.wait()
+        if self.__cancel or self.__errors or not self.__stack:                  # Canceled, failed, or nothing left to do
+          self.__cond.notify_all()
+          return
+        node = self.__stack.pop()
+        self.__active += 1
+      if self.throttle: self.throttle()
+      try:
+        self.__process( node )
+      except OSError as err:
+        self.__errors.append( err )
+        self.__close( node )
+      with self.__cond:
+        self.__active -= 1
+        self.__cond.notify_all()
+
+  ##############################################################################
+  def __process(self, node):
+    '''
+    Purpose:
+      Private method to remove all non-directory entries of a directory
+      and queue its subdirectories
+    Inputs:
+      node : dirNode to process
+    Outputs:
+      None.
+    '''
+    parent_fd = node.parent.fd if node.parent else None
+    node.fd   = os.open( node.name, OPEN_FLAGS, dir_fd = parent_fd )
+    with self.__cond:
+      self.__open.add( node )
+    subdirs   = []
+    files     = freed = 0
+    with os.scandir( node.fd ) as it:
+      for entry in it:
+        if self.__cancel: break
+        if entry.is_dir( follow_symlinks = False ):
+          subdirs.append( dirNode( entry.name, node ) )
+          continue
+        info = entry.stat( follow_symlinks = False )
+        try:
+          if info.st_nlink > 1 and not stat.S_ISLNK( info.st_mode ):            # Other links may be removed by other threads at the same time
+            with self.__linkLock:
+              info = os.stat( entry.name, dir_fd = node.fd, follow_symlinks = False )
+              os.unlink( entry.name, dir_fd = node.fd )
+          else:
+            os.unlink( entry.name, dir_fd = node.fd )
+        except FileNotFoundError:                                               # Removed by someone else; nothing freed here
+          continue
+        if info.st_nlink == 1: freed += info.st_size;                          # Only the last link frees space
+        files += 1
+        if files == BATCH:
+          self.__count( files, freed )
+          files = freed = 0
+    self.__count( files, freed )
+    if self.__cancel: return
+    with self.__cond:
+      node.pending += len(subdirs)
+      self.__stack.extend( subdirs )
+      self.__cond.notify_all()
+    self.__finish( node )
+
+  ##############################################################################
+  def __finish(self, node):
+    '''Mark one task of node done; remove directories that are empty'''
+    while node:
+      with self.__cond:
+        node.pending -= 1
+        if node.pending > 0: return
+      self.__close( node )
+      parent = node.parent
+      os.rmdir( node.name, dir_fd = parent.fd if parent else None )
+      self.__count( 1, 0 )
+      node = parent
+
+  ##############################################################################
+  def __close(self, node):
+    with self.__cond:
+      if node.fd is None: return
+      os.close( node.fd )
+      node.fd = None
+      self.__open.discard( node )
+
+  ##############################################################################
+  def __count(self, files, freed):
+    '''Add to counters and report progress'''
+    if files == 0: return
+    with self.__cond:
+      self.files += files
+      self.freed += freed
+    self.__report()
+
+  ##############################################################################
+  def __report(self):
+    if self.callback:
+      self.callback( self.files, self.freed )
@@ -0,0 +1,206 @@
+import logging;
+
+import os;
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS inodes (
+  inode    INTEGER PRIMARY KEY,
+  size     INTEGER NOT NULL,
+  refs     INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS accounted (
+  snapshot INTEGER PRIMARY KEY
+);
+'''
+
+class diskUsage( object ):
+  def __init__(self, catalog, log = None):
+    '''
+    Purpose:
+      Class for exact, incremental accounting of the disk space used
+      by backups. Every regular file inode in the catalog is tracked
+      with the number of backup entries linking to it, so the bytes a
+      backup uniquely holds (and would free when deleted) are known
+      without walking any directories. Counts are updated when a
+      backup is added to or removed from the catalog and are stored
+      in the catalog file, so they survive between runs.
+    Inputs:
+      catalog : snapshotCatalog instance
+    Keywords:
+      log     : Logger to use
+    '''
+    super().__init__();
+    self.log     = log or logging.getLogger(__name__);
+    self.catalog = catalog;
+    self.db      = catalog.db;
+    self.db.executescript( SCHEMA )
+
+  ##############################################################################
+  def accounted(self, name):
+    '''Return True if the named backup is included in the accounting'''
+    snap = self.catalog.snapshotId( name )
+    if snap is None: return False
+    row  = self.db.execute( 'SELECT 1 FROM accounted WHERE snapshot = ?', (snap,) ).fetchone()
+    return row is not None
+
+  ##############################################################################
+  def add(self, name):
+    '''
+    Purpose:
+      Method to add a completed backup to the accounting
+    Inputs:
+      name : Name of the backup
+    Outputs:
+      Returns number of bytes newly used by the backup
+    '''
+    snap = self.catalog.snapshotId( name )
+    if snap is None or self.accounted( name ): return 0
+    with self.db:
+      before = self.total()
+      self.db.execute(
+        'INSERT INTO inodes (inode, size, refs) '
+        'SELECT inode, MAX(size), COUNT(*) FROM entries '
+        "WHERE snapshot = ? AND kind = 'f' AND inode IS NOT NULL GROUP BY inode "
+        'ON CONFLICT (inode) DO UPDATE SET refs = refs + excluded.refs', (snap,) )
+      self.db.execute( 'INSERT INTO accounted (snapshot) VALUES (?)', (snap,) )
+      added = self.total() - before
+    self.log.debug( 'Backup {} uses {} new bytes'.format(name, added) )
+    return added
+
+  ##############################################################################
+  def remove(self, name):
+    '''
+    Purpose:
+      Method to remove a backup from the accounting; must be called
+      before the backup is dropped from the catalog
+    Inputs:
+      name : Name of the backup
+    Outputs:
+      Returns number of bytes freed by deleting the backup, or None
+      if the backup was not accounted for
+    '''
+    if not self.accounted( name ): return None
+    snap = self.catalog.snapshotId( name )
+    with self.db:
+      self.db.execute(
+        'UPDATE inodes SET refs = refs - (SELECT COUNT(*) FROM entries AS e '
+        "WHERE e.snapshot = ? AND e.kind = 'f' AND e.inode = inodes.inode) "
+        "WHERE inode IN (SELECT inode FROM entries WHERE snapshot = ? AND kind = 'f')", (snap, snap) )
+      freed = self.db.execute( 'SELECT COALESCE(SUM(size), 0) FROM inodes WHERE refs <= 0' ).fetchone()[0]
+      self.db.execute( 'DELETE FROM inodes WHERE refs <= 0' )
+      self.db.execute( 'DELETE FROM accounted WHERE snapshot = ?', (snap,) )
+    self.log.debug( 'Removing backup {} frees {} bytes'.format(name, freed) )
+    return freed
+
+  ##############################################################################
+  def update(self):
+    '''
+    Purpose:
+      Method to add complete backups in the catalog that are not yet
+      accounted for; e.g., backups cataloged before accounting existed
+    Inputs:
+      None.
+    Outputs:
+      Returns list of names of backups added
+    '''
+    added = [name for name in self.catalog.snapshots() if not self.accounted( name )]
+    for name in added:
+      self.add( name )
+    return added
+
+  ##############################################################################
+  def reclaimable(self, names):
+    '''
+    Purpose:
+      Method to compute the bytes that deleting a set of backups
+      together would free; i.e., the size of inodes that are only
+      linked from within the set
+    Inputs:
+      names : List of backup names
+    Outputs:
+      Returns number of bytes, or None if any backup is not
+      accounted for
+    '''
+    snaps = []
+    for name in names:
+      if not self.accounted( name ): return None
+      snaps.append( self.catalog.snapshotId( name ) )
+    if not snaps: return 0
+    return self.db.execute(
+      'SELECT COALESCE(SUM(i.size), 0) FROM (SELECT inode, COUNT(*) AS n FROM entries '
+      "WHERE snapshot IN ({}) AND kind = 'f' GROUP BY inode) AS s "
+      'JOIN inodes AS i ON i.inode = s.inode WHERE i.refs = s.n'.format( ','.join('?'*len(snaps)) ),
+      snaps ).fetchone()[0]
+
+  ##############################################################################
+  def shares(self, names):
+    '''
+    Purpose:
+      Method to get, in one pass over the entries of a set of backups,
+      what the retention planner needs to compute the bytes any subset
+      of them frees without querying the catalog again: the inodes
+      that are only linked from within the set, with the number of
+      links each backup holds
+    Inputs:
+      names : List of backup names
+    Outputs:
+      Returns tuple of (links, inodes), or None if any backup is not
+      accounted for; links is a dictionary of name: list of (inode,
+      number of links) and inodes a dictionary of inode: (size, total
+      number of links)
+    '''
+    snaps = {}
+    for name in names:
+      if not self.accounted( name ): return None
+      snaps[ self.catalog.snapshotId( name ) ] = name
+    links  = {name : [] for name in names}
+    inodes = {}
+    if not snaps: return links, inodes
+    rows = self.db.execute(
+      'WITH s AS (SELECT inode, snapshot, COUNT(*) AS n FROM entries '
+      "  WHERE snapshot IN ({}) AND kind = 'f' AND inode IS NOT NULL GROUP BY inode, snapshot), "
+      't AS (SELECT inode, SUM(n) AS n FROM s GROUP BY inode) '
+      'SELECT s.inode, s.snapshot, s.n, i.size, i.refs FROM s '
+      'JOIN t ON t.inode = s.inode JOIN inodes AS i ON i.inode = s.inode '
+      'WHERE i.refs = t.n'.format( ','.join('?'*len(snaps)) ), list(snaps) )
+    for inode, snap, n, size, refs in rows:
+      links[ snaps[snap] ].append( (inode, n) )
+      inodes[inode] = (size, refs)
+    return links, inodes
+
+  ##############################################################################
+  def total(self):
+    '''Return total bytes used by all accounted backups'''
+    return self.db.execute( 'SELECT COALESCE(SUM(size), 0) FROM inodes' ).fetchone()[0]
+
+  ##############################################################################
+  def check(self, backup_dir, snapshots):
+    '''
+    Purpose:
+      Method to cross-check the accounting against the file system.
+      The accounted total can never be larger than the space used on
+      the disk; if it is, or if backups exist that are not accounted
+      for, the accounting is incomplete.
+    Inputs:
+      backup_dir : Top-level backup directory
+      snapshots  : List of names of backups on disk
+    Outputs:
+      Returns dictionary with 'total', 'fs_used', 'unaccounted',
+      'stale', and 'consistent' keys; stale backups are accounted for
+      but no longer on disk
+    '''
+    info    = os.statvfs( backup_dir )
+    fs_used = (info.f_blocks - info.f_bfree) * info.f_frsize
+    total   = self.total()
+    missing = [name for name in snapshots if not self.accounted( name )]
+    stale   = [name for name in self.catalog.snapshots()
+                 if name not in snapshots and self.accounted( name )]
+    result  = {'total' : total, 'fs_used' : fs_used, 'unaccounted' : missing,
+               'stale' : stale, 'consistent' : total <= fs_used and not missing and not stale}
+    if total > fs_used:
+      self.log.warning( 'Accounted backup size ({}) larger than used disk space ({})'.format(total, fs_used) )
+    if missing:
+      self.log.info( '{} backups not in disk usage accounting'.format(len(missing)) )
+    if stale:
+      self.log.warning( '{} accounted backups no longer on disk'.format(len(stale)) )
+    return result
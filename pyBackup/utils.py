@@ -1,52 +1,258 @@
-import os, sys, shutil, json
-from subprocess import check_output
+import os, json, copy, time, fcntl, atexit, socket
+from contextlib import contextmanager
+from threading import Lock, RLock, Timer, local
 
-from . import CONFIGFILE
+from . import CONFIGFILE, setup
+from .devices import DEVICES
 
-DISKUTIL   = ['diskutil', 'info'] 
+SAVE_DELAY   = 5.0                                                              # Seconds a delayed save waits for more changes
+RELOAD_CHECK = 1.0                                                              # Seconds between checks for changes by other processes
 
 class Config( object ):
-  def __init__(self):
-    self.file  = CONFIGFILE 
-    self._data = {}
+  def __init__(self, file = CONFIGFILE):
+    '''
+    Purpose:
+      Class for the config file. Only keys changed in this process are
+      written, merged into the file as it is on disk under an fcntl
+      lock, so the GUI, the daemon, and a backup can all update it at
+      once; the file is replaced atomically, so a crash never leaves
+      it half written. Changes made inside transaction() are written
+      together when it ends, saves can be delayed so bursts of changes
+      are written once, and changes made by other processes are loaded
+      when the modification time of the file changes.
+    Inputs:
+      None.
+    Keywords:
+      file : Path of the config file
+    '''
+    self.file     = file
+    self.lockfile = file + '.lock'
+    self._data    = {}
+    self._dirty   = set()                                                       # Keys changed since the last save
+    self._local   = local()                                                     # Transaction of each thread
+    self._open    = 0                                                           # Threads inside a transaction
+    self._mtime   = None
+    self._checked = 0.0
+    self._timer   = None                                                        # Pending delayed save
+    self._lock    = RLock()
     self.loadConfig()
+    atexit.register( self.flush )
   def __getitem__(self, key):
+    self.reload()
     return self._data.get(key, None)
   def __setitem__(self, key, val):
-    self._data[key] = val
+    with self._lock:
+      cur = self._data.get(key, None)
+      if cur != val or isinstance(val, (dict, list)):                           # Containers may have been changed in place
+        self.__changed( key )
+        self._data[key] = val
+        self._dirty.add( key )
   def keys(self):
     return self._data.keys()
   def get(self, *args, **kwargs):
+    self.reload()
     return self._data.get(*args, **kwargs)
   def pop(self, *args, **kwargs):
-    return self._data.pop(*args, **kwargs)
-  def loadConfig(self):
-    with open(self.file, 'r') as fid:
-      self._data.update( json.load( fid ) )
-    if not self._data['disk_UUID']:                                                   # If the disk UUID is NOT defined
-      host = check_output( 'hostname' ).decode().rstrip()
-      self._data['backup_dir'] = os.path.join( self._data['backup_dir'], host )
-  def saveConfig(self):
-      with open(self.file, 'w') as fid:
-        json.dump( self._data, fid, indent = 4 );
-
-CONFIG = Config()
-
-def diskutil(val):                                                                                                                                                                                       
-  data = {}  
-  if isinstance(val, str) and val != '':
+    with self._lock:
+      self.__changed( args[0] )
+      self._dirty.add( args[0] )
+      return self._data.pop(*args, **kwargs)
+
+  ##############################################################################
+  @contextmanager
+  def transaction(self):
+    '''
+    Purpose:
+      Context manager to batch changes; they are written once, when
+      the outermost transaction ends, and undone if it raises. Each
+      thread has its own transaction, and only undoes the keys it
+      changed. Changes by other processes are not loaded while any
+      transaction is open.
+    '''
+    txn = self._local
+    with self._lock:
+      if not getattr( txn, 'depth', 0 ):
+        txn.depth   = 0
+        txn.before  = copy.deepcopy( self._data );                              # Containers may be changed in place before they are set
+        txn.changed = set()
+        self._open += 1
+      txn.depth += 1
+    ok = False
     try:
-      lines = check_output( DISKUTIL+[val] ).decode().splitlines() 
-    except:
-      return data
-    for line in lines:
+      yield self
+      ok = True
+    finally:
+      with self._lock:
+        txn.depth -= 1
+        if txn.depth == 0:
+          self._open -= 1
+          if not ok:
+            data = dict( self._data )
+            for key in txn.changed:
+              if key in txn.before:
+                data[key] = txn.before[key]
+              else:
+                data.pop( key, None )
+            self._data = data;                                                  # Swapped whole; readers do not take the lock
+            self._dirty.update( txn.changed );                                  # Another thread may have saved them meanwhile
+          txn.before = txn.changed = None
+          if ok: self.saveConfig()
+
+  ##############################################################################
+  def reload(self, force = False):
+    '''
+    Purpose:
+      Method to load changes made by other processes; the file is only
+      read when its modification time changed, and checked at most
+      every RELOAD_CHECK seconds
+    Keywords:
+      force : Check now and reload even if the time did not change
+    Outputs:
+      Returns True if the file was loaded
+    '''
+    if self._open > 0: return False
+    now = time.monotonic()
+    if not force and now - self._checked < RELOAD_CHECK: return False
+    with self._lock:
+      if self._open > 0: return False
+      self._checked = now
       try:
-        key, val = line.split(':')
-      except:
-        pass
+        mtime = os.stat( self.file ).st_mtime_ns
+      except OSError:
+        return False
+      if not force and mtime == self._mtime: return False
+      self.loadConfig()
+    return True
+
+  ##############################################################################
+  def loadConfig(self):
+    with self._lock, self.__fileLock( fcntl.LOCK_SH ):
+      with open(self.file, 'r') as fid:
+        data = json.load( fid )
+        self._mtime = os.fstat( fid.fileno() ).st_mtime_ns
+      self.__merge( data )
+
+  ##############################################################################
+  def saveConfig(self, delay = None):
+    '''
+    Purpose:
+      Method to write changed keys to the config file
+    Keywords:
+      delay : Seconds to wait before writing, so that more changes are
+               written at once; default is to write now
+    Outputs:
+      None.
+    '''
+    with self._lock:
+      if getattr( self._local, 'depth', 0 ): return                             # Written when the transaction ends
+      if delay:
+        if self._timer is None:
+          self._timer = Timer( delay, self.saveConfig )
+          self._timer.daemon = True
+          self._timer.start()
+        return
+      if self._timer is not None:
+        self._timer.cancel()
+        self._timer = None
+      if not self._dirty: return
+      with self.__fileLock( fcntl.LOCK_EX ):
+        try:
+          with open(self.file, 'r') as fid:
+            data = json.load( fid )
+        except (OSError, ValueError):
+          data = {}
+        for key in self._dirty:
+          if key in self._data:
+            data[key] = self._data[key]
+          else:
+            data.pop( key, None )
+        dirname  = os.path.dirname( self.file ) or '.'
+        import tempfile;                                                        # Only needed when writing
+        fd, tmp  = tempfile.mkstemp( dir = dirname, prefix = '.config.' )
+        try:
+          with os.fdopen( fd, 'w' ) as fid:
+            json.dump( data, fid, indent = 4 );
+            fid.flush()
+            os.fsync( fid.fileno() )
+          os.replace( tmp, self.file )
+        except:
+          if os.path.exists( tmp ): os.remove( tmp )
+          raise
+        dfd = os.open( dirname, os.O_RDONLY )
+        try:
+          os.fsync( dfd );                                                      # Make the rename durable
+        finally:
+          os.close( dfd )
+        self._mtime = os.stat( self.file ).st_mtime_ns
+        self._dirty.clear()
+        self.__merge( data )
+
+  ##############################################################################
+  def flush(self):
+    '''Write any changes now; e.g., ones waiting for a delayed save'''
+    if self._timer is not None or self._dirty: self.saveConfig()
+
+  ##############################################################################
+  def __merge(self, data):
+    '''
+    Replace values with those from the file, keeping unsaved changes.
+    The new values are swapped in at once, so threads reading without
+    the lock never see a partly merged dictionary.
+    '''
+    data = dict( data )
+    for key in self._dirty:
+      if key in self._data:
+        data[key] = self._data[key]
       else:
-        data[ key.strip() ] = val.strip()
-  return data
+        data.pop( key, None )
+    if not data.get('disk_UUID', None):                                         # If the disk UUID is NOT defined
+      host = socket.gethostname()
+      if os.path.basename( data['backup_dir'] ) != host:
+        data['backup_dir'] = os.path.join( data['backup_dir'], host )
+        self._dirty.add( 'backup_dir' )
+    self._data = data
+
+  ##############################################################################
+  def __changed(self, key):
+    '''Note a key changed inside the transaction of this thread; the lock must be held'''
+    if getattr( self._local, 'depth', 0 ): self._local.changed.add( key )
+
+  ##############################################################################
+  @contextmanager
+  def __fileLock(self, mode):
+    '''Hold an fcntl lock on the lock file of the config file'''
+    fd = os.open( self.lockfile, os.O_RDWR | os.O_CREAT, 0o644 )
+    try:
+      fcntl.flock( fd, mode )
+      yield
+    finally:
+      os.close( fd )
+
+_CONFIG_LOCK = Lock()
+
+def getConfig():
+  '''
+  Purpose:
+    Function to get the Config of the config file in the application
+    directory. It is created, and the application directory set up,
+    the first time it is used rather than at import, so commands that
+    exit early never read or write it. utils.CONFIG is the same
+    instance.
+  Inputs:
+    None.
+  Outputs:
+    Returns Config instance
+  '''
+  global CONFIG
+  with _CONFIG_LOCK:
+    if 'CONFIG' not in globals():
+      setup()
+      CONFIG = Config()
+  return CONFIG
+
+def __getattr__( name ):
+  if name == 'CONFIG': return getConfig()
+  raise AttributeError( 'module {!r} has no attribute {!r}'.format(__name__, name) )
 
 def get_UUID( mnt_point ):
   '''
@@ -58,43 +264,19 @@ def get_UUID( mnt_point ):
   Outputs:
     Returns UUID
   '''
-  if mnt_point[-1] == os.sep: mnt_point = mnt_point[:-1];                       # If the last character in the mount point is directory separator, remove it
-
-  if 'linux' in sys.platform:
-    data = json.loads( check_output( ['lsblk', '--fs', '--json'] ) );             # Run lsblk command to get information about block devices
-    for device in data['blockdevices']:                                           # Iterate over all the devicies
-      if ('children' in device) and device['children']:                           # If the device has children
-        for child in device['children']:                                          # Iterate over all the children
-          if ('mountpoint' in child) and child['mountpoint']:                     # If the child has a mount point
-            if mnt_point in child['mountpoint']:                                  # If the child's mount point matches the user input mount point
-              return child['uuid'];                                               # Return the UUID
-  elif 'darwin' in sys.platform:
-    data = diskutil( mnt_point )
-    return data.get('Disk / Partition UUID', None)
-
-  return None;                                                                  # Not found, so return None
+  return DEVICES.uuid( mnt_point )
 
 def get_MountPoint( UUID ):
   '''
   Purpose:
-    A function to determine the UUID of a hard drive
-    given its mount point
+    A function to determine the mount point of a hard drive
+    given its UUID
   Inputs:
-    mnt_point : Path to mount point
+    UUID : UUID of the drive
   Outputs:
-    Returns UUID
+    Returns mount point, or None if not mounted
   '''
-  if 'linux' in sys.platform:
-    data = json.loads( check_output( ['lsblk', '--fs', '--json'] ) );             # Run lsblk command to get information about block devices
-    for device in data['blockdevices']:                                           # Iterate over all the devicies
-      if ('children' in device) and device['children']:                           # If the device has children
-        for child in device['children']:                                          # Iterate over all the children
-          if ('uuid' in child) and (child['uuid'] == UUID):                       # If the child has a UUID
-            return child['mountpoint'];                                           # If the child's mount point matches the user input mount point
-  elif 'darwin' in sys.platform:
-    data = diskutil( UUID )
-    return data.get('Mount Point', None)
-  return None                                                                   # Not found, so return None
+  return DEVICES.mountPoint( UUID )
 
 def setBackupDir( path ):
   '''
@@ -108,9 +290,8 @@ def setBackupDir( path ):
   '''
   UUID = get_UUID( path )
   if UUID and os.path.isdir( path ):
-    total, used, free = shutil.disk_usage( path )
-    CONFIG['disk_size'] = int(free * 0.9)
-    CONFIG['disk_UUID'] = UUID
-    CONFIG.saveConfig()
+    config = getConfig()
+    config['disk_UUID'] = UUID
+    config.saveConfig()
     return True
   return False
@@ -0,0 +1,225 @@
+import logging;
+
+import os, errno, time, hashlib, multiprocessing;
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED;
+
+from . import utils
+from .governor import settings as governorSettings, lowerPriority
+
+BLOCK       = 8 * 1024**2;                                                      # Bytes per read; large reads keep the disk streaming
+DIGEST      = 32;                                                               # Bytes of the blake2b digest
+BATCH_FILES = 64;                                                               # Small files are handed to the worker processes in batches
+BATCH_BYTES = 64 * 1024**2
+
+def hashFile( path, throttle = None, drop = False ):
+  '''
+  Purpose:
+    Function to checksum a file with large sequential reads
+  Inputs:
+    path     : Path of the file
+  Keywords:
+    throttle : Function called with the number of bytes after each
+                read; may sleep to bound the read rate
+    drop     : If True, cached pages of the file are dropped before
+                and after reading, so the disk itself is read and the
+                page cache is left to other programs
+  Outputs:
+    Returns tuple of (digest, size, mtime in nanoseconds, inode)
+  '''
+  fd = os.open( path, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0) )
+  try:
+    info   = os.fstat( fd )
+    advise = getattr( os, 'posix_fadvise', None )
+    if advise:
+      if drop: advise( fd, 0, 0, os.POSIX_FADV_DONTNEED )
+      advise( fd, 0, 0, os.POSIX_FADV_SEQUENTIAL )
+    hasher = hashlib.blake2b( digest_size = DIGEST )
+    buf    = bytearray( BLOCK )
+    view   = memoryview( buf )
+    size   = 0
+    with open( fd, 'rb', buffering = 0, closefd = False ) as fid:
+      while True:
+        n = fid.readinto( buf )
+        if not n: break
+        hasher.update( view[:n] )
+        size += n
+        if throttle: throttle( n )
+    if advise and drop: advise( fd, 0, 0, os.POSIX_FADV_DONTNEED )
+    return hasher.digest(), size, info.st_mtime_ns, info.st_ino
+  finally:
+    os.close( fd )
+
+def hashFiles( paths, rate = 0, drop = False ):
+  '''
+  Purpose:
+    Function run in the worker processes to checksum a batch of files
+  Inputs:
+    paths : List of paths
+  Keywords:
+    rate  : Bytes per second this process reads at most; zero for no
+             limit
+    drop  : See hashFile()
+  Outputs:
+    Returns list of (digest, size, mtime, inode, error) tuples; error
+    is None, or the errno and message of a file that could not be
+    read
+  '''
+  start = time.monotonic()
+  done  = [0]
+  def throttle( n ):
+    done[0] += n
+    ahead = done[0] / rate - (time.monotonic() - start)
+    if ahead > 0: time.sleep( ahead )
+  out = []
+  for path in paths:
+    try:
+      out.append( hashFile( path, throttle if rate else None, drop ) + (None,) )
+    except OSError as err:
+      out.append( (None, None, None, None, (err.errno, err.strerror)) )
+  return out
+
+class snapshotVerifier( object ):
+  def __init__(self, backup_dir, catalog, workers = None, log = None):
+    '''
+    Purpose:
+      Class to record and check content checksums of the files in
+      rsync backups. Checksums are kept in the catalog by inode, so a
+      file hard linked into many backups is read once: after a backup,
+      only the inodes it wrote are checksummed (record()). verify()
+      reads back a sample of the inodes, those checked longest ago
+      first, or all of them, and reports the ones that no longer match
+      or cannot be read, with every backup that holds them. Files are
+      read in worker processes, at low priority and a bounded rate.
+    Inputs:
+      backup_dir : Backup directory
+      catalog    : snapshotCatalog of the backup directory
+    Keywords:
+      workers    : Number of worker processes; default from config
+      log        : Logger to use
+    '''
+    super().__init__();
+    self.log        = log or logging.getLogger(__name__);
+    self.backup_dir = backup_dir;
+    self.catalog    = catalog;
+    self.workers    = workers or utils.CONFIG.get('verify_workers', 2) or os.cpu_count() or 1;
+    self.stats      = {'files' : 0, 'bytes' : 0};                               # Files and bytes read by the last call
+    self.__cancel   = False;
+
+  ##############################################################################
+  def cancel(self):
+    self.__cancel = True
+
+  ##############################################################################
+  def record(self, name = None, changed = True, rate = 0):
+    '''
+    Purpose:
+      Method to checksum files whose inode has none yet
+    Keywords:
+      name    : Name of the snapshot; default is all snapshots
+      changed : If True, only files the snapshot wrote; False also
+                 fills in files backed up before checksums were kept
+      rate    : Bytes per second to read at most; zero for no limit
+    Outputs:
+      Returns number of inodes checksummed
+    '''
+    self.catalog.pruneChecksums();                                              # Before inode numbers of deleted backups are mistaken for new files
+    todo = self.catalog.unhashed( name, changed = changed )
+    jobs = [ (inode, os.path.join( self.backup_dir, snap, os.fsdecode(path) ), size)
+               for snap, path, inode, size in todo ]
+    rows = []
+    for inode, (digest, size, mtime, ino, err) in self.__hash( jobs, rate, drop = False ):
+      if err is not None:
+        self.log.warning( 'Failed to checksum inode {}: {}'.format(inode, err[1]) )
+      elif ino == inode:                                                        # Otherwise the catalog is out of date
+        rows.append( (inode, size, mtime, digest, time.time(), 0) )
+    self.catalog.setChecksums( rows )
+    self.log.info( 'Checksummed {} files, {} bytes'.format(len(rows), self.stats['bytes']) )
+    return len(rows)
+
+  ##############################################################################
+  def verify(self, budget = None, rate = 0, name = None):
+    '''
+    Purpose:
+      Method to read files back and compare them with their checksums
+    Keywords:
+      budget : Bytes to read at most; default is everything
+      rate   : Bytes per second to read at most; zero for no limit
+      name   : Only verify files in this snapshot
+    Outputs:
+      Returns list of dictionaries, one for each damaged inode, with
+      the inode, problem ('corrupted', 'changed', 'missing', or
+      'unreadable'), error message, and list of (snapshot, path) that
+      hold it
+    '''
+    self.catalog.pruneChecksums()
+    sample = self.catalog.sample( budget, name )
+    where  = {}
+    jobs   = []
+    for inode, size, mtime, digest, snap, path in sample:
+      where[inode] = (size, mtime, digest)
+      jobs.append( (inode, os.path.join( self.backup_dir, snap, os.fsdecode(path) ), size) )
+    rows = []
+    bad  = []
+    for inode, (digest, size, mtime, ino, err) in self.__hash( jobs, rate, drop = True ):
+      old     = where[inode]
+      problem = None
+      if err is not None:
+        problem = 'missing' if err[0] == errno.ENOENT else 'unreadable'
+      elif ino != inode:
+        problem = 'missing';                                                    # Path now holds another file
+      elif digest != old[2]:
+        problem = 'changed' if (size, mtime) != old[:2] else 'corrupted';       # Rot leaves the size and time alone
+      rows.append( (inode,) + old + (time.time(), int(problem is not None)) )
+      if problem:
+        bad.append( {'inode' : inode, 'problem' : problem,
+                     'error' : err[1] if err else None,
+                     'snapshots' : self.catalog.sharing( inode )} )
+        self.log.error( 'Backup file {}: inode {} in {} backups; {}'.format(
+          problem, inode, len(bad[-1]['snapshots']), err[1] if err else 'checksum mismatch' ) )
+    self.catalog.setChecksums( rows )
+    self.log.info( 'Verified {} files, {} bytes; {} damaged'.format(len(rows), self.stats['bytes'], len(bad)) )
+    return bad
+
+  ##############################################################################
+  def __hash(self, jobs, rate, drop):
+    '''
+    Private method to checksum files in worker processes; yields
+    (key, result) for each (key, path, size) job, as they complete.
+    The rate is shared by the workers.
+    '''
+    self.stats = {'files' : 0, 'bytes' : 0}
+    if not jobs: return
+    workers  = min( self.workers, len(jobs) )
+    method   = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    governor = governorSettings()
+    pool     = ProcessPoolExecutor( max_workers = workers,
+                 mp_context  = multiprocessing.get_context( method ),           # Not forked from a process with threads
+                 initializer = lowerPriority if governor['enabled'] else None,
+                 initargs    = (governor['nice'], governor['ionice']) )
+    futures  = {}
+    try:
+      batch, nbytes = [], 0
+      for i, (key, path, size) in enumerate( jobs ):
+        if self.__cancel: break
+        batch.append( (key, path) )
+        nbytes += size or 0
+        if len(batch) < BATCH_FILES and nbytes < BATCH_BYTES and i < len(jobs) - 1: continue
+        while len(futures) >= workers * 2:                                      # Keep memory and the backlog bounded
+          yield from self.__collect( futures, FIRST_COMPLETED )
+        future = pool.submit( hashFiles, [p for k, p in batch], rate / workers, drop )
+        futures[future] = [k for k, p in batch]
+        batch, nbytes = [], 0
+      while futures:
+        yield from self.__collect( futures, FIRST_COMPLETED )
+    finally:
+      pool.shutdown( wait = True, cancel_futures = True )
+
+  ##############################################################################
+  def __collect(self, futures, when):
+    done, _ = wait( futures, return_when = when )
+    for future in done:
+      keys = futures.pop( future )
+      for key, result in zip( keys, future.result() ):
+        self.stats['files'] += 1
+        self.stats['bytes'] += result[1] or 0
+        yield key, result
@@ -0,0 +1,291 @@
+import logging;
+
+import os, sys, json, time, signal, socket, struct;
+from subprocess import Popen, DEVNULL;
+from threading import Thread, Lock;
+
+from . import APPDIR, setup
+
+SOCKET   = os.path.join( APPDIR, 'pyBackup_worker.sock' )                        # Event socket of the running worker
+INTERVAL = 0.25                                                                 # Seconds between progress events
+LINGER   = 2.0                                                                  # Seconds the last event is served after the backup finished
+
+def start( src_dir = '/', path = SOCKET, timeout = 10.0 ):
+  '''
+  Purpose:
+    Function to start a worker process in its own session, so it keeps
+    running when the process that started it exits, and connect to it
+  Keywords:
+    src_dir : Directory to back up
+    path    : Path of the event socket
+    timeout : Seconds to wait for the worker to listen
+  Outputs:
+    Returns tuple of (Popen instance, workerClient instance); the
+    client is None if the worker did not listen in time
+  '''
+  proc     = Popen( [sys.executable, '-m', 'pyBackup.worker', src_dir, '--socket', path],
+    stdin = DEVNULL, stdout = DEVNULL, stderr = DEVNULL, start_new_session = True )
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline and proc.poll() is None:
+    client = workerClient.connect( path )
+    if client: return proc, client
+    time.sleep( 0.1 )
+  return proc, None
+
+class workerClient( object ):
+  def __init__(self, sock):
+    '''
+    Purpose:
+      Class for a connection to a running worker; see backupWorker.
+      Closing it detaches from the worker, which keeps running.
+    Inputs:
+      sock : Connected socket
+    '''
+    super().__init__();
+    self.sock = sock;
+    self.fid  = sock.makefile( 'rb' );
+
+  ##############################################################################
+  @classmethod
+  def connect(cls, path = SOCKET):
+    '''Return client connected to the worker, or None if no worker is running'''
+    sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    try:
+      sock.connect( path )
+    except OSError:
+      sock.close()
+      return None
+    return cls( sock )
+
+  ##############################################################################
+  def events(self):
+    '''Yield event dictionaries until the worker exits or the client is closed'''
+    try:
+      for line in self.fid:
+        try:
+          yield json.loads( line )
+        except ValueError:
+          return
+    except (OSError, ValueError):                                               # Closed while reading
+      return
+
+  ##############################################################################
+  def cancel(self):
+    '''Ask the worker to cancel the backup; returns False if it is gone'''
+    try:
+      self.sock.sendall( b'{"cmd": "cancel"}\n' )
+    except OSError:
+      return False
+    return True
+
+  ##############################################################################
+  def close(self):
+    try:
+      self.sock.shutdown( socket.SHUT_RDWR )
+    except OSError:
+      pass
+    self.fid.close()
+    self.sock.close()
+
+class backupWorker( object ):
+  def __init__(self, src_dir = '/', socket_path = SOCKET, interval = INTERVAL,
+                loglevel = logging.INFO, log = None):
+    '''
+    Purpose:
+      Class to run one backup in a process of its own and stream its
+      progress, so the GUI never shares an interpreter (or a GIL, or
+      signal handlers) with the transfer. Clients of the event socket
+      get one JSON object per line: a 'progress' event every interval
+      seconds, with the phase, percent done, bytes done and expected,
+      files and bytes per second, and the ETA, starting with the last
+      one as soon as they connect; and a 'finished' event with the
+      return code at the end. A client cancels the backup by sending
+      {"cmd": "cancel"}. Clients may come and go; the backup goes on.
+    Inputs:
+      None.
+    Keywords:
+      src_dir     : Directory to back up
+      socket_path : Path of the event socket
+      interval    : Seconds between progress events
+      loglevel    : Logging level of the backup
+      log         : Logger to use
+    '''
+    super().__init__();
+    self.log         = log or logging.getLogger(__name__);
+    self.src_dir     = src_dir;
+    self.socket_path = socket_path;
+    self.interval    = interval;
+    self.loglevel    = loglevel;
+    self.inst        = None;                                                    # multiBackup instance
+    self.status      = None;                                                    # Return code of the backup
+    self.__clients   = [];
+    self.__lock      = Lock();
+    self.__server    = None;
+    self.__last      = None;                                                    # Last event sent
+    self.__rate      = {'t' : None, 'bytes' : 0, 'files' : 0,
+                        'bytes_per_s' : 0.0, 'files_per_s' : 0.0}
+
+  ##############################################################################
+  def run(self):
+    '''
+    Purpose:
+      Method to run the backup, serving the event socket until it is
+      done
+    Inputs:
+      None.
+    Outputs:
+      Returns the return code of the backup; 1 if another worker is
+      running
+    '''
+    from .rsyncBackup import multiBackup
+    setup()
+    client = workerClient.connect( self.socket_path )
+    if client is not None:
+      client.close();                                                           # Only probing; the other worker keeps running
+      self.log.error( 'Another backup worker is running' )
+      return 1
+    if os.path.exists( self.socket_path ): os.remove( self.socket_path );       # Stale; its worker is gone
+    self.__server = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    self.__server.bind( self.socket_path )
+    os.chmod( self.socket_path, 0o600 )
+    self.__server.listen( 4 )
+    Thread( target = self.__accept, daemon = True ).start()
+
+    self.inst = multiBackup( src_dir = self.src_dir, loglevel = self.loglevel, signals = False )
+    for sig in [signal.SIGTERM, signal.SIGINT, signal.SIGQUIT]:
+      signal.signal( sig, self.cancel )
+    signal.signal( signal.SIGHUP, signal.SIG_IGN );                             # Closing the terminal or the GUI does not stop the backup
+    thread = Thread( target = self.__backup )
+    thread.start()
+    while thread.is_alive():
+      self.__send( self.__progress() )
+      thread.join( self.interval )
+    self.__send( {'event' : 'finished', 'status' : self.status, 'time' : time.time()} )
+    time.sleep( LINGER );                                                       # For clients that connect just now
+    self.__close()
+    return 1 if self.status is None else self.status
+
+  ##############################################################################
+  def cancel(self, *args):
+    self.log.info( 'Canceling backup' )
+    if self.inst: self.inst.cancel()
+
+  ##############################################################################
+  def __backup(self):
+    try:
+      self.status = self.inst.backup()
+    except Exception:
+      self.log.exception( 'Backup failed' )
+      self.status = 1
+
+  ##############################################################################
+  def __progress(self):
+    '''
+    Purpose:
+      Private method to build a progress event; rates are smoothed
+      over the last few intervals
+    Inputs:
+      None.
+    Outputs:
+      Returns event dictionary
+    '''
+    inst  = self.inst
+    now   = time.monotonic()
+    done  = inst.bytes_done
+    files = inst.files_done
+    rate  = self.__rate
+    if rate['t'] is not None and now > rate['t']:
+      dt = now - rate['t']
+      for key, val in (('bytes', done), ('files', files)):
+        current = max( val - rate[key], 0 ) / dt
+        rate[key + '_per_s'] = 0.7 * rate[key + '_per_s'] + 0.3 * current
+    rate.update( t = now, bytes = done, files = files )
+    return {'event'       : 'progress',
+            'phase'       : inst.statusTXT,
+            'progress'    : round( inst.progress, 2 ),
+            'bytes_done'  : done,
+            'bytes_total' : inst.backup_size,
+            'files_done'  : files,
+            'files_per_s' : round( rate['files_per_s'], 1 ),
+            'mb_per_s'    : round( rate['bytes_per_s'] / 1024**2, 2 ),
+            'eta'         : inst.eta,
+            'time'        : time.time()}
+
+  ##############################################################################
+  def __send(self, event):
+    '''Private method to send an event to all clients; clients that are gone are dropped'''
+    line = json.dumps( event ).encode() + b'\n'
+    with self.__lock:
+      self.__last = line
+      for client in list( self.__clients ):
+        try:
+          client.sendall( line )
+        except OSError:
+          self.__drop( client )
+
+  ##############################################################################
+  def __accept(self):
+    '''Private method of the thread accepting clients'''
+    while True:
+      try:
+        client, _ = self.__server.accept()
+      except OSError:                                                           # Server closed
+        return
+      client.setsockopt( socket.SOL_SOCKET, socket.SO_SNDTIMEO, struct.pack( 'll', 5, 0 ) );# A client that stops reading is dropped
+      with self.__lock:
+        self.__clients.append( client )
+        if self.__last:
+          try:
+            client.sendall( self.__last )
+          except OSError:
+            self.__drop( client )
+            continue
+      Thread( target = self.__read, args = (client,), daemon = True ).start()
+
+  ##############################################################################
+  def __read(self, client):
+    '''Private method of the thread reading commands of a client'''
+    try:
+      with client.makefile( 'rb' ) as fid:
+        for line in fid:
+          try:
+            cmd = json.loads( line ).get('cmd', None)
+          except (ValueError, AttributeError):
+            continue
+          if cmd == 'cancel': self.cancel()
+    except (OSError, ValueError):
+      pass
+    with self.__lock:
+      self.__drop( client )
+
+  ##############################################################################
+  def __drop(self, client):
+    '''Private method to forget a client; the lock must be held'''
+    if client in self.__clients:
+      self.__clients.remove( client )
+      try:
+        client.shutdown( socket.SHUT_RDWR );                                    # Wakes up its reader thread
+        client.close()
+      except OSError:
+        pass
+
+  ##############################################################################
+  def __close(self):
+    self.__server.close()
+    try:
+      os.remove( self.socket_path )
+    except OSError:
+      pass
+    with self.__lock:
+      for client in list( self.__clients ): self.__drop( client )
+
+if __name__ == "__main__":
+  import argparse
+  parser = argparse.ArgumentParser(description="Run one backup and stream its progress")
+  parser.add_argument("src_dir",    type = str, default='/', nargs='?', help = "Directory to backup; recusively")
+  parser.add_argument("--socket",   type = str, default=SOCKET, help = "Path of the event socket")
+  parser.add_argument("--loglevel", type = int, default=20,  help = "Set logging level")
+  args = parser.parse_args()
+  logging.getLogger( 'pyBackup' ).setLevel( args.loglevel )
+  inst = backupWorker( src_dir = args.src_dir, socket_path = args.socket, loglevel = args.loglevel )
+  sys.exit( inst.run() )
@@ -0,0 +1,31 @@
+import os, atexit, shutil, tempfile
+
+os.environ['HOME'] = tempfile.mkdtemp( prefix = 'pyBackup-test-' );             # Before pyBackup is imported; the application directory is below it
+atexit.register( shutil.rmtree, os.environ['HOME'], True )
+
+from pyBackup.rsyncParser import Item
+
+MTIME = b'2024/01/01-00:00:00'
+
+def makeSnapshot( catalog, backup_dir, name, files, link = None ):
+  '''
+  Write a backup directory and add it to the catalog as rsync would.
+  files is a dictionary of path: contents; contents of None hard link
+  the file from the link backup.
+  '''
+  snap_dir = os.path.join( str(backup_dir), name )
+  catalog.begin( name, link = link )
+  for path, data in sorted( files.items() ):
+    dst = os.path.join( snap_dir, path )
+    os.makedirs( os.path.dirname( dst ), exist_ok = True )
+    if data is None:
+      src = os.path.join( str(backup_dir), link, path )
+      os.link( src, dst )
+      flags, size = b'hf          ', os.path.getsize( src )
+    else:
+      with open( dst, 'wb' ) as fid:
+        fid.write( data )
+      flags, size = b'>f+++++++++', len(data)
+    catalog.add( Item( flags, size, MTIME, os.fsencode( path ) ) )
+  catalog.finish( snap_dir )
+  return snap_dir
@@ -0,0 +1,40 @@
+import pytest
+
+from pyBackup.catalog import snapshotCatalog
+
+from conftest import makeSnapshot
+
+@pytest.fixture
+def catalog( tmp_path ):
+  catalog = snapshotCatalog( str( tmp_path / 'catalog.db' ) )
+  yield catalog
+  catalog.close()
+
+def paths( catalog ):
+  return sorted( row[0] for row in catalog.db.execute( 'SELECT path FROM paths' ) )
+
+def test_add_records_versions_and_changes( catalog, tmp_path ):
+  makeSnapshot( catalog, tmp_path, 'a', {'x/keep': b'1', 'x/old': b'22'} )
+  makeSnapshot( catalog, tmp_path, 'b', {'x/keep': None, 'x/new': b'333'}, link = 'a' )
+  assert catalog.snapshots() == ['a', 'b']
+  assert [row[0] for row in catalog.versions( 'x/keep' )] == ['a', 'b']
+  assert catalog.versions( '/x/keep/' ) == catalog.versions( 'x/keep' )
+  assert [row[0] for row in catalog.changes( 'b' )] == ['x/new']
+
+def test_drop_removes_snapshot_and_unused_paths( catalog, tmp_path ):
+  makeSnapshot( catalog, tmp_path, 'a', {'keep': b'1', 'old': b'22'} )
+  makeSnapshot( catalog, tmp_path, 'b', {'keep': None, 'new': b'333'}, link = 'a' )
+  catalog.drop( 'a' )
+  assert catalog.snapshotId( 'a' ) is None and catalog.snapshots() == ['b']
+  assert catalog.versions( 'old' ) == []
+  assert paths( catalog ) == [b'keep', b'new']
+
+def test_prune_paths_in_batches( catalog, tmp_path ):
+  files = {'f{:02d}'.format(i): b'x' for i in range( 25 )}
+  makeSnapshot( catalog, tmp_path, 'a', files )
+  makeSnapshot( catalog, tmp_path, 'b', {'f00': None}, link = 'a' )
+  catalog.drop( 'a', prune = False )
+  assert len( paths( catalog ) ) == 25
+  assert catalog.prunePaths( batch = 4 ) == 24
+  assert paths( catalog ) == [b'f00']
+  assert catalog.prunePaths() == 0
@@ -0,0 +1,24 @@
+import os
+
+from pyBackup.checkpoint import backupCheckpoint
+from pyBackup.journal import journalChanges, FILE, TIME
+
+def finish( path, src_dir, changes = None ):
+  first = backupCheckpoint( path, src_dir, 'a' )
+  for name in ['one', 'two']:
+    first.done( name, first.start( name ), {'number_of_files' : 1} )
+  return backupCheckpoint( path, src_dir, 'b', changes = changes )
+
+def test_without_journal_every_subtree_is_transferred( tmp_path ):
+  resumed = finish( str( tmp_path / 'x.checkpoint' ), str(tmp_path) )
+  assert resumed.resumed == 'a' and set( resumed.finished ) == {'one', 'two'}
+  assert resumed.reusable( 'one' ) is None and resumed.reusable( 'two' ) is None
+
+def test_journal_decides_which_subtrees_are_skipped( tmp_path ):
+  src     = str(tmp_path)
+  changed = os.fsencode( os.path.join( src, 'two', 'file' ) )
+  changes = journalChanges( src, [TIME + b'9999999999', FILE + changed] )
+  resumed = finish( str( tmp_path / 'x.checkpoint' ), src, changes )
+  assert resumed.reusable( 'one' ) == {'number_of_files' : 1}
+  assert resumed.reusable( 'two' ) is None
+  assert resumed.reusable( 'three' ) is None
@@ -0,0 +1,93 @@
+import os, json, threading
+
+import pytest
+
+from pyBackup.utils import Config
+
+def makeConfig( tmp_path, **kwargs ):
+  data = {'disk_UUID' : 'abc', 'backup_dir' : 'Backups.backupsdb', 'date_FMT' : '%Y'}
+  data.update( kwargs )
+  path = tmp_path / 'config.json'
+  path.write_text( json.dumps( data ) )
+  return Config( file = str(path) ), path
+
+def onDisk( path ):
+  return json.loads( path.read_text() )
+
+def test_save_merges_with_file( tmp_path ):
+  config, path = makeConfig( tmp_path, a = 1, b = 2 )
+  data = onDisk( path )
+  data['b'] = 20;                                                               # Changed by another process
+  path.write_text( json.dumps( data ) )
+  config['a'] = 10
+  config.saveConfig()
+  data = onDisk( path )
+  assert data['a'] == 10 and data['b'] == 20
+  assert config['b'] == 20
+
+def test_reload_keeps_unsaved_changes( tmp_path ):
+  config, path = makeConfig( tmp_path, a = 1, b = 2 )
+  config['a'] = 10
+  data = onDisk( path )
+  data['b'] = 20
+  path.write_text( json.dumps( data ) )
+  assert config.reload( force = True )
+  assert config['a'] == 10 and config['b'] == 20
+
+def test_backup_dir_gets_host_without_uuid( tmp_path ):
+  config, path = makeConfig( tmp_path, disk_UUID = '' )
+  assert os.path.dirname( config['backup_dir'] ) == 'Backups.backupsdb'
+
+def test_transaction_writes_once( tmp_path ):
+  config, path = makeConfig( tmp_path )
+  with config.transaction():
+    config['a'] = 1
+    with config.transaction():
+      config['b'] = 2
+    assert 'a' not in onDisk( path )
+  data = onDisk( path )
+  assert data['a'] == 1 and data['b'] == 2
+
+def test_transaction_rollback( tmp_path ):
+  config, path = makeConfig( tmp_path, a = {'x' : 1} )
+  with pytest.raises( RuntimeError ):
+    with config.transaction():
+      config['a']['x'] = 2;                                                     # Changed in place, then set
+      config['a'] = config['a']
+      config['b'] = 2
+      raise RuntimeError()
+  assert config['a'] == {'x' : 1} and config['b'] is None
+  assert 'b' not in onDisk( path )
+
+def test_rollback_keeps_other_threads( tmp_path ):
+  config, path = makeConfig( tmp_path )
+  inside = threading.Event()
+  done   = threading.Event()
+  def other():
+    inside.wait()
+    config['other'] = 1
+    done.set()
+  thread = threading.Thread( target = other )
+  thread.start()
+  with pytest.raises( RuntimeError ):
+    with config.transaction():
+      config['mine'] = 1
+      inside.set()
+      done.wait()
+      raise RuntimeError()
+  thread.join()
+  assert config['other'] == 1 and config['mine'] is None
+
+def test_readers_never_see_partial_merge( tmp_path ):
+  config, path = makeConfig( tmp_path )
+  stop   = threading.Event()
+  failed = []
+  def reader():
+    while not stop.is_set():
+      if config.get( 'date_FMT' ) is None: failed.append( True )
+  threads = [threading.Thread( target = reader ) for i in range(4)]
+  for thread in threads: thread.start()
+  for i in range(200): config.reload( force = True )
+  stop.set()
+  for thread in threads: thread.join()
+  assert not failed
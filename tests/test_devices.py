@@ -0,0 +1,88 @@
+import os, sys, json, stat
+from types import SimpleNamespace
+
+import pytest
+
+from pyBackup import devices
+from pyBackup.devices import deviceCache, lsblkDevices
+
+pytestmark = pytest.mark.skipif( 'linux' not in sys.platform, reason = 'mountinfo is Linux only' )
+
+SDA1 = os.makedev( 8, 1 )
+SDB1 = os.makedev( 8, 17 )
+
+def mountinfo( path, *mounts ):
+  '''Write a mount table; mounts are (major:minor, root, mount point, source) tuples'''
+  with open( str(path), 'w' ) as fid:
+    for i, (dev, root, point, source) in enumerate( mounts ):
+      fid.write( '{} 1 {} {} {} rw,relatime - ext4 {} rw\n'.format(30+i, dev, root, point, source) )
+  return str(path)
+
+@pytest.fixture
+def disks( tmp_path, monkeypatch ):
+  '''Two fake block devices linked from a by-uuid directory, and their mount points'''
+  by_uuid = tmp_path / 'by-uuid'
+  by_uuid.mkdir()
+  table   = {}
+  for name, uuid, dev in [('sda1', 'AAAA', SDA1), ('sdb1', 'BBBB', SDB1)]:
+    node = tmp_path / name
+    node.write_bytes( b'' )
+    os.symlink( str(node), str(by_uuid / uuid) )
+    table[str(node)] = SimpleNamespace( st_mode = stat.S_IFBLK, st_rdev = dev )
+    mnt  = tmp_path / 'mnt' / name
+    mnt.mkdir( parents = True )
+    (mnt / 'file').write_bytes( b'' )
+    table[str(mnt / 'file')] = SimpleNamespace( st_dev = dev )
+  real = os.stat
+  def fakeStat( path, *args, **kwargs ):
+    return table.get( os.path.realpath( os.fsdecode( path ) ), None ) or real( path, *args, **kwargs )
+  monkeypatch.setattr( devices.os, 'stat', fakeStat )
+  return tmp_path, str(by_uuid)
+
+def test_direct_lookup_by_device_number( disks ):
+  root, by_uuid = disks
+  table = mountinfo( root / 'mountinfo',
+    ('8:1',  '/',    str(root / 'mnt' / 'sda1'), str(root / 'sda1')),
+    ('8:1',  '/sub', str(root / 'bind'),         str(root / 'sda1')),       # Bind mount; skipped
+    ('8:17', '/',    str(root / 'mnt' / 'sdb1'), str(root / 'sdb1')),
+    ('8:17', '/',    str(root / 'mnt' / 'sdb1' / 'again'), str(root / 'sdb1')) ) # Mounted twice; the shortest path is used
+  cache = deviceCache( mountinfo = table, by_uuid = by_uuid )
+  assert cache.direct
+  assert cache.mountPoint( 'AAAA' ) == str(root / 'mnt' / 'sda1')
+  assert cache.mountPoint( 'BBBB' ) == str(root / 'mnt' / 'sdb1')
+  assert cache.uuid( str(root / 'mnt' / 'sda1' / 'file') ) == 'AAAA'
+  assert cache.mountPoint( 'CCCC' ) is None
+
+  mountinfo( table, ('8:1', '/', str(root / 'mnt' / 'sda1'), str(root / 'sda1')) )
+  assert cache.mountPoint( 'BBBB' ) is not None;                                # Cached until the kernel reports a change
+  cache.invalidate()
+  assert cache.mountPoint( 'BBBB' ) is None
+  assert cache.mountPoint( 'AAAA' ) == str(root / 'mnt' / 'sda1')
+
+def test_lsblk_fallback_with_nested_devices( tmp_path, monkeypatch ):
+  tree  = {'blockdevices' : [
+    {'name' : 'sda', 'children' : [
+      {'name' : 'sda1', 'uuid' : 'AAAA', 'mountpoint' : '/boot'},
+      {'name' : 'sda2', 'uuid' : 'LUKS', 'mountpoint' : None, 'children' : [
+        {'name' : 'crypt', 'uuid' : 'LVM', 'children' : [
+          {'name' : 'vg-home', 'uuid' : 'HOME', 'mountpoint' : '/home'}]}]}]},
+    {'name' : 'sdb', 'uuid' : 'BBBB', 'mountpoint' : '/media/backup'}]}
+  calls = []
+  def lsblk( cmd ):
+    calls.append( cmd )
+    return json.dumps( tree ).encode()
+  monkeypatch.setattr( devices, 'check_output', lsblk )
+  assert {d['name'] for d in lsblkDevices( tree )} == {'sda', 'sda1', 'sda2', 'crypt', 'vg-home', 'sdb'}
+
+  cache = deviceCache( mountinfo = mountinfo( tmp_path / 'mountinfo' ),
+                       by_uuid = str( tmp_path / 'missing' ) )
+  assert not cache.direct
+  assert cache.mountPoint( 'HOME' ) == '/home'
+  assert cache.mountPoint( 'LUKS' ) is None
+  assert cache.uuid( '/media/backup/Backups.backupsdb' ) == 'BBBB'
+  assert calls == [devices.LSBLK];                                              # Cached between lookups
+
+  tree['blockdevices'].pop()
+  cache.invalidate()
+  assert cache.mountPoint( 'BBBB' ) is None and cache.uuid( '/home/user' ) == 'HOME'
+  assert len( calls ) == 2
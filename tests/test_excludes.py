@@ -0,0 +1,58 @@
+import os, re
+
+from pyBackup.excludes import translate, escape, isTagged, excludeFilter, CACHE_TAG, SIGNATURE
+
+def matches( pattern, path ):
+  return re.search( translate( pattern ), path ) is not None
+
+def test_translate_anchored():
+  assert matches( '/tmp/', 'tmp' )
+  assert matches( '/tmp/', 'tmp/a/b' )
+  assert not matches( '/tmp/', 'home/tmp' )
+  assert not matches( '/tmp/', 'tmpfiles' )
+
+def test_translate_unanchored():
+  assert matches( 'lost+found/', 'lost+found' )
+  assert matches( 'lost+found/', 'mnt/lost+found/x' )
+  assert not matches( 'lost+found/', 'mnt/not-lost+found' )
+
+def test_translate_wildcards():
+  assert matches( '*.o', 'src/main.o' )
+  assert not matches( '/*.o', 'src/main.o' )
+  assert matches( '/src/**/build/', 'src/a/b/build/x' )
+  assert matches( 'file?.txt', 'file1.txt' )
+  assert not matches( 'file?.txt', 'file12.txt' )
+  assert matches( '[ab].log', 'x/a.log' ) and not matches( '[ab].log', 'x/c.log' )
+
+def test_escape_round_trip():
+  name = 'odd[1]*?.txt'
+  assert matches( '/' + escape( name ), name )
+  assert not matches( '/' + escape( name ), 'odd1x.txt' )
+
+def test_is_tagged( tmp_path ):
+  (tmp_path / 'cache').mkdir()
+  (tmp_path / 'cache' / CACHE_TAG).write_bytes( SIGNATURE + b'\n' )
+  (tmp_path / 'fake').mkdir()
+  (tmp_path / 'fake' / CACHE_TAG).write_bytes( b'not a tag' )
+  (tmp_path / 'private').mkdir()
+  (tmp_path / 'private' / '.nobackup').touch()
+  assert isTagged( tmp_path / 'cache' ) == CACHE_TAG
+  assert isTagged( tmp_path / 'cache', caches = False ) is None
+  assert isTagged( tmp_path / 'fake' ) is None
+  assert isTagged( tmp_path / 'private', markers = ['.nobackup'] ) == '.nobackup'
+  assert isTagged( tmp_path / 'private', names = [], markers = ['.nobackup'] ) is None
+
+def test_filter_excludes_patterns_mounts_and_tags( tmp_path ):
+  src  = tmp_path / 'home'
+  (src / 'build').mkdir( parents = True )
+  filt = excludeFilter( str(src), patterns = ['*.o', '/home/skip/'], mounts = [str(tmp_path / 'disk')] )
+  assert filt.excluded( str(src / 'a.o') )
+  assert filt.excluded( str(src / 'skip' / 'x') )
+  assert not filt.excluded( str(src / 'keep') )
+  assert filt.excluded( str(tmp_path / 'disk' / 'x') )
+  (src / 'build' / '.nobackup').touch()
+  filt.markers = ['.nobackup']
+  assert filt.tag( str(src / 'build') )
+  assert filt.excluded( str(src / 'build' / 'out') )
+  assert not filt.excluded( str(src / 'build') );                               # Kept, empty
+  assert '- /home/build/*' in filt.rules()
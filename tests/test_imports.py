@@ -0,0 +1,31 @@
+import os, sys, json, pkgutil, subprocess
+
+import pyBackup
+
+BUDGET = 0.5                                                                    # Seconds the preflight import may take
+HEAVY  = ['sqlite3', 'pyBackup.rsyncBackup', 'pyBackup.catalog', 'pyBackup.rsyncPool']
+SCRIPT = '''
+import sys, json, time
+t0 = time.perf_counter()
+import pyBackup.preflight
+took = time.perf_counter() - t0
+loaded = [m for m in {heavy!r} if m in sys.modules]
+for name in {modules!r}:
+  __import__( 'pyBackup.' + name )
+print( json.dumps( {{'took' : took, 'loaded' : loaded}} ) )
+'''
+
+def run( home, modules ):
+  env  = dict( os.environ, HOME = str(home) )
+  root = os.path.dirname( os.path.dirname( pyBackup.__file__ ) )
+  out  = subprocess.run( [sys.executable, '-c', SCRIPT.format( heavy = HEAVY, modules = modules )],
+                         env = env, cwd = root, check = True, stdout = subprocess.PIPE )
+  return json.loads( out.stdout )
+
+def test_import_writes_nothing_and_preflight_stays_light( tmp_path ):
+  modules = [ m.name for m in pkgutil.iter_modules( pyBackup.__path__ )
+              if m.name != 'pyBackupGui' ];                                     # GUI needs PyQt5 and python-crontab
+  result  = run( tmp_path, modules )
+  assert os.listdir( str(tmp_path) ) == []
+  assert result['loaded'] == []
+  assert result['took'] < BUDGET
@@ -0,0 +1,36 @@
+from pyBackup.metrics import summarize, percentile, appendHistory, readHistory
+
+def run( duration, status = 0, **phases ):
+  return {'status' : status, 'duration' : duration, 'phases' : phases,
+          'bytes_per_second' : 100 * duration}
+
+def test_percentile():
+  assert percentile( [], 50 ) is None and percentile( [None], 50 ) is None
+  assert percentile( [3, 1, None, 2], 50 ) == 2
+  assert percentile( [1, 2, 3, 4], 90 ) == 4
+
+def test_summarize_skips_failed_runs_and_reports_trend():
+  records = [run( 10, transfer = 8 ), run( 99, status = 1 ), run( 10, transfer = 6 ),
+             run( 20, transfer = 16, prune = 2 ), run( 20, transfer = 18 )]
+  out     = summarize( records )
+  assert out['runs'] == 5 and out['failed'] == 1
+  assert out['duration'] == {'median' : 20, 'p90' : 20}
+  assert out['phases']['transfer'] == {'median' : 16, 'p90' : 18}
+  assert out['phases']['prune'] == {'median' : 2, 'p90' : 2}
+  assert out['bytes_per_second'] == 2000 and out['files_per_second'] is None
+  assert out['trend'] == 1.0                                                    # Median went from 10 to 20 seconds
+
+def test_summarize_empty():
+  out = summarize( [] )
+  assert out['runs'] == 0 and out['duration']['median'] is None and out['trend'] is None
+
+def test_history_is_trimmed_and_survives_torn_lines( tmp_path ):
+  path = str( tmp_path / 'history.ndjson' )
+  for i in range( 10 ):
+    appendHistory( {'i' : i, 'destination' : 'a' if i % 2 else 'b'}, path = path, keep = 3 )
+  with open( path, 'a' ) as fid:
+    fid.write( '{"i": 10, "dest' )
+  records = readHistory( path )
+  assert [r['i'] for r in records][-3:] == [7, 8, 9] and len( records ) <= 6
+  assert [r['i'] for r in readHistory( path, last = 2, destination = 'a' )] == [7, 9]
+  assert readHistory( str( tmp_path / 'missing' ) ) == []
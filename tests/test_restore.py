@@ -0,0 +1,23 @@
+import os
+
+import pytest
+
+from pyBackup.restore import relativePath
+
+def touch( root, *paths ):
+  for path in paths:
+    path = os.path.join( str(root), path )
+    os.makedirs( os.path.dirname( path ), exist_ok = True )
+    open( path, 'w' ).close()
+
+def test_relative_to_source_dir( tmp_path ):
+  touch( tmp_path, 'a/alice/notes.txt', 'b/home/alice/notes.txt' )
+  assert relativePath( str(tmp_path), ['a'], '/home/alice/notes.txt', src_dir = '/home/alice' ) == 'alice/notes.txt'
+  assert relativePath( str(tmp_path), ['a'], '/srv/alice/notes.txt', src_dir = '/home/alice' ) is None
+  assert relativePath( str(tmp_path), ['b'], '/home/alice/notes.txt', src_dir = '/' ) == 'home/alice/notes.txt'
+
+def test_unknown_source_dir_fails_when_ambiguous( tmp_path ):
+  touch( tmp_path, 'a/alice/notes.txt', 'a/notes.txt' )
+  with pytest.raises( ValueError ):
+    relativePath( str(tmp_path), ['a'], '/home/alice/notes.txt' )
+  assert relativePath( str(tmp_path), ['a'], '/home/alice/notes.txt', src_dir = '/home/alice' ) == 'alice/notes.txt'
@@ -0,0 +1,64 @@
+import os, calendar
+from datetime import datetime
+
+import pytest
+
+from pyBackup.catalog import snapshotCatalog
+from pyBackup.usage import diskUsage
+from pyBackup.retention import retentionPlanner, parseTiers, HOUR
+
+from conftest import makeSnapshot
+
+FMT   = '%Y-%m-%dT%H_%M_%S'
+NOW   = calendar.timegm( datetime( 2024, 6, 1 ).timetuple() )
+TIERS = [[24, 1], [720, 24], [None, 168]]
+
+def name( hours_ago ):
+  return datetime.utcfromtimestamp( NOW - hours_ago * HOUR ).strftime( FMT )
+
+def test_parse_tiers_keeps_everything_older():
+  assert parseTiers( [[24, 1]] ) == [(24 * HOUR, HOUR), (None, HOUR)]
+  assert parseTiers( TIERS )[-1] == (None, 168 * HOUR)
+
+def test_classify_thins_within_intervals():
+  planner = retentionPlanner( tiers = TIERS, date_FMT = FMT )
+  hourly  = [name( h ) for h in range( 5 )]                                     # One an hour; all kept
+  daily   = [name( 60 + h ) for h in range( 0, 6, 2 )]                          # Same day; only the oldest kept
+  keep, thin = planner.classify( hourly + daily + ['not-a-date'], now = NOW )
+  assert set( hourly ) <= set( keep ) and 'not-a-date' in keep
+  assert len( set( daily ) & set( keep ) ) == 1 and len( thin ) == 2
+
+def test_plan_without_usage_has_unknown_sizes():
+  planner = retentionPlanner( tiers = TIERS, date_FMT = FMT )
+  plan    = planner.plan( [name( 1 ), name( 0 )], 100, now = NOW )
+  assert plan['delete'] == [] and plan['reclaim'] is None and plan['sizes'] is None
+
+@pytest.fixture
+def usage( tmp_path ):
+  catalog = snapshotCatalog( str( tmp_path / 'catalog.db' ) )
+  yield diskUsage( catalog )
+  catalog.close()
+
+def test_plan_frees_shared_inodes_together( tmp_path, usage ):
+  a, b, c, d = name( 50 ), name( 49 ), name( 1 ), name( 0 )
+  makeSnapshot( usage.catalog, tmp_path, a, {'only_a' : b'a' * 100, 'shared' : b's' * 1000} )
+  makeSnapshot( usage.catalog, tmp_path, b, {'only_b' : b'b' * 10,  'shared' : None}, link = a )
+  makeSnapshot( usage.catalog, tmp_path, c, {'only_c' : b'c' * 500}, link = b )
+  makeSnapshot( usage.catalog, tmp_path, d, {'only_c' : None}, link = c )
+  for snap in (a, b, c, d): usage.add( snap )
+  planner = retentionPlanner( tiers = TIERS, date_FMT = FMT, usage = usage )
+
+  plan = planner.plan( [a, b, c, d], 0, now = NOW )
+  assert plan['sizes'] == {a : 100, b : 10, c : 0, d : 0}
+  assert plan['thin'] == [b]
+
+  plan = planner.plan( [a, b, c, d], 1050, now = NOW )                          # Needs both, for the shared file
+  assert plan['delete'] == [b, a]
+  assert plan['reclaim'] == 1110 == usage.reclaimable( plan['delete'] )
+
+  plan = planner.plan( [a, b, c, d], 5, now = NOW )                             # The redundant one is enough
+  assert plan['delete'] == [b] and plan['reclaim'] == 10
+
+  plan = planner.plan( [a, b, c, d], 100, protect = [b], now = NOW )            # Not enough without it
+  assert b not in plan['delete'] and d not in plan['delete']
+  assert plan['reclaim'] == usage.reclaimable( plan['delete'] )
@@ -0,0 +1,36 @@
+import io, errno
+
+from pyBackup.rsyncParser import (rsyncParser, FileStarted, Progress, FileFinished,
+  Stats, Item, Deleted, Error)
+
+OUTPUT = (b'sending incremental file list\n'
+          b'>f+++++++++ 1234 2024/01/01-00:00:00 dir/new file\n'
+          b'      1,234 100%    1.00MB/s    0:00:00 (xfr#1, to-chk=1/3)\r'
+          b'*deleting   dir/old\n'
+          b'rsync: write failed on "/disk/dir/big": No space left on device (28)\n'
+          b'Number of files: 3 (reg: 2, dir: 1)\n'
+          b'Total transferred file size: 1,234 bytes')                         # No newline after the last line
+
+def parse( data, **kwargs ):
+  return list( rsyncParser( io.BytesIO( data ), **kwargs ) )
+
+def test_events_of_itemized_output():
+  events = parse( OUTPUT, items = True, paths = False )
+  assert events == [
+    Item( b'>f+++++++++', 1234, b'2024/01/01-00:00:00', b'dir/new file' ),
+    Progress( 1234, 100 ),
+    FileFinished( 1234 ),
+    Deleted( b'dir/old' ),
+    Error( errno.ENOSPC, 'write failed on "/disk/dir/big": No space left on device' ),
+    Stats( 'number_of_files', 3 ),
+    Stats( 'total_transferred_file_size', 1234 )]
+
+def test_paths_without_items():
+  events = parse( OUTPUT )
+  assert events[0] == FileStarted( b'sending incremental file list' )
+  assert FileStarted( b'>f+++++++++ 1234 2024/01/01-00:00:00 dir/new file' ) in events
+  assert not any( isinstance( e, (Item, Deleted) ) for e in events )
+  assert any( isinstance( e, Error ) for e in events )
+
+def test_lines_longer_than_the_buffer():
+  assert parse( OUTPUT, readsize = 7, items = True ) == parse( OUTPUT, items = True )